@@ -0,0 +1,44 @@
+import json
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "run"))
+from gen_utils import complete_qa_pairs, loads_model_json, repair_model_json
+#loads_model_json 的回归检查：截断的输出不能被修成空结果当成功返回 (否则切片记成 empty，截断重试永远不会触发)
+#改了 gen_utils 里的 JSON 修复逻辑之后跑一遍，全部通过才打印 ✅
+
+PAIR = '{"instruction": "为什么响应增强?", "output": "归因于 $\\frac{R_a}{R_g}$ 变大。"}'
+FULL = '{"qa_pairs": [' + PAIR + ', ' + PAIR + ']}'
+
+def expect_error(name, text):
+    try:
+        result = loads_model_json(text)
+    except json.JSONDecodeError:
+        print(f"   ✔ {name}: 抛出 JSONDecodeError")
+        return
+    raise AssertionError(f"{name}: 应该抛 JSONDecodeError，实际返回 {result!r}")
+
+def expect_pairs(name, text, count):
+    pairs = complete_qa_pairs(loads_model_json(text))
+    assert len(pairs) == count, f"{name}: 应该有 {count} 个问答对，实际 {len(pairs)}"
+    print(f"   ✔ {name}: {count} 个问答对")
+
+def main():
+    print("🧪 检查 loads_model_json ...")
+    # 第一个对象的字符串中间被截断：修复只能退回到 {"qa_pairs": []}，必须报错让调用方按截断重试
+    first_cut = FULL[:FULL.index("归因于") + 2]
+    repaired, recovered = repair_model_json(first_cut)
+    assert recovered and not complete_qa_pairs(json.loads(repaired)), repaired
+    expect_error("第一个对象的字符串里截断", first_cut)
+    expect_error("数组刚开头就截断", '{"qa_pairs": [')
+    expect_error("第一个对象只有问题", '{"qa_pairs": [{"instruction": "为什么?", "output": "归')
+    expect_error("没有 JSON", "抱歉，我无法回答。")
+    # 第二个对象里截断：第一个问答对是完整的，照样收下
+    expect_pairs("第二个对象里截断", FULL[:FULL.rindex("归因于") + 2], 1)
+    expect_pairs("完整输出", FULL, 2)
+    expect_pairs("代码块 + 前后说明", "好的：\n```json\n" + FULL + "\n```\n以上。", 2)
+    # 模型确实没出题 (完整的空数组) 不是截断，正常返回
+    expect_pairs("完整的空结果", '{"qa_pairs": []}', 0)
+    print("✅ 全部通过")
+
+if __name__ == "__main__":
+    main()
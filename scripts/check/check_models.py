@@ -1,32 +1,40 @@
 import os
+import time
 from openai import OpenAI
-#检查硅基流动可使用模型
+#检查平台上可使用的模型；配置了 ENDPOINTS 时逐个检查 RHS / DSP 路由要用的端点 (key 能不能用、模型在不在、延迟多少)
 API_KEY = os.getenv("SILICONFLOW_API_KEY", "你的api")
+BASE_URL = "https://api.siliconflow.cn/v1"
+# 只列出名字里带这些关键词的模型 (不区分大小写)
+KEYWORDS = ["deepseek", "llama"]
+# 与 RHS / DSP 里的 ENDPOINTS 写法相同，直接复制过来；留空则只检查上面这一个平台
+ENDPOINTS = []
 
-client = OpenAI(
-    api_key=API_KEY,
-    base_url="https://api.siliconflow.cn/v1"
-)
+def check_endpoint(name, base_url, api_key, model=""):
+    client = OpenAI(api_key=api_key, base_url=base_url)
+    print(f"\n正在连接 {name} ({base_url}) 获取模型列表...")
+    started = time.monotonic()
+    try:
+        models = client.models.list()
+    except Exception as e:
+        print(f"❌ 获取失败: {e}")
+        return False
+    ids = [m.id for m in models.data]
+    print(f"✅ 连接正常，耗时 {time.monotonic() - started:.2f}s，共 {len(ids)} 个模型")
+    ok = True
+    if model:
+        ok = model in ids
+        print(f"  {'✅' if ok else '❌'} 配置的模型 {model} {'存在' if ok else '不在列表里，请检查名字'}")
+    for kw in KEYWORDS:
+        matched = [i for i in ids if kw.lower() in i.lower()]
+        print(f"  包含 {kw} 的模型: {len(matched)} 个")
+        for i in matched:
+            print(f"    - {i}")
+    return ok
 
-try:
-    print("正在连接 SiliconFlow 获取模型列表...")
-    models = client.models.list()
-    
-    print("\n✅ 找到以下 DeepSeek 相关模型：")
-    found = False
-    for m in models.data:
-        # 只打印名字里带 deepseek 的
-        if "deepseek" in m.id.lower():
-            print(f"  - {m.id}")
-            found = True
-            
-    if not found:
-        print("  (未找到包含 deepseek 名字的模型)")
-
-    print("\n✅ 找到以下 Llama 3.2 相关模型：")
-    for m in models.data:
-        if "llama" in m.id.lower() and "3.2" in m.id:
-            print(f"  - {m.id}")
-
-except Exception as e:
-    print(f"❌ 获取失败: {e}")
\ No newline at end of file
+if __name__ == "__main__":
+    if ENDPOINTS:
+        results = [check_endpoint(ep.get("name") or ep.get("model", ""), ep.get("base_url", ""), ep.get("api_key", ""),
+                                  ep.get("model", "")) for ep in ENDPOINTS]
+        print(f"\n=== {sum(results)}/{len(results)} 个端点可用 ===")
+    else:
+        check_endpoint("SiliconFlow", BASE_URL, API_KEY)
@@ -1,11 +1,25 @@
 import json
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "run"))
+from gen_utils import ChunkStore
 
 FILE_PATH = ""
+# 可选：chunk.py 输出的切片文件 (带 .index.db 索引)，填了会按 source_chunk_id 回查原文，统计对不上的问答对
+CHUNK_FILE = ""
 
 def check_physics_quality():
     total = 0
     has_formula = 0
     has_logic_words = 0
+    orphans = 0
+    store = None
+    if CHUNK_FILE:
+        store = ChunkStore(CHUNK_FILE)
+        # 索引丢了或比切片文件旧时先重建，否则 ChunkStore 会建一个空索引，所有问答对都被算成对不上
+        if not os.path.exists(store.index_path) or os.path.getmtime(store.index_path) < os.path.getmtime(CHUNK_FILE):
+            print(f"🔧 切片索引缺失或已过期，正在重建: {store.index_path}")
+            store.rebuild()
     
     # 物理逻辑关键词
     logic_keywords = [
@@ -36,6 +50,10 @@ def check_physics_quality():
             if any(kw in content for kw in logic_keywords):
                 has_logic_words += 1
 
+            # 按切片 ID 直接查索引，不用扫描切片文件
+            if store is not None and data.get('source_chunk_id') not in store:
+                orphans += 1
+
     if total == 0:
         print("⚠️ 文件为空，还没有生成任何数据。")
         return
@@ -44,6 +62,9 @@ def check_physics_quality():
     print(f"--------------------------------------")
     print(f"🧮 含公式比例: {has_formula/total*100:.1f}%  (建议 >30%)")
     print(f"🧠 含逻辑比例: {has_logic_words/total*100:.1f}%  (建议 >80%)")
+    if store is not None:
+        store.close()
+        print(f"🔗 找不到原切片: {orphans} 条  (旧版 line_N 编号或切片已重新生成)")
     print(f"--------------------------------------")
     
     if has_formula/total < 0.2:
@@ -0,0 +1,91 @@
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from washing import clean_paper_content, clean_paper_content_regex
+#对比逐行清洗和原来的多正则清洗：输出必须完全一致，并测一下每篇的耗时
+
+# 真实语料：MinerU 结果目录 (batch_x/xxx_result/*.md)，留空则只跑随机构造的样例
+CORPUS_DIR = ""
+RANDOM_DOCS = 3000
+SEED = 0
+
+# 随机样例的拼接素材：专门挑括号、LaTeX、图片、链接、参考文献标题这些容易出问题的
+PIECES = [
+    "传感器", "gas sensing", " ", "  ", "\n", "\n\n", "\n\n\n\n", "#", "## ", "\n## References\n",
+    "\n#  \n references", "\n# 参考文献", "\n### Bibliography", "\n#References", "[", "]", "(", ")",
+    "](", "![", "![](images/a.jpg)", "[12]", "[link](http://a.b)", "![fig](x.png", "[a](b",
+    "$\\frac{[A]}{[B]}$", "$$\\theta = \\frac{KP}{1+KP}$$", "<td>[1]</td>", "\\left[ x \\right]",
+]
+
+def random_doc(rng):
+    return "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 400)))
+
+def simulated_paper(rng):
+    """按 MinerU 输出的样子造一篇论文：长段落带引用和公式、图片单独一行、最后是参考文献"""
+    words = ["the", "sensor", "response", "SnO2", "异质结的", "电阻", "gas", "$\\frac{R_a}{R_g}$"]
+    lines = ["# Title"]
+    for _ in range(rng.randint(80, 200)):
+        r = rng.random()
+        if r < 0.1:
+            lines.append(f"![](images/{rng.getrandbits(64):x}.jpg)")
+        elif r < 0.15:
+            lines.append("## Section")
+        else:
+            lines.append(" ".join(f"[{rng.randint(1, 80)}]" if rng.random() < 0.03 else rng.choice(words)
+                                  for _ in range(rng.randint(40, 150))))
+        lines.append("")
+    lines.append("# References")
+    lines += [f"[{i}] A. B. et al." for i in range(60)]
+    return "\n".join(lines)
+
+def load_corpus():
+    docs = []
+    if CORPUS_DIR:
+        for root, dirs, files in os.walk(CORPUS_DIR):
+            for f in files:
+                if f.endswith('.md'):
+                    with open(os.path.join(root, f), 'r', encoding='utf-8') as fh:
+                        docs.append(fh.read())
+    return docs
+
+def bench(func, docs, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for doc in docs:
+            func(doc)
+        best = min(best, time.perf_counter() - started)
+    return best / max(len(docs), 1) * 1e6
+
+def main():
+    rng = random.Random(SEED)
+    samples = [random_doc(rng) for _ in range(RANDOM_DOCS)]
+    papers = [simulated_paper(rng) for _ in range(200)]
+    real = load_corpus()
+
+    # 1. 差分测试
+    mismatched = 0
+    for doc in samples + papers + real:
+        if clean_paper_content(doc) != clean_paper_content_regex(doc):
+            mismatched += 1
+            if mismatched <= 3:
+                print(f"❌ 输出不一致，原文前 200 字: {doc[:200]!r}")
+    print(f"差分测试: {len(samples)} 篇随机样例 + {len(papers)} 篇模拟论文 + {len(real)} 篇真实文档，不一致 {mismatched} 篇")
+
+    # 2. 微基准：真实文档、模拟论文 + 一篇整行都是 [ 的病态文档 (表格、引用多的论文会出现)
+    worst = "正文 " + "[12] " * 5000 + "\n" + "![" * 2000
+    cases = [("真实文档", real), ("模拟论文", papers), ("病态长行", [worst])]
+    for name, docs in cases:
+        if not docs:
+            continue
+        t_new = bench(clean_paper_content, docs)
+        t_old = bench(clean_paper_content_regex, docs, repeat=1)
+        print(f"{name}: 正则版 {t_old:.1f} µs/篇 | 逐行版 {t_new:.1f} µs/篇 | 加速 {t_old / t_new:.1f}x")
+
+    if mismatched:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,68 +1,315 @@
 import os
+import sys
 import json
+import re
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "run"))
+from gen_utils import ChunkStore, TokenCounter, chunk_content_id
 
 # ================= 路径配置 =================
 # 切块方便使用
 INPUT_FILE = ""
 OUTPUT_FILE = ""
+# 切片偏移索引 (SQLite)，按切片 ID 直接读取；留空则为 OUTPUT_FILE + ".index.db"
+CHUNK_INDEX_FILE = ""
 
-def chunk_text(text, chunk_size=1200, overlap=200):
+# ================= 切块参数 =================
+# 目标模型的 tokenizer.json (例如从 HuggingFace 下载 deepseek-ai/DeepSeek-V3 的 tokenizer.json 放到本地)
+# 运行时不联网。留空或没装 tokenizers 时按字符估算 token 数
+TOKENIZER_FILE = ""
+# 字符 -> token 换算比例的缓存：有 tokenizer 时每次切块后重新拟合，没有时读取上次的结果来估算
+TOKEN_CALIBRATION_FILE = ""
+# 目标长度 (token)：按标题、段落、句子为单位往里装，装不下就开新块
+CHUNK_TOKENS = 800
+# 相邻切片重叠的句子数 (只在同一小节内重叠)，0 表示不重叠
+OVERLAP_SENTENCES = 1
+# 重叠部分最多占目标 token 数的比例，防止一句超长句子被整句重复
+MAX_OVERLAP_RATIO = 0.25
+# 遇到新标题时，当前块已经有这么多 token 就直接结束，让新小节从新块开始
+MIN_CHUNK_TOKENS = 250
+# 公式、表格等整块内容超过这个长度 (字符) 才会被拆开，兜底防止出现 RHS 读不了的超长切片
+MAX_BLOCK_SIZE = 3000
+# 行内公式的最大长度，超过就认为是落单的 $
+MAX_INLINE_MATH = 300
+
+HEADING_PATTERN = re.compile(r'(#{1,6})\s+(.*)')
+# 句子结束符 (连同后面的空白) 和行内公式的 $ 定界符；公式里的句号不算断句
+SENTENCE_TOKEN = re.compile(r'\\\$|\$\$|\$|[。！？；!?]+\s*|\.\s+')
+# 这些缩写后面的 "." 不断句
+ABBREVIATIONS = {"fig", "figs", "eq", "eqs", "ref", "refs", "al", "e.g", "i.e", "etc", "vs", "no", "ca", "approx", "resp"}
+
+def split_sentences(para):
+    """按句子切分段落，行内公式 $...$ / $$...$$ 里面不切；切出来的句子首尾相接就是原段落"""
+    sentences = []
+    start = 0
+    in_math = False
+    math_start = 0
+    for m in SENTENCE_TOKEN.finditer(para):
+        tok = m.group()
+        if tok == '\\$':
+            continue
+        if tok[0] == '$':
+            in_math = not in_math
+            math_start = m.start()
+            continue
+        if in_math:
+            # 落单的 $ (例如价格) 会让后面整段都不断句，行内公式不会这么长
+            if m.start() - math_start <= MAX_INLINE_MATH:
+                continue
+            in_math = False
+        if tok[0] == '.':
+            word = para[para.rfind(' ', start, m.start()) + 1:m.start()].lstrip('(')
+            # 缩写、人名首字母 (A.)、编号 (1.) 后面不断句
+            if word.lower() in ABBREVIATIONS or (len(word) == 1 and word.isupper()) or word.isdigit():
+                continue
+        sentences.append(para[start:m.end()])
+        start = m.end()
+    if start < len(para):
+        sentences.append(para[start:])
+    return sentences
+
+def _block_end(lines, i):
+    """如果第 i 行开始一个不能切开的块 (公式、表格、代码)，返回块结束后的下一行，否则返回 None"""
+    line = lines[i].strip()
+    if line.startswith('$$'):
+        if len(line) > 2 and line.endswith('$$'):
+            return i + 1
+        closer = lambda s: s.endswith('$$')
+    elif line.startswith('\\begin{'):
+        env = line[len('\\begin{'):].split('}', 1)[0]
+        end_tag = f'\\end{{{env}}}'
+        if end_tag in line:
+            return i + 1
+        closer = lambda s: end_tag in s
+    elif line.startswith('<table'):
+        if '</table>' in line:
+            return i + 1
+        closer = lambda s: '</table>' in s
+    elif line.startswith('```'):
+        closer = lambda s: s.startswith('```')
+    elif line.startswith('|'):
+        # Markdown 表格：连续的 | 开头的行
+        j = i + 1
+        while j < len(lines) and lines[j].strip().startswith('|'):
+            j += 1
+        return j
+    else:
+        return None
+    # 一直找到结束标记；没有结束标记就到文末为止 (之后会按 MAX_BLOCK_SIZE 拆开)
+    j = i + 1
+    while j < len(lines) and not closer(lines[j].strip()):
+        j += 1
+    return min(j + 1, len(lines))
+
+def _hard_split(line, limit, seps):
+    """把超长的一行拆成不超过 limit 的几段，尽量在 seps 之后断开"""
+    pieces = []
+    while len(line) > limit:
+        cut = max(line.rfind(sep, 0, limit) + len(sep) if line.rfind(sep, 0, limit) > 0 else 0 for sep in seps)
+        cut = cut or limit
+        pieces.append(line[:cut])
+        line = line[cut:]
+    pieces.append(line)
+    return pieces
+
+def _split_oversized(text, limit):
+    """超长的整块内容先按行拆，单行还超长 (例如一整行的 HTML 表格) 就按 </tr> 或字符拆"""
+    pieces = []
+    for line in text.split('\n'):
+        pieces.extend(_hard_split(line, limit, ('</tr>',)))
+    # 再把短行合并回不超过 limit 的块
+    merged, cur = [], ""
+    for piece in pieces:
+        if cur and len(cur) + 1 + len(piece) > limit:
+            merged.append(cur)
+            cur = piece
+        else:
+            cur = f"{cur}\n{piece}" if cur else piece
+    if cur:
+        merged.append(cur)
+    return merged
+
+def iter_units(text):
+    """把论文拆成最小单位 (kind, 文本, 小节路径, 是否新段落)
+
+    kind: heading 标题 / sentence 句子 / block 公式、表格等不可切分的块
     """
-    将长文本切分为带重叠的片段
-    chunk_size: 每个片段的字符数
-    overlap: 相邻片段重叠的字符数，保证语义连贯
+    lines = text.split('\n')
+    path = ()  # ((级别, 标题), ...)
+    para = []
+
+    def flush_para():
+        if para:
+            n = 0
+            for sent in split_sentences('\n'.join(para)):
+                # 没有句号的超长句子 (例如只用逗号) 在逗号或空格处拆开
+                for piece in _hard_split(sent, MAX_BLOCK_SIZE, ('，', ', ', ' ')):
+                    yield "sentence", piece, path, n == 0
+                    n += 1
+            para.clear()
+
+    i = 0
+    while i < len(lines):
+        stripped = lines[i].strip()
+        if not stripped:
+            yield from flush_para()
+            i += 1
+            continue
+        m = HEADING_PATTERN.match(stripped)
+        if m:
+            yield from flush_para()
+            level = len(m.group(1))
+            path = tuple(p for p in path if p[0] < level) + ((level, m.group(2).strip()),)
+            yield "heading", stripped, path, True
+            i += 1
+            continue
+        end = _block_end(lines, i)
+        if end is not None:
+            yield from flush_para()
+            block = '\n'.join(lines[i:end]).strip()
+            pieces = _split_oversized(block, MAX_BLOCK_SIZE) if len(block) > MAX_BLOCK_SIZE else [block]
+            for piece in pieces:
+                yield "block", piece, path, True
+            i = end
+            continue
+        para.append(lines[i])
+        i += 1
+    yield from flush_para()
+
+def chunk_text(text, counter, chunk_tokens=CHUNK_TOKENS, overlap_sentences=OVERLAP_SENTENCES):
+    """
+    按结构切分论文：标题、段落、句子为边界，公式和表格保持完整
+    counter: TokenCounter，一篇论文的所有单位一次批量计数
+    chunk_tokens: 每个片段的目标 token 数
+    overlap_sentences: 相邻片段重叠的句子数，保证语义连贯
+    返回 [(片段文本, 小节路径 [标题, ...]), ...]
     """
     chunks = []
-    start = 0
     if not text:
         return chunks
-        
-    while start < len(text):
-        end = start + chunk_size
-        chunks.append(text[start:end])
-        # 下一次开始的位置是 当前结束位置 减去 重叠部分
-        start += (chunk_size - overlap)
-        # 防止死循环
-        if chunk_size <= overlap:
-            break
+    units = list(iter_units(text))
+    sizes = counter.count_batch([u[1] for u in units])
+    max_overlap = int(chunk_tokens * MAX_OVERLAP_RATIO)
+    cur = []     # 当前块里的 ((kind, 文本, 小节路径, 是否新段落), token 数)
+    cur_len = 0
+    fresh = 0    # 当前块里除重叠句子和标题以外的新内容数
+
+    def emit(items):
+        parts = []
+        for n, ((kind, unit, _, new_para), _) in enumerate(items):
+            parts.append(("\n\n" if new_para else "") + unit if n else unit)
+        body = "".join(parts).strip()
+        if body:
+            # 小节路径取块里第一个单位所在的小节
+            chunks.append((body, [title for _, title in items[0][0][2]]))
+
+    for unit, tokens in zip(units, sizes):
+        kind, unit_text, path, new_para = unit
+        # 段落之间的 "\n\n" 约占 1 个 token
+        size = tokens + (1 if new_para else 0)
+        new_section = kind == "heading" and cur_len >= MIN_CHUNK_TOKENS
+        if fresh and (new_section or cur_len + size > chunk_tokens):
+            # 块末尾的标题挪到下一块开头，不让标题和正文分开
+            carry = []
+            while cur and cur[-1][0][0] == "heading":
+                carry.insert(0, cur.pop())
+            emit(cur)
+            if carry or kind == "heading" or not overlap_sentences:
+                cur = carry
+            else:
+                # 下一块从上一块最后几句开始 (只在同一小节内)
+                tail, tail_len = [], 0
+                for prev in reversed(cur):
+                    if prev[0][0] != "sentence" or prev[0][2] != path or len(tail) >= overlap_sentences:
+                        break
+                    tail_len += prev[1]
+                    if tail_len > max_overlap:
+                        break
+                    tail.insert(0, prev)
+                cur = tail
+            cur_len = sum(t + 1 for _, t in cur)
+            fresh = 0
+        cur.append((unit, tokens))
+        cur_len += size
+        if kind != "heading":
+            fresh += 1
+    if fresh:
+        emit(cur)
     return chunks
 
+def chunk_row(c_id, source, chunk_id, chunk, section_path, tokens):
+    """一个切片的 JSONL 行 (bytes)"""
+    chunk_item = {
+        "id": c_id,
+        "source": source,
+        "chunk_id": chunk_id,
+        "text": chunk,
+        "section_path": section_path,
+        "tokens": tokens
+    }
+    return (json.dumps(chunk_item, ensure_ascii=False) + '\n').encode('utf-8')
+
 def run_chunking():
     if not os.path.exists(INPUT_FILE):
         print(f"❌ 错误：找不到输入文件 {INPUT_FILE}")
         return
 
     print(f"🚀 开始处理文件: {INPUT_FILE}")
+    counter = TokenCounter(TOKENIZER_FILE, TOKEN_CALIBRATION_FILE)
+    print(f"切片目标: {CHUNK_TOKENS} tokens ({'tokenizer 精确计数' if counter.exact else '按字符估算'})")
     chunk_count = 0
     paper_count = 0
+    token_total = 0
+    duplicate_count = 0
+    seen_ids = set()
+    offset = 0
+    # 留一部分样本，最后用来拟合字符 -> token 的换算比例
+    calibration_samples = []
 
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f_out:
+    # 二进制写入，记录每行的字节偏移给索引用
+    with open(OUTPUT_FILE, "wb") as f_out, ChunkStore(OUTPUT_FILE, CHUNK_INDEX_FILE) as store:
+        store.reset()
         with open(INPUT_FILE, "r", encoding="utf-8") as f_in:
             for line in f_in:
                 try:
                     data = json.loads(line)
                     content = data.get('content', '')
                     source = data.get('source', 'unknown')
-                    
+
                     # 执行切片
-                    chunks = chunk_text(content)
-                    
-                    for i, chunk in enumerate(chunks):
-                        chunk_item = {
-                            "source": source,
-                            "chunk_id": i,
-                            "text": chunk.strip()
-                        }
-                        f_out.write(json.dumps(chunk_item, ensure_ascii=False) + '\n')
+                    chunks = chunk_text(content, counter)
+                    # 切好的片段再整体计数一次，写进结果供 RHS 按 token 过滤
+                    chunk_tokens = counter.count_batch([chunk for chunk, _ in chunks])
+
+                    rows = []
+                    for i, ((chunk, section_path), tokens) in enumerate(zip(chunks, chunk_tokens)):
+                        # 内容哈希作为全局 ID；完全相同的切片只保留第一条
+                        c_id = chunk_content_id(chunk)
+                        if c_id in seen_ids:
+                            duplicate_count += 1
+                            continue
+                        seen_ids.add(c_id)
+                        row = chunk_row(c_id, source, i, chunk, section_path, tokens)
+                        f_out.write(row)
+                        rows.append((c_id, offset, len(row)))
+                        offset += len(row)
                         chunk_count += 1
-                    
+                        token_total += tokens
+                    store.add_many(rows)
+                    if chunks and len(calibration_samples) < 2000:
+                        calibration_samples.append(chunks[0][0])
+
                     paper_count += 1
                 except Exception as e:
                     print(f"⚠️ 处理某行时出错: {e}")
 
     print(f"✅ 处理完成！")
-    print(f"统计：共处理 {paper_count} 篇论文，生成 {chunk_count} 个切片片段。")
+    if duplicate_count:
+        print(f"跳过内容完全相同的切片: {duplicate_count} 个")
+    print(f"统计：共处理 {paper_count} 篇论文，生成 {chunk_count} 个切片片段，平均 {token_total / max(chunk_count, 1):.0f} tokens。")
+    if counter.calibrate(calibration_samples):
+        print(f"字符 -> token 换算比例: {counter.ratios}")
     print(f"结果保存至: {OUTPUT_FILE}")
+    print(f"切片索引: {store.index_path}")
 
 if __name__ == "__main__":
-    run_chunking()
\ No newline at end of file
+    run_chunking()
@@ -7,7 +7,9 @@ WORK_DIR = r""
 # 一定要确认文件名与你主脚本里的一致
 FILES_TO_CLEAN = [
     "sensor_physics_sft.jsonl",  # 生成的结果文件
-    "generation.log"             # 记录进度的日志文件
+    "generation.log",            # 记录进度的日志文件
+    "chunk_manifest.jsonl",      # 断点续跑清单，不删的话会跳过全部切片
+    "request_events.jsonl"       # 请求级遥测
 ]
 
 def clean_files():
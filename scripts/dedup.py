@@ -0,0 +1,195 @@
+import os
+import json
+import re
+import bisect
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+#近似去重：放在 washing 和 chunk 之间 (整篇论文)，也可以放在 chunk 之后 (切片)
+#同一篇论文被 FENZU 重复分到多个 batch、预印本和正式版内容高度重合，不去重的话 RHS 会为同一段文字付两次钱
+# ================= 配置区 =================
+# 论文 (washing 输出，文本在 content 字段) 或切片 (chunk 输出，文本在 text 字段) 都可以
+INPUT_FILE = ""
+OUTPUT_FILE = ""   # 去重后的 JSONL，格式与输入相同
+REPORT_FILE = ""   # 去重报告：每行一条被删掉的记录及它重复的是哪一条
+
+# Jaccard 相似度达到这个值就认为是重复 (按字符 5-gram 计算)
+THRESHOLD = 0.8
+# 签名长度 (2 的幂)，越长越准、越占内存；切片数量上百万时可以改成 64
+NUM_PERM = 128
+SHINGLE_SIZE = 5
+# 计算签名的进程数，None 表示用满所有 CPU 核；设为 1 则单进程执行
+WORKERS = None
+CHUNKSIZE = 32
+# 同时排队的任务数 = 进程数 × 这个倍数 (每个任务 CHUNKSIZE 行)，输入边读边提交，内存占用与文件大小无关
+IN_FLIGHT_PER_WORKER = 4
+# ==========================================
+
+_SPACES = re.compile(r'\s+')
+# 64 位乘法散列，把 crc32 打散到整个 64 位空间
+_MIX = 0x9E3779B97F4A7C15
+_MASK64 = (1 << 64) - 1
+
+def record_key(data):
+    """用来在报告里指认一条记录：论文用 source，切片用 source#chunk_id"""
+    if "id" in data:
+        return str(data["id"])
+    source = data.get("source", "unknown")
+    if "chunk_id" in data:
+        return f"{source}#{data['chunk_id']}"
+    return source
+
+def minhash_signature(text, num_perm=NUM_PERM, k=SHINGLE_SIZE):
+    """单次散列 MinHash (one permutation hashing)：每个 shingle 只算一次散列，按高位分桶取桶内最小值。
+
+    和 num_perm 次独立散列的 MinHash 一样，两个签名同一位相等的概率约等于 Jaccard，
+    但计算量只和文本长度成正比。空桶从右边最近的非空桶借值 (densification)
+    """
+    text = _SPACES.sub(' ', text).strip().lower()
+    if len(text) < k:
+        return None
+    bits = num_perm.bit_length() - 1  # num_perm 需为 2 的幂
+    shift = 64 - bits
+    low = (1 << shift) - 1
+    sig = [_MASK64] * num_perm
+    for shingle in {text[i:i + k] for i in range(len(text) - k + 1)}:
+        h = (zlib.crc32(shingle.encode('utf-8')) * _MIX) & _MASK64
+        b = h >> shift
+        v = h & low
+        if v < sig[b]:
+            sig[b] = v
+    # densification：空桶借用右边最近非空桶的值，加上距离区分来源
+    if _MASK64 in sig:
+        filled = [b for b in range(num_perm) if sig[b] != _MASK64]
+        for b in range(num_perm):
+            if sig[b] == _MASK64:
+                i = bisect.bisect_left(filled, b)
+                src = filled[i] if i < len(filled) else filled[0]
+                sig[b] = sig[src] + (((src - b) % num_perm) << shift)
+    return array('Q', sig)
+
+def estimate_jaccard(sig_a, sig_b):
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+def lsh_params(threshold, num_perm):
+    """选择 bands × rows = num_perm，使 S 曲线的拐点 (1/b)^(1/r) 最接近阈值"""
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        err = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or err < best[0]:
+            best = (err, bands, rows)
+    return best[1], best[2]
+
+class LSHIndex:
+    """LSH 分带索引：只和同一个带里签名完全相同的记录比较，整体近似线性"""
+
+    def __init__(self, threshold=THRESHOLD, num_perm=NUM_PERM):
+        self.threshold = threshold
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self.tables = [{} for _ in range(self.bands)]
+        self.signatures = {}
+
+    def _band_keys(self, sig):
+        r = self.rows
+        return [sig[i * r:(i + 1) * r].tobytes() for i in range(self.bands)]
+
+    def query(self, sig):
+        """返回 (最相似的已有记录, Jaccard 估计)，低于阈值返回 (None, 0)"""
+        best, best_sim = None, 0.0
+        seen = set()
+        for table, band_key in zip(self.tables, self._band_keys(sig)):
+            for key in table.get(band_key, ()):
+                if key in seen:
+                    continue
+                seen.add(key)
+                sim = estimate_jaccard(sig, self.signatures[key])
+                if sim >= self.threshold and sim > best_sim:
+                    best, best_sim = key, sim
+        return best, best_sim
+
+    def add(self, key, sig):
+        self.signatures[key] = sig
+        for table, band_key in zip(self.tables, self._band_keys(sig)):
+            table.setdefault(band_key, []).append(key)
+
+def signature_of_line(line):
+    """子进程里解析一行并计算签名，返回 (原始行, 记录 key, 签名)"""
+    try:
+        data = json.loads(line)
+    except json.JSONDecodeError:
+        return line, None, None
+    text = data.get('content', data.get('text', ''))
+    return line, record_key(data), minhash_signature(text)
+
+def _apply_chunk(fn, items):
+    return [fn(item) for item in items]
+
+def ordered_imap(pool, fn, iterable, chunksize=1, window=8):
+    """按输入顺序返回 fn 的结果，和 pool.map 一样，但最多只有 window 个任务在排队
+
+    ProcessPoolExecutor.map 会先把整个输入读完、全部提交成 future 再返回第一个结果，
+    大文件会被整个读进内存；这里取走一个结果才补交一个任务
+    """
+    items = iter(iterable)
+    pending = deque()
+    while True:
+        while len(pending) < window:
+            batch = list(islice(items, chunksize))
+            if not batch:
+                break
+            pending.append(pool.submit(_apply_chunk, fn, batch))
+        if not pending:
+            return
+        yield from pending.popleft().result()
+
+def run_dedup():
+    if not os.path.exists(INPUT_FILE):
+        print(f"❌ 错误：找不到输入文件 {INPUT_FILE}")
+        return
+
+    index = LSHIndex(THRESHOLD, NUM_PERM)
+    print(f"🚀 开始去重: {INPUT_FILE} (阈值 {THRESHOLD}, {index.bands} 带 × {index.rows} 行)")
+    total = kept = dropped = 0
+
+    with open(INPUT_FILE, 'r', encoding='utf-8') as f_in, \
+         open(OUTPUT_FILE, 'w', encoding='utf-8') as f_out, \
+         open(REPORT_FILE, 'w', encoding='utf-8') as f_report:
+        if WORKERS == 1:
+            results = map(signature_of_line, f_in)
+            pool = None
+        else:
+            pool = ProcessPoolExecutor(max_workers=WORKERS)
+            # 按输入顺序返回，先出现的记录保留，后出现的判为重复
+            results = ordered_imap(pool, signature_of_line, f_in, CHUNKSIZE,
+                                   (WORKERS or os.cpu_count() or 1) * IN_FLIGHT_PER_WORKER)
+        try:
+            for line, key, sig in results:
+                if key is None:
+                    continue
+                total += 1
+                if sig is not None:
+                    dup_of, sim = index.query(sig)
+                    if dup_of is not None:
+                        dropped += 1
+                        f_report.write(json.dumps({"id": key, "duplicate_of": dup_of, "jaccard": round(sim, 3)}, ensure_ascii=False) + '\n')
+                        continue
+                    # 同一个 key 出现多次 (例如重复跑了 washing) 时后一条照样比对，但只用第一条建索引
+                    if key not in index.signatures:
+                        index.add(key, sig)
+                f_out.write(line if line.endswith('\n') else line + '\n')
+                kept += 1
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+
+    print(f"✅ 去重完成！共 {total} 条，保留 {kept} 条，删除重复 {dropped} 条 ({dropped / max(total, 1):.1%})")
+    print(f"结果保存至: {OUTPUT_FILE}")
+    print(f"去重报告: {REPORT_FILE}")
+
+if __name__ == "__main__":
+    run_dedup()
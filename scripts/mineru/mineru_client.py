@@ -1,73 +1,192 @@
 import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
 #用mineru处理文件
 # --- 基础配置 ---
 token = "" #mineru的api
 apply_url = "https://mineru.net/api/v4/file-urls/batch"
 input_dir = ""  # PDF 所在文件夹
 batch_log_file = ""    # 用于存放生成的 batch_id，方便后续查询
-
-# --- 准备工作：扫描本地 PDF 文件 ---
-file_paths = []
-for root, dirs, files in os.walk(input_dir):
-    for f in files:
-        if f.lower().endswith('.pdf'):
-            file_paths.append(os.path.join(root, f))
+# 每个文件的上传状态 (追加写)，中断后重跑只补传失败/没传的文件，不会重新申请 batch_id
+upload_state_file = ""
 
 # 官方限制单次申请不能超过 200 个
 BATCH_LIMIT = 200
+# 并行上传线程数 (也是连接池大小)
+UPLOAD_WORKERS = 16
+# 网络抖动 / 5xx / 429 的重试次数，间隔按 2^n 秒递增
+UPLOAD_RETRIES = 4
 
 header = {
     "Content-Type": "application/json",
     "Authorization": f"Bearer {token}"
 }
 
-for i in range(0, len(file_paths), BATCH_LIMIT):
-    current_batch_files = file_paths[i : i + BATCH_LIMIT]
-    
+# 文件状态：pending 已拿到上传链接 / uploaded 上传成功 / failed 重试后仍失败 / expired 链接失效需重新申请
+_state_lock = threading.Lock()
+
+def load_upload_state():
+    """读取上传状态，返回 {文件路径: 最后一条记录}"""
+    state = {}
+    if not upload_state_file or not os.path.exists(upload_state_file):
+        return state
+    with open(upload_state_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+                state[rec["path"]] = rec
+            except Exception:
+                pass  # 崩溃时写了半行
+    return state
+
+def save_file_state(state, path, batch_id, url, status):
+    rec = {"path": path, "batch_id": batch_id, "url": url, "state": status}
+    with _state_lock:
+        state[path] = rec
+        if upload_state_file:
+            with open(upload_state_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+def make_session():
+    # 复用 TCP/TLS 连接，避免每个文件都重新握手
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=UPLOAD_WORKERS, pool_maxsize=UPLOAD_WORKERS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def upload_one(session, state, path, batch_id, url):
+    """上传单个文件，返回最终状态"""
+    err = ""
+    for attempt in range(UPLOAD_RETRIES + 1):
+        try:
+            with open(path, 'rb') as f:
+                # 直接传文件对象，requests 会流式发送，不会整个读进内存
+                # 上传文件时，无须设置 Content-Type 请求头
+                res_upload = session.put(url, data=f, timeout=(10, 300))
+            code = res_upload.status_code
+            if code == 200:
+                save_file_state(state, path, batch_id, url, "uploaded")
+                return "uploaded"
+            if code in (401, 403):
+                # 预签名链接过期，重试也没用，需要重新申请
+                save_file_state(state, path, batch_id, url, "expired")
+                return "expired"
+            err = f"status: {code}"
+            if code != 429 and code < 500:
+                break  # 其他 4xx 重试也没用
+        except requests.RequestException as e:
+            # 连接断开、超时、ChunkedEncodingError 等都当作网络抖动重试
+            err = str(e)
+        if attempt < UPLOAD_RETRIES:
+            time.sleep(2 ** attempt)
+    print(f"File {path}: upload failed, {err}")
+    save_file_state(state, path, batch_id, url, "failed")
+    return "failed"
+
+def apply_batch(session, files):
+    """申请一批上传链接，成功返回 (batch_id, urls)"""
     # 构造符合官方格式的 data 数据体
     data = {
         "files": [
-            {"name": os.path.basename(fp), "data_id": fp} 
-            for fp in current_batch_files
+            {"name": os.path.basename(fp), "data_id": fp}
+            for fp in files
         ],
         "model_version": "vlm"
     }
+    # 1.申请上传链接 (POST)
+    response = session.post(apply_url, headers=header, json=data, timeout=60)
+    if response.status_code != 200:
+        print('response not success. status:{} ,result:{}'.format(response.status_code, response.text))
+        return None, None
+    result = response.json()
+    if result["code"] != 0:
+        # 官方代码中 result 是 dict，需使用 get 或 ["msg"]
+        print('apply upload url failed, reason:{}'.format(result.get("msg", "unknown")))
+        return None, None
+    return result["data"]["batch_id"], result["data"]["file_urls"]
+
+def apply_and_upload(pool, session, state, files):
+    """按 BATCH_LIMIT 分组申请新的上传链接 (新 batch_id) 并提交上传任务，返回 {future: 文件路径}"""
+    futures = {}
+    for i in range(0, len(files), BATCH_LIMIT):
+        current_batch_files = files[i : i + BATCH_LIMIT]
+        try:
+            batch_id, urls = apply_batch(session, current_batch_files)
+        except Exception as err:
+            print(f"An error occurred: {err}")
+            continue
+        if not batch_id:
+            continue
+
+        # --- 关键步骤：保存 batch_id ---
+        with open(batch_log_file, 'a') as log:
+            log.write(f"{batch_id}\n")
+        print(f'batch_id:{batch_id}, urls数量:{len(urls)}')
+
+        # 先记下每个文件的上传链接，再并行上传 (PUT)
+        for fp, url in zip(current_batch_files, urls):
+            save_file_state(state, fp, batch_id, url, "pending")
+            futures[pool.submit(upload_one, session, state, fp, batch_id, url)] = fp
+    return futures
+
+def wait_uploads(futures, counts):
+    """等上传完成并累计结果，返回链接过期的文件"""
+    expired = []
+    for n, fut in enumerate(as_completed(futures), 1):
+        try:
+            status = fut.result()
+            counts[status] += 1
+            if status == "expired":
+                expired.append(futures[fut])
+        except Exception as err:
+            print(f"An error occurred: {err}")
+        if n % 100 == 0 or n == len(futures):
+            print(f"上传进度: {n}/{len(futures)} | 成功 {counts['uploaded']} | 失败 {counts['failed']} | 链接过期 {counts['expired']}")
+    return expired
+
+def run_upload():
+    # --- 准备工作：扫描本地 PDF 文件 ---
+    file_paths = []
+    for root, dirs, files in os.walk(input_dir):
+        for f in files:
+            if f.lower().endswith('.pdf'):
+                file_paths.append(os.path.join(root, f))
+
+    state = load_upload_state()
+    session = make_session()
+    counts = {"uploaded": 0, "failed": 0, "expired": 0}
+    futures = {}
+
+    # 要在续传开始前算好：续传中途发现过期的文件由第 3 步补申请，不能在这里再申请一次
+    todo = [fp for fp in file_paths if fp not in state or state[fp]["state"] == "expired"]
+    resume = [rec for rec in state.values() if rec["state"] in ("pending", "failed")]
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        # 1. 续传：已有上传链接但没传成功的文件，沿用原来的 batch_id
+        if resume:
+            print(f"续传上次未完成的文件: {len(resume)} 个")
+        for rec in resume:
+            futures[pool.submit(upload_one, session, state, rec["path"], rec["batch_id"], rec["url"])] = rec["path"]
+
+        # 2. 从没申请过、或链接已过期的文件，申请新的 batch_id
+        print(f"共 {len(file_paths)} 个 PDF，需要新申请上传的: {len(todo)} 个")
+        futures.update(apply_and_upload(pool, session, state, todo))
+        expired = wait_uploads(futures, counts)
+
+        # 3. 续传时才发现链接已经过期的文件，本次直接重新申请 (只补申请一轮，避免平台异常时死循环)
+        if expired:
+            print(f"有 {len(expired)} 个文件的上传链接已过期，重新申请")
+            counts["expired"] -= len(expired)
+            wait_uploads(apply_and_upload(pool, session, state, expired), counts)
+
+    print(f"\n任务全部处理完成。所有的 batch_id 已记录在 {batch_log_file} 中。")
+    if counts["failed"] or counts["expired"]:
+        print(f"有 {counts['failed'] + counts['expired']} 个文件未上传成功，直接重新运行本脚本即可只补传这些文件。")
 
-    try:
-        # 1.申请上传链接 (POST)
-        response = requests.post(apply_url, headers=header, json=data)
-        
-        if response.status_code == 200:
-            result = response.json()
-            print('response success. result:{}'.format(result))
-            
-            if result["code"] == 0:
-                batch_id = result["data"]["batch_id"]
-                urls = result["data"]["file_urls"]
-                
-                # --- 关键步骤：保存 batch_id ---
-                with open(batch_log_file, 'a') as log:
-                    log.write(f"{batch_id}\n")
-                
-                print(f'batch_id:{batch_id}, urls数量:{len(urls)}')
-                
-                # 2. 循环执行上传 (PUT)
-                for j in range(0, len(urls)):
-                    with open(current_batch_files[j], 'rb') as f:
-                        # 上传文件时，无须设置 Content-Type 请求头
-                        res_upload = requests.put(urls[j], data=f)
-                        if res_upload.status_code == 200:
-                            print(f"File {j+1}/{len(urls)}: {current_batch_files[j]} upload success")
-                        else:
-                            print(f"File {j+1}: upload failed, status: {res_upload.status_code}")
-            else:
-                # 官方代码中 result 是 dict，需使用 get 或 ["msg"]
-                print('apply upload url failed, reason:{}'.format(result.get("msg", "unknown")))
-        else:
-            print('response not success. status:{} ,result:{}'.format(response.status_code, response.text))
-            
-    except Exception as err:
-        print(f"An error occurred: {err}")
-
-print(f"\n任务全部处理完成。所有的 batch_id 已记录在 {batch_log_file} 中。")
\ No newline at end of file
+if __name__ == "__main__":
+    run_upload()
@@ -1,6 +1,12 @@
 import requests
+import json
 import os
+import shutil
+import time
+import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 #从mineru获得处理结果
 # ================= 配置区 =================
 token = ""
@@ -8,12 +14,99 @@ batch_id_file = ""
 
 # 这里填入你想保存的新位置（例如在你的 myprojects 下建立一个 results 文件夹）
 NEW_BASE_DIR = ""
+
+# 并行下载线程数 (也是连接池大小)
+DOWNLOAD_WORKERS = 8
+# 只解压 washing.py 需要的 .md 文件 (图片、layout.json 等都不要)，省磁盘也省时间
+ONLY_MARKDOWN = False
+# 压缩包小于这个大小时全程在内存里解压，超过才落到系统临时目录
+SPOOL_MAX_MEMORY = 64 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+# 轮询模式：一直等到所有批次都处理完，边处理边下载 (False 则只扫一遍已完成的)
+WAIT_FOR_COMPLETION = True
+# 轮询间隔：有新进展时回到最小值，没有进展时翻倍，直到最大值
+POLL_MIN_INTERVAL = 10
+POLL_MAX_INTERVAL = 300
+# 最长等待时间 (秒)，防止有文件一直卡在 waiting-file / pending
+MAX_WAIT_SECONDS = 12 * 3600
+# 每个文件的状态记录，重跑时不会重复下载
+download_state_file = ""
+# 解析失败的文件 (每行一个原始路径 data_id)，方便挑出来重新提交
+failed_list_file = ""
 # ==========================================
 
 header = {
     "Authorization": f"Bearer {token.strip()}"
 }
 
+def make_session():
+    # 复用 TCP/TLS 连接，避免每个压缩包都重新握手
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def result_paths(data_id):
+    """data_id (例如 .../batch_12/abc.pdf) -> (batch 文件夹名, 文件名, 解压目录)"""
+    # --- 路径重定向逻辑 ---
+    # 获取 batch_x 这一层文件夹的名字
+    path_parts = data_id.replace("\\", "/").split('/')
+    batch_folder_name = path_parts[-2] if len(path_parts) > 1 else "default_batch"
+    file_base_name = os.path.basename(path_parts[-1]).replace(".pdf", "")
+    extract_to = os.path.join(NEW_BASE_DIR, batch_folder_name, f"{file_base_name}_result")
+    return batch_folder_name, file_base_name, extract_to
+
+def download_one(session, zip_url, extract_to):
+    """流式下载一个压缩包并解压到 extract_to"""
+    # 先解压到 .part 目录，全部写完再改名：_result 目录存在就说明是完整的
+    part_dir = extract_to + ".part"
+    shutil.rmtree(part_dir, ignore_errors=True)
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY) as buf:
+        with session.get(zip_url, stream=True, timeout=(10, 300)) as zip_res:
+            zip_res.raise_for_status()
+            for block in zip_res.iter_content(chunk_size=CHUNK_SIZE):
+                buf.write(block)
+        buf.seek(0)
+        with zipfile.ZipFile(buf) as z:
+            if ONLY_MARKDOWN:
+                members = [m for m in z.namelist() if m.lower().endswith(".md")]
+                z.extractall(part_dir, members=members)
+            else:
+                z.extractall(part_dir)
+    os.makedirs(part_dir, exist_ok=True)
+    os.replace(part_dir, extract_to)
+
+def fetch_batch_results(session, b_id):
+    url = f"https://mineru.net/api/v4/extract-results/batch/{b_id}"
+    res = session.get(url, headers=header, timeout=60)
+    if res.status_code != 200:
+        return None
+    return res.json().get("data", {}).get("extract_result", [])
+
+# MinerU 单个文件的终态
+FINAL_STATES = ("done", "failed")
+
+def load_state():
+    if download_state_file and os.path.exists(download_state_file):
+        with open(download_state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        # 旧版状态文件按 data_id 记录，转成按批次记录
+        for data_id, rec in state.pop("items", {}).items():
+            state.setdefault("batches", {}).setdefault(rec["batch_id"], {})[data_id] = rec
+        return state
+    return {"batches": {}}
+
+def save_state(state):
+    if not download_state_file:
+        return
+    # 先写临时文件再替换，中途崩溃不会留下半个状态文件
+    tmp = download_state_file + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, download_state_file)
+
 def download_to_new_location():
     # 创建主结果目录
     if not os.path.exists(NEW_BASE_DIR):
@@ -23,48 +116,129 @@ def download_to_new_location():
     with open(batch_id_file, 'r') as f:
         batch_ids = [line.strip() for line in f if line.strip()]
 
-    for b_id in batch_ids:
-        print(f"\n🚀 正在拉取批次数据: {b_id}")
-        url = f"https://mineru.net/api/v4/extract-results/batch/{b_id}"
-        
-        try:
-            res = requests.get(url, headers=header)
-            if res.status_code == 200:
-                results = res.json().get("data", {}).get("extract_result", [])
-                
+    session = make_session()
+    state = load_state()
+    # 按 (批次, data_id) 记录：链接过期的文件会用新的 batch_id 重新申请，data_id 不变，
+    # 按 data_id 记的话两个批次会互相覆盖，旧批次永远等不到全部完成
+    batches = state.setdefault("batches", {})  # batch_id -> {data_id -> {batch_id, state, err_msg, downloaded}}
+    order = {b_id: i for i, b_id in enumerate(batch_ids)}
+
+    def latest():
+        """每个 data_id 以 batch_id 文件里最后出现的批次为准，之前批次里的同一个文件算被替代"""
+        newest = {}
+        for b_id, recs in batches.items():
+            for data_id in recs:
+                if data_id not in newest or order.get(b_id, -1) > order.get(newest[data_id], -1):
+                    newest[data_id] = b_id
+        return {data_id: batches[b_id][data_id] for data_id, b_id in newest.items()}
+    counts = {"ok": 0, "skip": 0, "error": 0}
+    # 所有文件都到终态的批次不用再查
+    open_batches = [b for b in batch_ids if b not in state.get("finished_batches", [])]
+    in_flight = {}  # future -> (batch_id, data_id)
+    downloading = set()  # 正在下载的 data_id，查重用集合，不用每条结果都扫一遍 in_flight
+    batch_final = {}  # 所有文件都到终态的批次 -> 文件列表
+    interval = POLL_MIN_INTERVAL
+    started = time.monotonic()
+
+    def collect(block):
+        """收回下载结果，block=True 时等全部下载完"""
+        for fut in list(in_flight):
+            if not block and not fut.done():
+                continue
+            b_id, data_id = in_flight.pop(fut)
+            downloading.discard(data_id)
+            batch_folder_name, file_base_name, _ = result_paths(data_id)
+            try:
+                fut.result()
+                batches[b_id][data_id]["downloaded"] = True
+                counts["ok"] += 1
+                print(f"  📥 已保存至 {batch_folder_name}: {file_base_name}")
+            except Exception as e:
+                # 不标记 downloaded，下一轮轮询会重新下载
+                counts["error"] += 1
+                print(f"  💥 {file_base_name} 下载出错: {e}")
+        save_state(state)
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        while True:
+            progress = False
+            for b_id in list(open_batches):
+                try:
+                    results = fetch_batch_results(session, b_id)
+                except Exception as e:
+                    print(f"  💥 批次 {b_id} 查询出错: {e}")
+                    continue
+                if results is None:
+                    print(f"  ❌ 批次 {b_id} 请求失败")
+                    continue
+
+                recs = batches.setdefault(b_id, {})
                 for item in results:
-                    if item.get("state") == "done":
-                        zip_url = item.get("full_zip_url")
-                        data_id = item.get("data_id") # 例如: .../batch_12/abc.pdf
-                        
-                        # --- 路径重定向逻辑 ---
-                        # 获取 batch_x 这一层文件夹的名字
-                        path_parts = data_id.split('/')
-                        batch_folder_name = path_parts[-2] if len(path_parts) > 1 else "default_batch"
-                        file_base_name = os.path.basename(data_id).replace(".pdf", "")
-                        
-                        new_batch_path = os.path.join(NEW_BASE_DIR, batch_folder_name)
-                        extract_to = os.path.join(new_batch_path, f"{file_base_name}_result")
-                        
-                        os.makedirs(extract_to, exist_ok=True)
-                        
-                        # 下载并解压
-                        print(f"  📥 下载并保存至 {batch_folder_name}: {file_base_name}")
-                        zip_res = requests.get(zip_url)
-                        
-                        # 内存中直接解压或使用临时文件
-                        temp_zip = os.path.join(NEW_BASE_DIR, "temp_download.zip")
-                        with open(temp_zip, 'wb') as f_zip:
-                            f_zip.write(zip_res.content)
-                        
-                        with zipfile.ZipFile(temp_zip, 'r') as z:
-                            z.extractall(extract_to)
-                        
-                        os.remove(temp_zip)
-            else:
-                print(f"  ❌ 批次 {b_id} 请求失败")
-        except Exception as e:
-            print(f"  💥 处理出错: {e}")
+                    data_id = item.get("data_id")
+                    rec = recs.setdefault(data_id, {"batch_id": b_id, "state": None, "err_msg": "", "downloaded": False})
+                    if rec["state"] != item.get("state"):
+                        rec.update({"state": item.get("state"), "err_msg": item.get("err_msg", "")})
+                        progress = True
+                        if rec["state"] == "failed":
+                            print(f"  ⚠️ 解析失败: {data_id} ({rec['err_msg']})")
+
+                    if rec["state"] != "done" or rec["downloaded"] or data_id in downloading:
+                        continue
+                    _, _, extract_to = result_paths(data_id)
+                    if os.path.isdir(extract_to):
+                        rec["downloaded"] = True
+                        counts["skip"] += 1
+                        continue
+                    os.makedirs(os.path.dirname(extract_to), exist_ok=True)
+                    in_flight[pool.submit(download_one, session, item.get("full_zip_url"), extract_to)] = (b_id, data_id)
+                    downloading.add(data_id)
+
+            # 被后面批次重新申请的文件 (旧批次里一直是 waiting-file) 不用再等
+            current = latest()
+            for b_id in open_batches:
+                recs = batches.get(b_id)
+                if not recs:
+                    continue
+                data_ids = [d for d, rec in recs.items() if current[d] is rec]
+                if all(recs[d]["state"] in FINAL_STATES for d in data_ids):
+                    batch_final[b_id] = data_ids
+
+            collect(block=False)
+            # 全部到终态、且成功的都已下载好的批次才关闭；下载出错的留着下一轮重下
+            for b_id, data_ids in list(batch_final.items()):
+                recs = batches[b_id]
+                if all(recs[d]["state"] == "failed" or recs[d]["downloaded"] for d in data_ids):
+                    del batch_final[b_id]
+                    open_batches.remove(b_id)
+                    state.setdefault("finished_batches", []).append(b_id)
+                    save_state(state)
+                    print(f"✅ 批次 {b_id} 已全部处理完 ({len(data_ids)} 个文件)")
+            if not WAIT_FOR_COMPLETION or not open_batches:
+                break
+            if time.monotonic() - started > MAX_WAIT_SECONDS:
+                print(f"⏰ 超过最长等待时间，还有 {len(open_batches)} 个批次没处理完，下次重跑会接着等")
+                break
+
+            waiting = sum(1 for rec in latest().values() if rec["state"] not in FINAL_STATES)
+            interval = POLL_MIN_INTERVAL if progress or in_flight else min(interval * 2, POLL_MAX_INTERVAL)
+            print(f"⏳ 处理中 {waiting} 个 | 已下载 {counts['ok'] + counts['skip']} 个 | {interval}s 后再次查询")
+            time.sleep(interval)
+
+        collect(block=True)
+
+    # 汇总解析失败的文件 (重新申请后成功的不算)
+    current = latest()
+    failed = sorted(data_id for data_id, rec in current.items() if rec["state"] == "failed")
+    if failed:
+        print(f"\n⚠️ 有 {len(failed)} 个文件解析失败:")
+        for data_id in failed:
+            print(f"  - {data_id}: {current[data_id]['err_msg']}")
+        if failed_list_file:
+            with open(failed_list_file, 'w', encoding='utf-8') as f:
+                f.write("".join(f"{data_id}\n" for data_id in failed))
+            print(f"失败列表已写入 {failed_list_file}，可以挑出来重新提交")
+
+    print(f"\n完成：新下载 {counts['ok']} 个 | 已存在跳过 {counts['skip']} 个 | 出错 {counts['error']} 个")
 
 if __name__ == "__main__":
-    download_to_new_location()
\ No newline at end of file
+    download_to_new_location()
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "run"))
+from gen_utils import ChunkStore, TokenCounter, chunk_content_id
+import washing
+import dedup
+import chunk
+#一条命令完成 washing -> dedup -> chunk：MinerU 结果目录进，domain_chunks.jsonl 出
+#中间不落盘 (清洗结果的 JSONL 可选输出)，省掉两次整库的序列化/解析和一个与语料一样大的中间文件
+#用法：
+#  python pipeline.py --base-dir results --batches 1-29 --output domain_chunks.jsonl
+#  python pipeline.py --config pipeline.json    (键名与命令行参数相同，例如 {"base_dir": "...", "chunk_tokens": 800})
+#命令行参数优先于配置文件，配置文件优先于下面的默认值
+
+# ================= 默认配置 =================
+DEFAULTS = {
+    "base_dir": "",            # MinerU 结果目录 (batch_x/xxx_result/*.md)
+    "batches": "1-29",         # 处理哪些 batch，例如 "1-29" 或 "1,3,5-8"
+    "output": "",              # 最终切片文件
+    "chunk_index": "",         # 切片偏移索引，留空则为 output + ".index.db"
+    "washed_output": "",       # 可选：同时写出 washing.py 格式的清洗结果
+    "dedup_report": "",        # 可选：去重报告
+    "min_length": washing.MIN_LENGTH,
+    "dedup": True,
+    "threshold": dedup.THRESHOLD,
+    "num_perm": dedup.NUM_PERM,
+    "tokenizer_file": chunk.TOKENIZER_FILE,
+    "token_calibration_file": chunk.TOKEN_CALIBRATION_FILE,
+    "chunk_tokens": chunk.CHUNK_TOKENS,
+    "overlap_sentences": chunk.OVERLAP_SENTENCES,
+    "workers": None,           # None 表示用满所有 CPU 核；1 为单进程
+    "chunksize": 8,
+    "in_flight": 0,            # 同时排队的任务数 (每个任务 chunksize 篇)，0 表示进程数 × 4；论文边发现边提交
+    "progress_every": 500,     # 每处理多少篇打印一次各阶段计数
+}
+# ==========================================
+
+# 阶段名 -> 子进程里累计的耗时 (秒)，用来算每个阶段自身的吞吐
+STAGES = ("read", "clean", "signature", "chunk")
+
+def parse_batches(spec):
+    """"1-29" / "1,3,5-8" -> [1, ..., 29]"""
+    batches = []
+    for part in str(spec).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-', 1)
+            batches.extend(range(int(lo), int(hi) + 1))
+        else:
+            batches.append(int(part))
+    return batches
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="清洗 -> 去重 -> 切块 流式流水线")
+    parser.add_argument("--config", help="JSON 配置文件，键名与命令行参数相同 (用下划线)")
+    parser.add_argument("--base-dir")
+    parser.add_argument("--batches")
+    parser.add_argument("--output")
+    parser.add_argument("--chunk-index")
+    parser.add_argument("--washed-output")
+    parser.add_argument("--dedup-report")
+    parser.add_argument("--min-length", type=int)
+    parser.add_argument("--no-dedup", dest="dedup", action="store_false", default=None)
+    parser.add_argument("--threshold", type=float)
+    parser.add_argument("--num-perm", type=int)
+    parser.add_argument("--tokenizer-file")
+    parser.add_argument("--token-calibration-file")
+    parser.add_argument("--chunk-tokens", type=int)
+    parser.add_argument("--overlap-sentences", type=int)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--chunksize", type=int)
+    parser.add_argument("--in-flight", type=int)
+    parser.add_argument("--progress-every", type=int)
+    args = parser.parse_args(argv)
+
+    config = dict(DEFAULTS)
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            loaded = json.load(f)
+        unknown = set(loaded) - set(DEFAULTS)
+        if unknown:
+            parser.error(f"配置文件里有未知的键: {', '.join(sorted(unknown))}")
+        config.update(loaded)
+    config.update({k: v for k, v in vars(args).items() if v is not None and k != "config"})
+    if not config["base_dir"] or not config["output"]:
+        parser.error("必须指定 base_dir 和 output (命令行或配置文件)")
+    if config["num_perm"] & (config["num_perm"] - 1):
+        parser.error("num_perm 必须是 2 的幂")
+    return config
+
+# ================= 子进程：读取 + 清洗 + 过滤 + 签名 + 切块 =================
+_counter = None
+_config = None
+
+def init_worker(config):
+    # 每个进程只加载一次 tokenizer
+    global _counter, _config
+    _config = config
+    _counter = TokenCounter(config["tokenizer_file"], config["token_calibration_file"])
+
+def process_paper(task):
+    """返回 (状态, source, 结果, 各阶段耗时)
+
+    状态为 ok 时结果是 (清洗后的记录, MinHash 签名, [(切片, 小节路径, token 数)])，
+    skip / error 时是原因
+    """
+    i, paper_folder, md_path = task
+    source = f"batch_{i}/{paper_folder}"
+    timings = dict.fromkeys(STAGES, 0.0)
+    try:
+        t0 = time.perf_counter()
+        with open(md_path, 'rb') as f:
+            raw = f.read()
+        raw_content = raw.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+        t1 = time.perf_counter()
+        cleaned = washing.clean_paper_content(raw_content)
+        t2 = time.perf_counter()
+        timings["read"], timings["clean"] = t1 - t0, t2 - t1
+        if len(cleaned) < _config["min_length"]:
+            return "skip", source, "too_short", timings
+
+        sig = None
+        if _config["dedup"]:
+            sig = dedup.minhash_signature(cleaned, _config["num_perm"])
+        t3 = time.perf_counter()
+        # 切块放在子进程里和清洗一起做；被判为重复的论文白切了，但重复率低，换来切块也能并行
+        chunks = chunk.chunk_text(cleaned, _counter, _config["chunk_tokens"], _config["overlap_sentences"])
+        tokens = _counter.count_batch([text for text, _ in chunks])
+        t4 = time.perf_counter()
+        timings["signature"], timings["chunk"] = t3 - t2, t4 - t3
+        record = washing.paper_record(i, paper_folder, cleaned)
+        return "ok", source, (record, sig, [(text, path, n) for (text, path), n in zip(chunks, tokens)]), timings
+    except Exception as e:
+        return "error", source, f"处理 {md_path} 失败: {e}", timings
+
+# ================= 主进程 =================
+def discover(config, counts):
+    """FENZU 的 batch 目录结构 -> (batch 号, 论文文件夹, md 路径)"""
+    for i, paper_folder, folder_path, md_path in washing.iter_papers(config["base_dir"], parse_batches(config["batches"])):
+        counts["discovered"] += 1
+        if md_path is None:
+            counts["no_md"] += 1
+            continue
+        yield i, paper_folder, md_path
+
+def print_progress(counts, timings, started):
+    elapsed = max(time.monotonic() - started, 1e-9)
+    # 读取、清洗每篇都做；签名、切块只对过了长度过滤的论文做
+    done = {"read": counts["processed"], "clean": counts["processed"],
+            "signature": counts["washed"], "chunk": counts["washed"]}
+    stage_rates = " | ".join(
+        f"{name} {done[name] / timings[name]:.0f} 篇/s" for name in STAGES if timings[name] > 0)
+    print(f"⏱️ {elapsed:.0f}s | 发现 {counts['discovered']} | 清洗 {counts['washed']} | 过短 {counts['too_short']} | "
+          f"出错 {counts['error']} | 重复 {counts['near_duplicate']} | 切片 {counts['chunks']} | "
+          f"{counts['processed'] / elapsed:.1f} 篇/s")
+    if stage_rates:
+        print(f"   单进程各阶段吞吐: {stage_rates}")
+
+def run_pipeline(config):
+    if not os.path.isdir(config["base_dir"]):
+        print(f"❌ 错误：找不到目录 {config['base_dir']}")
+        return
+
+    index = dedup.LSHIndex(config["threshold"], config["num_perm"]) if config["dedup"] else None
+    counter = TokenCounter(config["tokenizer_file"], config["token_calibration_file"])
+    print(f"🚀 开始处理: {config['base_dir']} -> {config['output']}")
+    print(f"切片目标: {config['chunk_tokens']} tokens ({'tokenizer 精确计数' if counter.exact else '按字符估算'}) | "
+          f"去重: {'阈值 %s' % config['threshold'] if index else '关闭'}")
+
+    counts = dict.fromkeys(("discovered", "no_md", "processed", "washed", "too_short", "error",
+                            "near_duplicate", "papers", "chunks", "duplicate_chunks", "tokens"), 0)
+    timings = dict.fromkeys(STAGES, 0.0)
+    seen_ids = set()
+    calibration_samples = []
+    offset = 0
+    started = time.monotonic()
+
+    tasks = discover(config, counts)
+    if config["workers"] == 1:
+        init_worker(config)
+        results = map(process_paper, tasks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=config["workers"], initializer=init_worker, initargs=(config,))
+        # 按提交顺序返回：先出现的论文保留、后出现的判为重复，和单独跑 dedup.py 的结果一致。
+        # 不用 pool.map：它会先把 discover() 整个走完才返回第一个结果，"发现" 计数和流式处理都名存实亡
+        window = config["in_flight"] or (config["workers"] or os.cpu_count() or 1) * 4
+        results = dedup.ordered_imap(pool, process_paper, tasks, config["chunksize"], window)
+
+    washed_out = open(config["washed_output"], 'wb') if config["washed_output"] else None
+    report_out = open(config["dedup_report"], 'w', encoding='utf-8') if config["dedup_report"] else None
+    try:
+        with open(config["output"], "wb") as f_out, ChunkStore(config["output"], config["chunk_index"]) as store:
+            store.reset()
+            for status, source, payload, spent in results:
+                # 上一篇已经计完数，这时打印各阶段的数字才对得上
+                if config["progress_every"] and counts["processed"] and counts["processed"] % config["progress_every"] == 0:
+                    print_progress(counts, timings, started)
+                counts["processed"] += 1
+                for name in STAGES:
+                    timings[name] += spent[name]
+                if status == "error":
+                    counts["error"] += 1
+                    print(payload)
+                    continue
+                if status == "skip":
+                    counts["too_short"] += 1
+                    continue
+                counts["washed"] += 1
+                record, sig, chunks = payload
+
+                # 去重
+                if index is not None and sig is not None:
+                    dup_of, sim = index.query(sig)
+                    if dup_of is not None:
+                        counts["near_duplicate"] += 1
+                        if report_out:
+                            report_out.write(json.dumps({"id": source, "duplicate_of": dup_of, "jaccard": round(sim, 3)}, ensure_ascii=False) + '\n')
+                        continue
+                    if source not in index.signatures:
+                        index.add(source, sig)
+                if washed_out:
+                    washed_out.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+
+                # 写切片
+                rows = []
+                for n, (text, section_path, tokens) in enumerate(chunks):
+                    c_id = chunk_content_id(text)
+                    if c_id in seen_ids:
+                        counts["duplicate_chunks"] += 1
+                        continue
+                    seen_ids.add(c_id)
+                    row = chunk.chunk_row(c_id, source, n, text, section_path, tokens)
+                    f_out.write(row)
+                    rows.append((c_id, offset, len(row)))
+                    offset += len(row)
+                    counts["chunks"] += 1
+                    counts["tokens"] += tokens
+                store.add_many(rows)
+                counts["papers"] += 1
+                if chunks and len(calibration_samples) < 2000:
+                    calibration_samples.append(chunks[0][0])
+
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+        for f in (washed_out, report_out):
+            if f:
+                f.close()
+
+    print(f"\n✅ 处理完成！")
+    print_progress(counts, timings, started)
+    print(f"论文: 发现 {counts['discovered']} 篇 (无 md {counts['no_md']}) -> 清洗后保留 {counts['washed']} 篇 "
+          f"-> 去重后 {counts['papers']} 篇")
+    if counts["duplicate_chunks"]:
+        print(f"跳过内容完全相同的切片: {counts['duplicate_chunks']} 个")
+    print(f"切片: {counts['chunks']} 个，平均 {counts['tokens'] / max(counts['chunks'], 1):.0f} tokens")
+    if counter.calibrate(calibration_samples):
+        print(f"字符 -> token 换算比例: {counter.ratios}")
+    print(f"结果保存至: {config['output']}")
+    print(f"切片索引: {store.index_path}")
+    if washed_out:
+        print(f"清洗结果: {config['washed_output']}")
+    if report_out:
+        print(f"去重报告: {config['dedup_report']}")
+
+if __name__ == "__main__":
+    run_pipeline(parse_args())
@@ -0,0 +1,197 @@
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from fake_chat_server import FakeChatServer
+from gen_utils import ChunkManifest
+#端到端基准：在本地模拟接口上跑 RHS / DSP，比较不同 CONCURRENCY / TIMEOUT / MAX_TOKENS 的吞吐、延迟、丢片率和成本
+#不联网、不花钱；每组参数都从空的输出文件开始跑 (代替 clean_for_benchmark.py 手动清理)
+
+# ================= 配置 =================
+# 要测的脚本 (run 目录下的文件名)
+RUNNER_FILE = "run_hyper_speed.py"
+# 切片文件 (chunk.py 的输出)；留空则随机造 NUM_CHUNKS 个切片
+INPUT_FILE = ""
+NUM_CHUNKS = 300
+# 每组参数的结果追加到这里 (JSONL)，留空则只打印
+RESULT_FILE = ""
+
+# 模拟接口的行为，见 fake_chat_server.PROFILE；所有组合共用
+SERVER_PROFILE = {
+    "time_scale": 0.1,   # 等待时间缩短为 1/10，延迟统计会换算回原始时间
+}
+# 多端点路由用的两个 key (base_url 留空表示指向模拟接口)；模拟接口按 key 分别计算 capacity
+FAKE_ENDPOINTS = [
+    {"name": "key1", "api_key": "fake-key1", "model": "fake-deepseek-chat", "concurrency": 25},
+    {"name": "key2", "api_key": "fake-key2", "model": "fake-deepseek-chat", "concurrency": 25},
+]
+# 每组参数覆盖脚本里的同名全局变量。TIMEOUT_SECONDS 等时间类参数写原始时间，会自动乘以 time_scale
+# "profile" 只对这一组覆盖 SERVER_PROFILE
+CONFIGS = [
+    {"name": "默认", },
+    {"name": "并发20", "CONCURRENCY": 20},
+    {"name": "超时30s", "TIMEOUT_SECONDS": 30.0},
+    {"name": "输出限800", "MAX_OUTPUT_TOKENS": 800},
+    {"name": "非流式", "STREAM": False},
+    {"name": "不重试", "RETRY_ENABLED": False},
+    {"name": "单key限20", "profile": {"capacity": 20}},
+    {"name": "2个key", "profile": {"capacity": 20}, "ENDPOINTS": FAKE_ENDPOINTS},
+    {"name": "1个key宕机", "profile": {"down_keys": ["fake-key2"]}, "ENDPOINTS": FAKE_ENDPOINTS},
+]
+# 需要按 time_scale 缩放的参数
+TIME_KEYS = ("TIMEOUT_SECONDS", "BATCH_TIMEOUT_SECONDS", "HEALTH_CHECK_INTERVAL", "ENDPOINT_COOLDOWN")
+# 每组都固定的覆盖 (输出、日志、清单文件放在临时目录里，由基准自己管理)
+COMMON_OVERRIDES = {"API_KEY": "fake", "MODEL_NAME": "fake-deepseek-chat"}
+SEED = 0
+
+# 按 time_scale 加速时，脚本里写死的等待时间 (429 后 sleep 5 秒、对冲最小等待 1 秒等) 不会缩放，
+# time_scale 太小会让这部分占比失真，比较 429 相关的参数时建议用 1.0
+
+def load_runner():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), RUNNER_FILE)
+    spec = importlib.util.spec_from_file_location("bench_runner", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_chunks(path):
+    """随机造切片：长度在 RHS 默认的 100-3500 字之间"""
+    rng = random.Random(SEED)
+    words = ["SnO2 纳米线", "异质结界面", "的电阻变化", "gas response", "遵循 Arrhenius 方程", "氧空位浓度",
+             "$S = R_a / R_g$", "工作温度 300 ℃", "表面吸附氧", "耗尽层宽度"]
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(NUM_CHUNKS):
+            text = "，".join(rng.choice(words) for _ in range(rng.randint(40, 300))) + "。"
+            f.write(json.dumps({"id": f"bench_{i}", "text": text}, ensure_ascii=False) + "\n")
+
+def percentile(data, q):
+    if not data:
+        return None
+    data = sorted(data)
+    return data[min(len(data) - 1, int(len(data) * q))]
+
+def run_one(runner, defaults, server, config, work_dir, input_file):
+    server.reset(dict(SERVER_PROFILE, seed=SEED, **config.get("profile", {})))
+    scale = server.profile["time_scale"]
+    overrides = dict(COMMON_OVERRIDES, BASE_URL=server.base_url, INPUT_FILE=input_file,
+                     OUTPUT_FILE=os.path.join(work_dir, "sensor_physics_sft.jsonl"),
+                     LOG_FILE=os.path.join(work_dir, "generation.log"),
+                     MANIFEST_FILE=os.path.join(work_dir, "chunk_manifest.jsonl"),
+                     TELEMETRY_FILE=os.path.join(work_dir, "request_events.jsonl"))
+    for key, value in config.items():
+        if key in ("name", "profile"):
+            continue
+        if key not in defaults:
+            print(f"⚠️ {RUNNER_FILE} 里没有 {key}，忽略")
+            continue
+        if key == "ENDPOINTS":
+            value = [dict(ep, base_url=ep.get("base_url") or server.base_url) for ep in value]
+        overrides[key] = value * scale if key in TIME_KEYS else value
+    for key in TIME_KEYS:
+        if key in defaults and key not in config:
+            overrides[key] = defaults[key] * scale
+    # 先恢复默认值，再套上这一组的覆盖
+    for key, value in defaults.items():
+        setattr(runner, key, value)
+    for key, value in overrides.items():
+        setattr(runner, key, value)
+    for name in ("sensor_physics_sft.jsonl", "chunk_manifest.jsonl", "request_events.jsonl"):
+        path = os.path.join(work_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    started = time.monotonic()
+    asyncio.run(runner.main())
+    elapsed = time.monotonic() - started
+
+    statuses = ChunkManifest(overrides["MANIFEST_FILE"]).load()
+    with open(overrides["OUTPUT_FILE"], 'r', encoding='utf-8') as f:
+        qa_count = sum(1 for _ in f)
+    records = list(server.records)
+    events = []
+    if "TELEMETRY_FILE" in defaults and os.path.exists(overrides["TELEMETRY_FILE"]):
+        with open(overrides["TELEMETRY_FILE"], 'r', encoding='utf-8') as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    if events:
+        # 客户端记录的延迟 (含超时被斩杀的请求)
+        ok_latency = [e["latency"] / scale for e in events if e["outcome"] != "rate_limited"]
+    else:
+        # 脚本没有遥测时用服务端记录：超过 TIMEOUT_SECONDS 的请求已经被斩杀，按超时时间算
+        timeout = overrides.get("TIMEOUT_SECONDS")
+        cap = timeout / scale if timeout else float("inf")
+        ok_latency = [min(r["latency"], cap) for r in records if r["outcome"] != "429"]
+    chunks = len(statuses)
+    dropped = sum(1 for s in statuses.values() if s in ("timeout", "failed"))
+    tokens = sum(r["prompt_tokens"] + r["completion_tokens"] for r in records)
+    return {
+        "name": config.get("name", ""),
+        "runner": RUNNER_FILE,
+        "config": {k: v for k, v in config.items() if k not in ("name", "profile")},
+        "profile": server.profile,
+        "seconds": round(elapsed, 2),
+        "chunks": chunks,
+        # 吞吐按原始时间换算
+        "chunks_per_s": round(chunks / (elapsed / scale), 3),
+        "qa_pairs": qa_count,
+        "qa_per_min": round(qa_count / (elapsed / scale) * 60, 2),
+        "latency_p50": percentile(ok_latency, 0.5),
+        "latency_p95": percentile(ok_latency, 0.95),
+        "latency_p99": percentile(ok_latency, 0.99),
+        "drop_rate": round(dropped / max(chunks, 1), 4),
+        "empty_rate": round(sum(1 for s in statuses.values() if s == "empty") / max(chunks, 1), 4),
+        "requests": len(records),
+        "throttled": sum(1 for r in records if r["outcome"] == "429"),
+        # 流式请求提前断开的没有真正跑到 max_tokens
+        "truncated": sum(1 for r in records if r["finish_reason"] == "length" and r["outcome"] != "disconnected"),
+        "json_errors": sum(1 for e in events if e["outcome"] == "json_error"),
+        "aborted": sum(1 for e in events if e["outcome"] == "aborted"),
+        "salvaged_pairs": sum(e.get("salvaged", 0) for e in events),
+        "tokens_per_qa": round(tokens / qa_count, 1) if qa_count else None,
+        "completion_tokens_per_qa": round(sum(r["completion_tokens"] for r in records) / qa_count, 1) if qa_count else None,
+    }
+
+def fmt(v, spec):
+    return "-" if v is None else format(v, spec)
+
+def main():
+    runner = load_runner()
+    defaults = {k: v for k, v in vars(runner).items() if k.isupper()}
+    work_dir = tempfile.mkdtemp(prefix="bench_generation_")
+    input_file = INPUT_FILE
+    if not input_file:
+        input_file = os.path.join(work_dir, "domain_chunks.jsonl")
+        make_chunks(input_file)
+    server = FakeChatServer(dict(SERVER_PROFILE, seed=SEED), port=0).start()
+    print(f"🧪 模拟接口: {server.base_url} | 脚本: {RUNNER_FILE} | 切片: {input_file}")
+
+    results = []
+    try:
+        for config in CONFIGS:
+            print(f"\n===== {config.get('name', '')} =====")
+            row = run_one(runner, defaults, server, config, work_dir, input_file)
+            results.append(row)
+            if RESULT_FILE:
+                with open(RESULT_FILE, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    finally:
+        server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("\n" + "=" * 120)
+    print(f"{'配置':<12}{'切片/s':>8}{'问答/分钟':>10}{'p50':>7}{'p95':>7}{'p99':>7}{'丢片率':>8}"
+          f"{'空结果':>8}{'请求':>6}{'429':>6}{'截断':>6}{'JSON错':>7}{'断开':>6}{'token/问答':>11}")
+    for r in results:
+        print(f"{r['name']:<12}{r['chunks_per_s']:>8.2f}{r['qa_per_min']:>10.1f}{fmt(r['latency_p50'], '>7.1f')}"
+              f"{fmt(r['latency_p95'], '>7.1f')}{fmt(r['latency_p99'], '>7.1f')}{r['drop_rate']:>8.1%}"
+              f"{r['empty_rate']:>8.1%}{r['requests']:>6}{r['throttled']:>6}{r['truncated']:>6}{r['json_errors']:>7}{r['aborted']:>6}{fmt(r['tokens_per_qa'], '>11.0f')}")
+    print("延迟为模拟接口上的原始时间 (秒)，token/问答 含所有请求 (包括被斩杀、截断的) 的 prompt + completion；"
+          "流式请求提前断开的只算已发出的 token")
+    if RESULT_FILE:
+        print(f"结果已追加到 {RESULT_FILE}")
+
+if __name__ == "__main__":
+    main()
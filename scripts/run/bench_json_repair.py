@@ -0,0 +1,150 @@
+import json
+import random
+import re
+import time
+from gen_utils import LATEX_COMMANDS, extract_qa_records, loads_model_json
+#JSON 解析基准：在抓取的原始输出上比较旧的 fix_json_string 和 gen_utils.loads_model_json
+#统计能解析的比例、保住的问答对数、被吃掉的 LaTeX 命令数和每条的耗时
+
+# ================= 配置 =================
+# RHS / DSP 的 RAW_RESPONSE_FILE (每行 {"chunk_id", "finish_reason", "content"})；留空则随机造 NUM_SYNTHETIC 条
+CORPUS_FILE = r""
+NUM_SYNTHETIC = 3000
+SEED = 0
+# 每种解析方式重复跑几遍取最快的一遍计时
+TIMING_ROUNDS = 3
+# 打印几个新解析器救回来的样例
+SHOW_EXAMPLES = 3
+
+def legacy_fix_json_string(json_str):
+    """原来 RHS / DSP 里的 fix_json_string，作为对照"""
+    json_str = json_str.replace("```json", "").replace("```", "").strip()
+    try:
+        json_str = re.sub(r'(?<!\\)\\(?!["\\/bfnrtu])', r'\\\\', json_str)
+    except Exception:
+        pass
+    return json_str
+
+def legacy_loads(text):
+    return json.loads(legacy_fix_json_string(text))
+
+# LaTeX 命令的反斜杠被当成 JSON 转义后留下的痕迹：控制字符 + 命令剩下的字母 (\frac -> 换页符 + "rac")
+_ESCAPED = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+_EATEN_LATEX = re.compile("|".join(
+    re.escape(_ESCAPED[c[0]] + c[1:]) + "(?![A-Za-z])"
+    for c in sorted(LATEX_COMMANDS, key=len, reverse=True) if c[0] in _ESCAPED and len(c) > 2))
+
+def eaten_latex(obj):
+    """解析结果里有几处 LaTeX 命令被吃掉了"""
+    if isinstance(obj, str):
+        return len(_EATEN_LATEX.findall(obj))
+    if isinstance(obj, dict):
+        return sum(eaten_latex(v) for v in obj.values())
+    if isinstance(obj, list):
+        return sum(eaten_latex(v) for v in obj)
+    return 0
+
+def make_corpus():
+    """随机造模型输出：按真实常见的毛病组合 (没转义的 LaTeX、代码块、前后说明、截断、多余逗号、原始换行、内嵌引号)"""
+    rng = random.Random(SEED)
+    formulas = [r"$\frac{R_a}{R_g}$", r"$\theta = \frac{KP}{1+KP}$", r"$\nabla \times \mathbf{E}$", r"$\beta$",
+                r"$\tau_{res}$", r"$\rho \propto \exp(-E_a / k_B T)$", r"$\Delta G$", r"$\sigma = n e \mu$",
+                r"$\text{SnO}_2$", r"$\nu_{max}$", r"\times 10^{3}"]
+    words = ["灵敏度", "归因于异质结界面", "遵循 Arrhenius 方程", "氧空位浓度升高", "耗尽层变宽", "因此响应增强"]
+    corpus = []
+    for i in range(NUM_SYNTHETIC):
+        pairs = []
+        for _ in range(rng.randint(1, 2)):
+            parts = [rng.choice(words) + "，" + rng.choice(formulas) for _ in range(rng.randint(2, 8))]
+            if rng.random() < 0.2:
+                parts.insert(1, '所谓"敏化"效应')  # 没转义的引号
+            answer = "".join(parts) + "。"
+            if rng.random() < 0.3:
+                answer = answer.replace("，", "\n", 1)  # 原始换行
+            pairs.append({"instruction": "分析：" + rng.choice(words), "output": answer})
+        # 模型的原始输出：反斜杠通常不转义，少数情况会正确转义
+        inner = ",\n".join(
+            '{"instruction": "%s", "output": "%s"}' % (p["instruction"], p["output"]) for p in pairs)
+        if rng.random() < 0.1:
+            inner = inner.replace("\\", "\\\\")
+        text = '{"qa_pairs": [' + inner + (",\n" if rng.random() < 0.1 else "") + "]}"
+        finish_reason = "stop"
+        r = rng.random()
+        if r < 0.15:
+            text = "```json\n" + text + "\n```"
+        elif r < 0.25:
+            text = "好的，以下是问答对：\n" + text + "\n希望对你有帮助！"
+        elif r < 0.35:
+            text = text[:rng.randint(len(text) // 2, len(text) - 1)]
+            finish_reason = "length"
+        corpus.append({"chunk_id": f"synthetic_{i}", "finish_reason": finish_reason, "content": text})
+    return corpus
+
+def load_corpus():
+    if not CORPUS_FILE:
+        return make_corpus()
+    corpus = []
+    with open(CORPUS_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if row.get("content"):
+                corpus.append(row)
+    return corpus
+
+def evaluate(name, loads, corpus):
+    parsed, pairs, eaten, failed_ids = 0, 0, 0, set()
+    results = []
+    for row in corpus:
+        try:
+            result = loads(row["content"])
+        except ValueError:
+            failed_ids.add(row["chunk_id"])
+            results.append(None)
+            continue
+        parsed += 1
+        pairs += len(extract_qa_records(row["chunk_id"], "", result))
+        eaten += eaten_latex(result)
+        results.append(result)
+    best = float("inf")
+    for _ in range(TIMING_ROUNDS):
+        started = time.perf_counter()
+        for row in corpus:
+            try:
+                loads(row["content"])
+            except ValueError:
+                pass
+        best = min(best, time.perf_counter() - started)
+    return {"name": name, "parsed": parsed, "pairs": pairs, "eaten_latex": eaten,
+            "us_per_response": best / max(len(corpus), 1) * 1e6, "results": results}
+
+def main():
+    corpus = load_corpus()
+    print(f"🧪 语料: {CORPUS_FILE or '随机生成'} | {len(corpus)} 条原始输出 "
+          f"(其中被 max_tokens 截断 {sum(1 for r in corpus if r.get('finish_reason') == 'length')} 条)")
+    old = evaluate("fix_json_string", legacy_loads, corpus)
+    new = evaluate("loads_model_json", loads_model_json, corpus)
+
+    print("\n" + "=" * 78)
+    print(f"{'解析方式':<20}{'可解析':>10}{'问答对':>10}{'被吃掉的 LaTeX':>18}{'耗时 μs/条':>14}")
+    for r in (old, new):
+        print(f"{r['name']:<20}{r['parsed'] / max(len(corpus), 1):>10.1%}{r['pairs']:>10}{r['eaten_latex']:>18}"
+              f"{r['us_per_response']:>14.1f}")
+    gained = new["pairs"] - old["pairs"]
+    print(f"\n💰 同样花钱拿到的输出，多保住 {gained} 个问答对 ({gained / max(old['pairs'], 1):+.1%})，"
+          f"少吃掉 {old['eaten_latex'] - new['eaten_latex']} 处 LaTeX")
+
+    shown = 0
+    for row, a, b in zip(corpus, old["results"], new["results"]):
+        if shown >= SHOW_EXAMPLES:
+            break
+        if a is None and b is not None and extract_qa_records(row["chunk_id"], "", b):
+            shown += 1
+            print(f"\n--- 救回的样例 {row['chunk_id']} (finish_reason={row.get('finish_reason')}) ---")
+            print(row["content"][:200].replace("\n", "⏎"))
+            print("=>", json.dumps(b, ensure_ascii=False)[:200])
+
+if __name__ == "__main__":
+    main()
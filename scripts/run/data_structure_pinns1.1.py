@@ -2,23 +2,72 @@ import json
 import os
 import time
 import logging
-import re
 import asyncio
-from openai import AsyncOpenAI
+from types import SimpleNamespace
 from tqdm.asyncio import tqdm
+from gen_utils import (ChunkManifest, QAStreamParser, RetryQueue, RetryTask, Router, Telemetry, TokenCounter, UsageStats,
+                       complete_qa_pairs, extract_qa_records, loads_model_json, make_endpoints, run_pipeline,
+                       stream_chat_completion)
 
 # ================= 配置区域 =================
 API_KEY = ""  #填入 Key
 BASE_URL = "https://api.siliconflow.cn/v1"#硅基流动平台，可以自行修改
 MODEL_NAME = "deepseek-ai/DeepSeek-V3.2"  #推荐
 
-# 并发数
+# 多平台 / 多账号一起跑：每项 {"name", "base_url", "api_key", "model", "weight", "concurrency", "rpm", "tpm", "probe"}，
+# 字段说明见 gen_utils.ENDPOINT_DEFAULTS。留空则只用上面这一个 (并发、限速沿用下面的 CONCURRENCY / RPM_LIMIT / TPM_LIMIT)
+ENDPOINTS = []
+HEALTH_CHECK_INTERVAL = 60        # 后台探活间隔 (秒)，同时让连接池保持热连接；0 表示只在启动时检查
+ENDPOINT_FAILURE_THRESHOLD = 3    # 连续失败几次 (超时、5xx、连接错误) 暂停分配
+ENDPOINT_COOLDOWN = 30.0          # 暂停多久 (秒)
+
+# 并发数 (上限)
 CONCURRENCY = 15 
+# 自适应并发：429 / 延迟上升时减半，顺畅时逐步加回，最多到 CONCURRENCY
+ADAPTIVE_CONCURRENCY = True
+INITIAL_CONCURRENCY = 5
+MIN_CONCURRENCY = 1
+# 平台限速 (0 表示不限制)。DSP 不限制输出长度，TPM 按 RESERVE_OUTPUT_TOKENS 预扣输出额度
+RPM_LIMIT = 0
+TPM_LIMIT = 0
+RESERVE_OUTPUT_TOKENS = 1500
+# TPM 预扣按这个 tokenizer.json / 换算比例缓存计数 (与 chunk.py 相同)，都留空则按默认比例估算
+TOKENIZER_FILE = ""
+TOKEN_CALIBRATION_FILE = ""
+
+# 流式输出：边收边解析，精确记录截断；输出退化 (末尾 DEGENERATE_REPEAT_CHARS 字一直复读，
+# 或前 DEGENERATE_PROSE_CHARS 字都不是 JSON) 时提前断开。DSP 不限制输出长度，复读会一直计费到平台上限
+STREAM = True
+ABORT_DEGENERATE = True
+DEGENERATE_REPEAT_CHARS = 400
+DEGENERATE_PROSE_CHARS = 300
+
+# 延后重试：失败的切片排到输入的最后再试 (429 等一会儿、JSON 错发修复提示词、截断放大 max_tokens)，
+# 重试期间不占 worker。策略见 gen_utils.RETRY_POLICIES，可以在 RETRY_POLICIES 里覆盖
+RETRY_MAX_ATTEMPTS = 2          # 每个切片最多重试几次 (加上首次共 3 次，和以前一样)
+RETRY_BUDGET_RATIO = 1.0        # 重试总数上限 = 首轮切片数 × 这个比例
+RETRY_POLICIES = {}
+RETRY_MAX_OUTPUT_TOKENS = 8192  # 截断的切片重试时用的 max_tokens
+
+# 计费 (元 / 百万 token)，只用于统计前缀缓存省了多少钱，按平台价格填写
+PRICE_INPUT_PER_M = 2.0
+PRICE_CACHE_HIT_PER_M = 0.2
 #请根据情况修改
 WORK_DIR = r""
 INPUT_FILE = os.path.join(WORK_DIR, "domain_chunks.jsonl")
 OUTPUT_FILE = os.path.join(WORK_DIR, "sensor_physics_sft.jsonl")
 LOG_FILE = os.path.join(WORK_DIR, "generation.log")
+# 断点续跑清单：按 source_chunk_id 记录每个切片的结果 (done/empty/timeout/failed)
+MANIFEST_FILE = os.path.join(WORK_DIR, "chunk_manifest.jsonl")
+# 重启时跳过哪些状态的切片。默认只跳过已完成的，失败的切片重启后会再试；不想重试就加上 "timeout", "failed"
+RESUME_SKIP_STATUSES = ("done", "empty")
+# 请求级遥测：每个请求一行 (排队时间、延迟、token、finish_reason、结果分类、第几次重试)，留空则不写文件
+TELEMETRY_FILE = os.path.join(WORK_DIR, "request_events.jsonl")
+# 每次请求的原始输出 (解析之前)，给 bench_json_repair.py 当语料，留空则不记录
+RAW_RESPONSE_FILE = ""
+# 每隔多少秒打印一次最近 SUMMARY_WINDOW 秒的吞吐和延迟分位数，0 表示不打印
+SUMMARY_INTERVAL = 30
+SUMMARY_WINDOW = 60
 
 # ================= Prompt =================
 #请根据你的任务灵活修改，这个框架很优秀建议沿用
@@ -57,6 +106,11 @@ SYSTEM_PROMPT = r"""你是一位传感器材料与器件物理领域的专家。
   ]
 }
 """
+# 前缀缓存 (DeepSeek 等平台支持)：system + 用户指令前缀每次必须逐字节一致才能命中。
+# 不要往 SYSTEM_PROMPT 或 USER_PROMPT_PREFIX 里拼时间戳、chunk_id 之类会变的内容，变化的文本只放在最后
+USER_PROMPT_PREFIX = "请阅读以下科学文献片段，并生成0-2个包含物理约束的问答对：\n\n"
+# JSON 解析失败的切片重试时，把上次的输出连同这段提示词发回去，只让模型修格式
+REPAIR_PROMPT = "下面是你上一次的输出，它不是合法的 JSON (可能有未转义的反斜杠、多余的说明文字)。请只输出修复后的 JSON，结构和问答内容保持不变：\n\n"
 
 # ================= 工具函数 =================
 def setup_logger(log_file_path):
@@ -69,140 +123,211 @@ def setup_logger(log_file_path):
         logger.addHandler(fh)
     return logger
 
-def fix_json_string(json_str):
-    json_str = json_str.replace("```json", "").replace("```", "").strip()
-    try:
-        json_str = re.sub(r'(?<!\\)\\(?!["\\/bfnrtu])', r'\\\\', json_str)
-    except Exception:
-        pass
-    return json_str
-
-def count_lines(filename):
-    if not os.path.exists(filename): return 0
-    with open(filename, 'r', encoding='utf-8') as f:
-        return sum(1 for _ in f)
+# 全程共用一个计数器，main 里按本次配置创建；系统提示词每次都一样，只数一次
+token_counter = TokenCounter()
+SYSTEM_PROMPT_TOKENS = 0
 
 # ================= 异步核心逻辑 =================
 
-async def process_single_chunk(sem, client, text_chunk, chunk_id, logger):
-    async with sem:  # 限制并发数
-        retries = 3
-        for attempt in range(retries):
+async def process_single_chunk(router, usage_stats, telemetry, text_chunk, chunk_id, logger, task=None):
+    """请求一次。失败时不在这里休眠重试 (会一直占着 worker)，而是返回失败信息 (原因, 上次输出)，
+    由延后重试队列排到最后再试；task 是重试时带的 RetryTask"""
+    user_content = USER_PROMPT_PREFIX + text_chunk
+    extra = {}
+    attempt = 0
+    if task is not None:
+        attempt = task.attempt
+        if task.repair_text:
+            user_content = REPAIR_PROMPT + task.repair_text
+        if task.max_tokens_factor > 1:
+            # DSP 平时不限输出长度，被平台默认上限截断的切片重试时显式放大
+            extra["max_tokens"] = RETRY_MAX_OUTPUT_TOKENS
+    estimated = SYSTEM_PROMPT_TOKENS + token_counter.count(user_content) + RESERVE_OUTPUT_TOKENS
+    reserved = 0
+    queued = started = time.monotonic()
+    queue_wait = None
+    # 并发名额和 RPM / TPM 额度按端点各自计算
+    ep = router.pick()
+    try:
+        # 只在请求期间占用并发名额
+        async with ep.limiter:
+            reserved = await ep.rate_limiter.acquire(estimated)
+            started = time.monotonic()
+            queue_wait = started - queued
+            request = dict(
+                model=ep.model,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": user_content}
+                ],
+                temperature=0.3,
+                response_format={"type": "json_object"},
+                **extra
+            )
             try:
-                response = await client.chat.completions.create(
-                    model=MODEL_NAME,
-                    messages=[
-                        {"role": "system", "content": SYSTEM_PROMPT},
-                        {"role": "user", "content": f"请阅读以下科学文献片段，并生成0-2个包含物理约束的问答对：\n\n{text_chunk}"}
-                    ],
-                    temperature=0.3,
-                    response_format={"type": "json_object"}
-                )
-                
-                raw_content = response.choices[0].message.content
-                cleaned_content = fix_json_string(raw_content)
-                qa_data = json.loads(cleaned_content)
-                
-                return chunk_id, text_chunk, qa_data
-                
-            except json.JSONDecodeError:
-                if attempt == retries - 1:
-                    logger.error(f"Chunk {chunk_id}: JSON最终解析失败。Raw: {raw_content[:50]}...")
-            except Exception as e:
-                if "429" in str(e):
-                    logger.warning(f"Chunk {chunk_id}: 触发限流 (429)，休眠 5秒...")
-                    await asyncio.sleep(5)
+                if STREAM:
+                    # 流式：边收边解析，复读 / 输出不是 JSON 时提前断开
+                    parser = QAStreamParser(repeat_chars=DEGENERATE_REPEAT_CHARS, prose_chars=DEGENERATE_PROSE_CHARS)
+                    result = await stream_chat_completion(ep.client, request, parser, abort_degenerate=ABORT_DEGENERATE)
                 else:
-                    logger.error(f"Chunk {chunk_id}: API 错误: {e}")
-            
-            if attempt < retries - 1:
-                await asyncio.sleep(1 + attempt)
-                
-        return chunk_id, text_chunk, None
-
-async def main():
-    logger = setup_logger(LOG_FILE)
-    logger.info(">>> 异步任务开始 <<<")
-    
-    client = AsyncOpenAI(api_key=API_KEY, base_url=BASE_URL)
+                    response = await ep.client.chat.completions.create(**request)
+                    choice = response.choices[0]
+                    result = SimpleNamespace(content=choice.message.content or "", finish_reason=choice.finish_reason,
+                                             usage=response.usage, ttfb=None, pairs=[], aborted=None)
+            finally:
+                # 失败、被取消的请求也算一个延迟样本 (和 RHS 一样)，慢请求堆积时控制器才会降并发
+                latency = time.monotonic() - started
+                ep.limiter.record_latency(latency)
+    except Exception as e:
+        # 请求本身失败 (SDK 解析 SSE / 响应体时抛出的 JSONDecodeError 也算在这里)，预扣的输出额度退回
+        if reserved:
+            ep.rate_limiter.reconcile(reserved, reserved - RESERVE_OUTPUT_TOKENS)
+        throttled = "429" in str(e)
+        router.report(ep, ok=False, throttled=throttled)
+        telemetry.record(chunk_id, "rate_limited" if throttled else "api_error", time.monotonic() - started,
+                         queue_wait, retry=attempt, error=e, endpoint=ep.name)
+        if throttled:
+            ep.limiter.record_throttle()
+            logger.warning(f"Chunk {chunk_id}: 触发限流 (429)，排到最后重试")
+        else:
+            logger.error(f"Chunk {chunk_id}: API 错误: {e}")
+        return chunk_id, text_chunk, None, "failed", ("rate_limited" if throttled else "api_error", None)
+    router.report(ep, ok=True)
     
-    total_lines = count_lines(INPUT_FILE)
-    if os.path.exists(OUTPUT_FILE):
-        processed_count = count_lines(OUTPUT_FILE)
-    else:
-        processed_count = 0
-        
-    print(f"输入文件: {total_lines} 行")
-    print(f"已处理: {processed_count} 行 (跳过)")
+    telemetry.record_raw(chunk_id, result.content, result.finish_reason)
+    usage = result.usage
+    if usage is None and result.aborted:
+        # 提前断开的流拿不到 usage，按已收到的内容估算
+        prompt = estimated - RESERVE_OUTPUT_TOKENS
+        completion = token_counter.count(result.content)
+        usage = SimpleNamespace(prompt_tokens=prompt, completion_tokens=completion, total_tokens=prompt + completion)
+    usage_stats.record(usage, latency)
+    # 用真实用量修正预扣额度
+    if usage:
+        ep.rate_limiter.reconcile(reserved, usage.total_tokens)
+    raw_content = result.content
+    finish_reason = result.finish_reason
+    salvaged = result.pairs
+    # 只有模型输出本身的解析失败才按 JSON 错误处理
+    try:
+        if result.aborted:
+            raise json.JSONDecodeError(f"输出退化，已提前断开: {result.aborted}", raw_content, len(raw_content))
+        qa_data = loads_model_json(raw_content)
+        if finish_reason == "length":
+            # 截断的输出修好后只剩已闭合的问答对，照样按截断统计 (一个都没剩时 loads_model_json 已经抛错)
+            salvaged = complete_qa_pairs(qa_data)
+            raise json.JSONDecodeError("输出被 max_tokens 截断", raw_content, len(raw_content))
+    except json.JSONDecodeError as e:
+        outcome = "aborted" if result.aborted else "truncated" if finish_reason == "length" else "json_error"
+        telemetry.record(chunk_id, outcome, latency, queue_wait, ttfb=result.ttfb, usage=usage,
+                         finish_reason=finish_reason, retry=attempt, error=e, salvaged=len(salvaged),
+                         endpoint=ep.name)
+        if salvaged:
+            # 断开 / 截断之前已经闭合的问答对是完整的，直接收下，不再重试
+            return chunk_id, text_chunk, {"qa_pairs": salvaged}, "done", None
+        logger.error(f"Chunk {chunk_id}: JSON解析失败 ({outcome}, 第 {attempt} 次重试)。Raw: {raw_content[:50]}...")
+        return chunk_id, text_chunk, None, "failed", (outcome, raw_content)
+    telemetry.record(chunk_id, "ok", latency, queue_wait, ttfb=result.ttfb, usage=usage,
+                     finish_reason=finish_reason, retry=attempt, endpoint=ep.name)
     
-    lines_to_process = []
+    return chunk_id, text_chunk, qa_data, "done", None
+
+def iter_pending_chunks(finished_ids):
+    """流式读取输入文件，边读边过滤，跳过已完成的切片"""
     with open(INPUT_FILE, 'r', encoding='utf-8') as f:
         for i, line in enumerate(f):
-            if i < processed_count:
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError:
                 continue
-            if line.strip():
-                lines_to_process.append((i+1, line.strip()))
-
-    if not lines_to_process:
-        print("所有数据已处理完毕。")
-        return
-
-    sem = asyncio.Semaphore(CONCURRENCY)
-    tasks = []
-
-    print(f"准备处理 {len(lines_to_process)} 条数据，并发数: {CONCURRENCY}")
-    
-    for idx, line in lines_to_process:
-        try:
-            data = json.loads(line)
             text = data.get('text', data.get('content', ''))
-            c_id = data.get('id', f"line_{idx}")
+            c_id = data.get('id', f"line_{i+1}")
             
             if len(text) < 100:
                 continue
-                
-            task = process_single_chunk(sem, client, text, c_id, logger)
-            tasks.append(task)
-        except json.JSONDecodeError:
-            pass
+            if c_id in finished_ids:
+                continue
+            yield c_id, text
+
+async def main():
+    global token_counter, SYSTEM_PROMPT_TOKENS
+    token_counter = TokenCounter(TOKENIZER_FILE, TOKEN_CALIBRATION_FILE)
+    SYSTEM_PROMPT_TOKENS = token_counter.count(SYSTEM_PROMPT)
+    logger = setup_logger(LOG_FILE)
+    logger.info(">>> 异步任务开始 <<<")
+    
+    endpoint_configs = ENDPOINTS or [{"name": "default", "base_url": BASE_URL, "api_key": API_KEY, "model": MODEL_NAME,
+                                      "concurrency": CONCURRENCY, "rpm": RPM_LIMIT, "tpm": TPM_LIMIT}]
+    router = Router(make_endpoints(endpoint_configs, ADAPTIVE_CONCURRENCY, INITIAL_CONCURRENCY, MIN_CONCURRENCY),
+                    ENDPOINT_FAILURE_THRESHOLD, ENDPOINT_COOLDOWN, HEALTH_CHECK_INTERVAL, printer=tqdm.write)
     
-    with open(OUTPUT_FILE, 'a', encoding='utf-8') as f_out:
-        pbar = tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="🚀 高速生成中")
+    # 按 chunk_id 断点续跑，输出行数和输入行数并不是一一对应的
+    manifest = ChunkManifest(MANIFEST_FILE)
+    finished_ids = manifest.load_finished(RESUME_SKIP_STATUSES, seed_output=OUTPUT_FILE)
         
-        for future in pbar:
-            try:
-                chunk_id, origin_text, result = await future
-                
-                if result:
-                    final_qas = result.get('qa_pairs', result) if isinstance(result, dict) else result
+    print(f"已完成: {len(finished_ids)} 个切片 (跳过)")
+    print(f"开始流式处理，并发上限: {router.max_limit} (端点: {len(router.endpoints)} | 自适应: {ADAPTIVE_CONCURRENCY})")
+    
+    usage_stats = UsageStats()
+    telemetry = Telemetry(TELEMETRY_FILE, SUMMARY_INTERVAL, SUMMARY_WINDOW, printer=tqdm.write,
+                          raw_path=RAW_RESPONSE_FILE)
+    retry = RetryQueue(RETRY_MAX_ATTEMPTS, RETRY_BUDGET_RATIO, policies=RETRY_POLICIES)
+    
+    async def handle(item):
+        task = item if isinstance(item, RetryTask) else None
+        c_id, text = task.item if task else item
+        res = await process_single_chunk(router, usage_stats, telemetry, text, c_id, logger, task)
+        reason, last_output = res[4] or (None, None)
+        # 排进重试队列的切片这次不写结果
+        return None if retry.offer(item, reason, last_output) else res
+    
+    async with router:
+        with open(OUTPUT_FILE, 'a', encoding='utf-8') as f_out, manifest, telemetry:
+            pbar = tqdm(desc="🚀 高速生成中")
+            
+            def write_result(res):
+                if res is None:
+                    return
+                try:
+                    chunk_id, origin_text, result, status, _ = res
+                    # 和 RHS 共用同一套校验，格式不对的问答对直接跳过
+                    records = extract_qa_records(chunk_id, origin_text, result)
+                    valid_count = len(records)
                     
-                    if isinstance(final_qas, list) and len(final_qas) > 0:
-                        valid_count = 0
-                        for qa in final_qas:
-                            q = qa.get("instruction", qa.get("question"))
-                            a = qa.get("output", qa.get("answer"))
+                    for record in records:
+                        f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    
+                    if valid_count > 0:
+                        f_out.flush()
+                        logger.info(f"Chunk {chunk_id}: 成功生成 {valid_count} 条。")
+                    
+                    # 结果落盘之后再记清单
+                    if status == "done" and valid_count == 0:
+                        status = "empty"
+                    manifest.record(chunk_id, status, valid_count)
                             
-                            if q and a:
-                                record = {
-                                    "source_chunk_id": chunk_id,
-                                    "instruction": q,
-                                    "output": a,
-                                    "context_preview": origin_text[:50]
-                                }
-                                f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
-                                valid_count += 1
-                        
-                        if valid_count > 0:
-                            f_out.flush()
-                            logger.info(f"Chunk {chunk_id}: 成功生成 {valid_count} 条。")
-                    else:
-                        pass
-                        
-            except Exception as e:
-                logger.error(f"主循环写入错误: {e}")
+                except Exception as e:
+                    logger.error(f"主循环写入错误: {e}")
+                pbar.set_postfix({"并发": router.limit, "缓存": f"{usage_stats.hit_rate:.0%}"})
+                pbar.update(1)
+            
+            await run_pipeline(iter_pending_chunks(finished_ids), handle, write_result, router.max_limit, retry=retry)
+            pbar.close()
 
     logger.info(">>> 任务完成 <<<")
-    print(f"\n处理完成！文件已保存至: {OUTPUT_FILE}")
+    print(telemetry.totals_summary())
+    print(retry.summary())
+    if len(router.endpoints) > 1:
+        print(router.summary())
+    cache_report = usage_stats.summary(PRICE_INPUT_PER_M, PRICE_CACHE_HIT_PER_M)
+    logger.info(cache_report)
+    print(cache_report)
+    if pbar.n == 0:
+        print("所有数据已处理完毕。")
+    else:
+        print(f"\n处理完成！文件已保存至: {OUTPUT_FILE}")
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,147 @@
+import email
+import email.policy
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+#本地模拟 OpenAI 兼容的批量接口 (/v1/files + /v1/batches)，不花钱离线测试 run_batch_api.py
+# 用法：python fake_batch_server.py，然后把 run_batch_api.py 的 BASE_URL 改成 http://127.0.0.1:8765/v1
+
+# ================= 配置 =================
+HOST = "127.0.0.1"
+PORT = 8765
+COMPLETE_AFTER_SECONDS = 5.0  # 提交后多久变成 completed
+ERROR_RATE = 0.05             # 单条请求进入 error 文件的比例
+MALFORMED_RATE = 0.02         # 返回非法 JSON 内容的比例
+
+FILES = {}    # file_id -> {"meta": {...}, "data": bytes}
+BATCHES = {}  # batch_id -> batch 对象 (dict)
+LOCK = threading.Lock()
+
+def fake_completion(body):
+    """根据请求内容造一个 chat.completion，问答对里带上片段开头方便核对"""
+    user_text = body["messages"][-1]["content"]
+    snippet = user_text.split("\n\n", 1)[-1][:30]
+    if random.random() < MALFORMED_RATE:
+        content = '{"qa_pairs": [{"instruction": "截断的回答'
+    else:
+        content = json.dumps({"qa_pairs": [{
+            "instruction": f"分析以下片段中的物理机理：{snippet}",
+            "output": "性能提升归因于异质结界面的内建电场，遵循 $S = R_a / R_g$。"
+        }]}, ensure_ascii=False)
+    prompt_tokens = len(user_text) // 2
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake-model"),
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 80,
+                  "total_tokens": prompt_tokens + 80}
+    }
+
+def new_file(data, filename, purpose):
+    file_id = f"file-{uuid.uuid4().hex[:16]}"
+    meta = {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed"}
+    FILES[file_id] = {"meta": meta, "data": data}
+    return meta
+
+def finish_batch(batch):
+    """到时间后一次性生成 output / error 文件"""
+    out_lines, err_lines = [], []
+    for line in FILES[batch["input_file_id"]]["data"].decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        req = json.loads(line)
+        row = {"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": req["custom_id"], "error": None}
+        if random.random() < ERROR_RATE:
+            row["response"] = {"status_code": 500, "request_id": uuid.uuid4().hex,
+                               "body": {"error": {"message": "fake server error", "type": "server_error"}}}
+            err_lines.append(row)
+        else:
+            row["response"] = {"status_code": 200, "request_id": uuid.uuid4().hex,
+                               "body": fake_completion(req["body"])}
+            out_lines.append(row)
+
+    def dump(rows):
+        return "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows).encode("utf-8")
+
+    batch["output_file_id"] = new_file(dump(out_lines), "output.jsonl", "batch_output")["id"]
+    if err_lines:
+        batch["error_file_id"] = new_file(dump(err_lines), "errors.jsonl", "batch_output")["id"]
+    batch["request_counts"] = {"total": len(out_lines) + len(err_lines),
+                               "completed": len(out_lines), "failed": len(err_lines)}
+    batch["status"] = "completed"
+    batch["completed_at"] = int(time.time())
+
+class Handler(BaseHTTPRequestHandler):
+    def _send(self, code, payload, raw=False):
+        body = payload if raw else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/octet-stream" if raw else "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        with LOCK:
+            if self.path.rstrip("/") == "/v1/files":
+                # multipart/form-data：用 email 模块解析，不依赖第三方库
+                raw = b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + self._body()
+                msg = email.message_from_bytes(raw, policy=email.policy.HTTP)
+                fields, data, filename = {}, b"", "upload.jsonl"
+                for part in msg.iter_parts():
+                    name = part.get_param("name", header="content-disposition")
+                    if part.get_filename():
+                        data, filename = part.get_payload(decode=True), part.get_filename()
+                    else:
+                        fields[name] = part.get_content().strip()
+                return self._send(200, new_file(data, filename, fields.get("purpose", "batch")))
+
+            if self.path.rstrip("/") == "/v1/batches":
+                req = json.loads(self._body() or b"{}")
+                if req.get("input_file_id") not in FILES:
+                    return self._send(404, {"error": {"message": "input file not found"}})
+                batch_id = f"batch_{uuid.uuid4().hex[:16]}"
+                BATCHES[batch_id] = {
+                    "id": batch_id, "object": "batch", "endpoint": req.get("endpoint"),
+                    "errors": None, "input_file_id": req["input_file_id"],
+                    "completion_window": req.get("completion_window", "24h"),
+                    "status": "in_progress", "output_file_id": None, "error_file_id": None,
+                    "created_at": int(time.time()), "in_progress_at": int(time.time()),
+                    "completed_at": None, "request_counts": {"total": 0, "completed": 0, "failed": 0},
+                    "metadata": req.get("metadata")
+                }
+                return self._send(200, BATCHES[batch_id])
+        self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def do_GET(self):
+        with LOCK:
+            m = re.fullmatch(r"/v1/batches/([\w-]+)", self.path)
+            if m and m.group(1) in BATCHES:
+                batch = BATCHES[m.group(1)]
+                if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= COMPLETE_AFTER_SECONDS:
+                    finish_batch(batch)
+                return self._send(200, batch)
+            m = re.fullmatch(r"/v1/files/([\w-]+)/content", self.path)
+            if m and m.group(1) in FILES:
+                return self._send(200, FILES[m.group(1)]["data"], raw=True)
+        self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def log_message(self, fmt, *args):
+        pass  # 不刷屏
+
+if __name__ == "__main__":
+    print(f"🧪 模拟批量接口已启动: http://{HOST}:{PORT}/v1 (完成耗时 {COMPLETE_AFTER_SECONDS}s, 错误率 {ERROR_RATE})")
+    try:
+        ThreadingHTTPServer((HOST, PORT), Handler).serve_forever()
+    except KeyboardInterrupt:
+        print("\n已停止")
@@ -0,0 +1,280 @@
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from gen_utils import TokenCounter
+#本地模拟 OpenAI 兼容的对话接口 (/v1/chat/completions)，不花钱离线测试 DSP / RHS 的并发、超时、max_tokens 设置
+# 用法：python fake_chat_server.py，然后把 RHS 的 BASE_URL 改成 http://127.0.0.1:8766/v1
+# bench_generation.py 会在同一个进程里启动它，按不同参数组合跑基准
+
+# ================= 配置 =================
+HOST = "127.0.0.1"
+PORT = 8766
+# 模拟的服务端行为，bench_generation.py 可以按需覆盖其中的任何一项
+PROFILE = {
+    "ttfb_median": 2.0,        # 首 token 延迟的中位数 (秒)，服从对数正态分布
+    "ttfb_sigma": 0.5,         # 对数正态的 sigma，越大长尾越重
+    "tokens_per_second": 40,   # 生成速度
+    "output_tokens_mean": 600, # 模型 "想要" 生成的长度，超过 max_tokens 会被截断 (finish_reason=length)
+    "output_tokens_sd": 250,
+    "capacity": 64,            # 每个 API key 同时处理的请求数上限，超过直接返回 429 (和真实平台一样按账号限流)
+    "down_keys": [],           # 这些 API key 的请求一律返回 503，模拟某个平台 / 账号宕机
+    "rate_429": 0.02,          # 随机 429 的比例
+    "timeout_rate": 0.01,      # 请求卡住不返回的比例 (卡 hang_seconds 秒)
+    "hang_seconds": 300,
+    "malformed_rate": 0.03,    # 返回内容不是合法 JSON 的比例
+    "empty_rate": 0.1,         # 返回空 qa_pairs 的比例
+    "degenerate_rate": 0.02,   # 一个正常问答对之后开始复读，一直写到 max_tokens 的比例
+    "stream_chunk_tokens": 8,  # 流式输出 (stream=True) 每个片段的 token 数
+    "time_scale": 1.0,         # 所有等待时间乘以这个系数，调小可以加速基准 (延迟统计会换算回原始时间)
+    "seed": 0,
+}
+
+
+class FakeChatServer:
+    """模拟的对话接口 + 每个请求的记录 (给 bench_generation.py 统计用)"""
+
+    def __init__(self, profile=None, host=HOST, port=PORT):
+        self.profile = dict(PROFILE, **(profile or {}))
+        self.rng = random.Random(self.profile["seed"])
+        self.lock = threading.Lock()
+        self.in_flight = {}  # API key -> 正在处理的请求数
+        self.records = []  # 每个请求一条 {outcome, latency, prompt_tokens, completion_tokens, finish_reason}
+        self.prefix_seen = set()
+        self.counter = TokenCounter()
+        server = self
+
+        class Handler(_Handler):
+            fake = server
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset(self, profile=None):
+        """换一组参数重新开始统计 (连接和线程不用重建)"""
+        with self.lock:
+            if profile is not None:
+                self.profile = dict(PROFILE, **profile)
+            self.rng = random.Random(self.profile["seed"])
+            self.records = []
+            self.prefix_seen = set()
+
+    def plan(self, body, key=""):
+        """决定这个请求的结果：返回 (HTTP 状态码, 响应体, 需要等待的秒数, 这个请求的记录)
+
+        流式请求的等待时间是首 token 延迟，内容按 tokens_per_second 逐段发出
+        """
+        p = self.profile
+        messages = body.get("messages", [])
+        system = "".join(m.get("content", "") for m in messages if m.get("role") == "system")
+        user = messages[-1].get("content", "") if messages else ""
+        prompt_tokens = self.counter.count(system) + self.counter.count(user)
+        max_tokens = body.get("max_tokens") or 4096
+        with self.lock:
+            r = self.rng.random()
+            ttfb = self.rng.lognormvariate(math.log(p["ttfb_median"]), p["ttfb_sigma"])
+            wanted = max(20, int(self.rng.gauss(p["output_tokens_mean"], p["output_tokens_sd"])))
+            kind = self.rng.random()
+            # 相同的 system prompt 第二次起算命中前缀缓存 (DeepSeek 的字段名)
+            cached = self.counter.count(system) if system in self.prefix_seen else 0
+            self.prefix_seen.add(system)
+            overloaded = self.in_flight.get(key, 0) > p["capacity"]
+
+        if overloaded or r < p["rate_429"]:
+            record = self._record("429", 0.05, 0, 0, None)
+            return 429, {"error": {"message": "Rate limit reached (fake)", "type": "rate_limit_error", "code": 429}}, 0.05, record
+
+        degenerate = p["malformed_rate"] + p["empty_rate"] <= kind < p["malformed_rate"] + p["empty_rate"] + p["degenerate_rate"]
+        if degenerate:
+            # 复读停不下来，只有 max_tokens 能截住
+            wanted = max_tokens * 2
+        completion_tokens = min(wanted, max_tokens)
+        finish_reason = "length" if wanted > max_tokens else "stop"
+        latency = ttfb + completion_tokens / p["tokens_per_second"]
+        outcome = "ok"
+        if r < p["rate_429"] + p["timeout_rate"]:
+            latency, outcome = p["hang_seconds"], "hang"
+        content = fake_content(user, wanted, kind, p)
+        if degenerate:
+            outcome = "degenerate"
+        if finish_reason == "length":
+            # 按比例截断，和真实模型被 max_tokens 截断一样，JSON 不完整
+            content = content[:max(1, len(content) * completion_tokens // wanted)]
+            outcome = "degenerate" if degenerate else "length"
+        elif kind < p["malformed_rate"]:
+            outcome = "malformed"
+        record = self._record(outcome, latency, prompt_tokens, completion_tokens, finish_reason)
+        if body.get("stream"):
+            latency = ttfb if outcome != "hang" else p["hang_seconds"]
+        return 200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake-model"),
+            "choices": [{"index": 0, "finish_reason": finish_reason,
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens,
+                      "prompt_cache_hit_tokens": cached, "prompt_cache_miss_tokens": prompt_tokens - cached}
+        }, latency, record
+
+    def _record(self, outcome, latency, prompt_tokens, completion_tokens, finish_reason):
+        record = {"outcome": outcome, "latency": latency, "prompt_tokens": prompt_tokens,
+                  "completion_tokens": completion_tokens, "finish_reason": finish_reason}
+        with self.lock:
+            self.records.append(record)
+        return record
+
+
+def fake_content(user_text, wanted_tokens, kind, p):
+    """造一段长度约 wanted_tokens 的回答：正常 JSON / 空列表 / 不合法 JSON / 复读"""
+    snippet = user_text.split("\n\n", 1)[-1][:30]
+    if kind < p["malformed_rate"]:
+        # 一半是没转义的 LaTeX，一半是 JSON 前后夹了说明文字 (loads_model_json 都能修)
+        if kind < p["malformed_rate"] / 2:
+            return '{"qa_pairs": [{"instruction": "推导灵敏度", "output": "由 Langmuir 吸附 $\\theta = \\frac{KP}{1+KP}$ 可得"}]}'
+        return '好的，以下是生成的问答对：\n{"qa_pairs": [{"instruction": "分析机理", "output": "归因于异质结"}]}\n希望对你有帮助！'
+    if kind < p["malformed_rate"] + p["empty_rate"]:
+        return '{"qa_pairs": []}'
+    # 中文约 1.5 字/token，两个问答对平分长度
+    filler = "性能提升归因于异质结界面的内建电场，遵循 $S = R_a / R_g$。"
+    if kind < p["malformed_rate"] + p["empty_rate"] + p["degenerate_rate"]:
+        # 第一个问答对正常，第二个的回答开始复读同一句话
+        first = json.dumps({"instruction": f"分析以下片段中的物理机理：{snippet}", "output": filler * 4}, ensure_ascii=False)
+        loop = "因此灵敏度随温度升高而升高，"
+        prefix = '{"qa_pairs": [' + first + ', {"instruction": "进一步分析", "output": "'
+        return prefix + loop * (int(wanted_tokens * 1.5) // len(loop) + 1)
+    per_pair = max(1, int(wanted_tokens * 1.5 / 2))
+    # 句子带编号，正常回答不会被当成复读
+    body = "".join(f"({i}) {filler}" for i in range(per_pair // len(filler) + 1))[:per_pair]
+    return json.dumps({"qa_pairs": [
+        {"instruction": f"分析以下片段中的物理机理：{snippet}", "output": body},
+        {"instruction": f"推导该片段涉及的数学关系：{snippet}", "output": body},
+    ]}, ensure_ascii=False)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    fake = None
+    protocol_version = "HTTP/1.1"  # keep-alive，和真实平台一样复用连接
+
+    def _send(self, code, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data):
+        """分块传输编码写一个 SSE 事件"""
+        payload = f"data: {data}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(payload):x}\r\n".encode("ascii") + payload + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, payload, body, record):
+        """按 OpenAI 的 SSE 格式逐段发出内容；客户端中途断开时，只按已发出的 token 记账"""
+        p = self.fake.profile
+        choice = payload["choices"][0]
+        content = choice["message"]["content"]
+        usage = payload["usage"]
+        head = {k: payload[k] for k in ("id", "created", "model")}
+        head["object"] = "chat.completion.chunk"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        # 每段 stream_chunk_tokens 个 token (约 1.5 字/token)
+        total_tokens = usage["completion_tokens"]
+        step = max(1, int(p["stream_chunk_tokens"] * 1.5))
+        sent = 0
+        interval = p["stream_chunk_tokens"] / p["tokens_per_second"] * p["time_scale"]
+        deadline = time.monotonic()
+        try:
+            for start in range(0, len(content), step):
+                piece = content[start:start + step]
+                self._chunk(json.dumps(dict(head, choices=[{"index": 0, "delta": {"content": piece},
+                                                            "finish_reason": None}]), ensure_ascii=False))
+                sent = start + len(piece)
+                # 按绝对时间排期，避免 sleep 的误差逐段累积
+                deadline += interval
+                time.sleep(max(0.0, deadline - time.monotonic()))
+            self._chunk(json.dumps(dict(head, choices=[{"index": 0, "delta": {},
+                                                        "finish_reason": choice["finish_reason"]}])))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self._chunk(json.dumps(dict(head, choices=[], usage=usage)))
+            self._chunk("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前断开 (超时或者主动放弃)，平台不再继续生成
+            with self.fake.lock:
+                record["completion_tokens"] = total_tokens * sent // max(len(content), 1)
+                record["outcome"] = "disconnected"
+            self.close_connection = True
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            return self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+        fake = self.fake
+        key = self._api_key()
+        if key in fake.profile["down_keys"]:
+            fake._record("503", 0.0, 0, 0, None)
+            return self._send(503, {"error": {"message": "Service unavailable (fake)", "type": "server_error"}})
+        with fake.lock:
+            fake.in_flight[key] = fake.in_flight.get(key, 0) + 1
+        try:
+            code, payload, wait, record = fake.plan(body, key)
+            time.sleep(wait * fake.profile["time_scale"])
+            if code == 200 and body.get("stream"):
+                self._stream(payload, body, record)
+            else:
+                self._send(code, payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 客户端超时后已经断开
+        finally:
+            with fake.lock:
+                fake.in_flight[key] -= 1
+
+    def _api_key(self):
+        return self.headers.get("Authorization", "").replace("Bearer ", "", 1)
+
+    def do_GET(self):
+        # check_models.py / 路由探活用的模型列表
+        if self._api_key() in self.fake.profile["down_keys"]:
+            return self._send(503, {"error": {"message": "Service unavailable (fake)", "type": "server_error"}})
+        if self.path.rstrip("/") == "/v1/models":
+            return self._send(200, {"object": "list", "data": [
+                {"id": "fake-deepseek-chat", "object": "model", "owned_by": "fake"}]})
+        self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def log_message(self, fmt, *args):
+        pass  # 不刷屏
+
+
+if __name__ == "__main__":
+    server = FakeChatServer()
+    print(f"🧪 模拟对话接口已启动: {server.base_url} (首 token 中位 {PROFILE['ttfb_median']}s, "
+          f"429 {PROFILE['rate_429']:.0%}, 卡死 {PROFILE['timeout_rate']:.0%}, 非法 JSON {PROFILE['malformed_rate']:.0%})")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\n已停止")
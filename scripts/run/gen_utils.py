@@ -0,0 +1,1308 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import time
+from collections import deque
+from types import SimpleNamespace
+#DSP / RHS 共用的工具，放在 run 目录下直接 import 即可 (chunk.py / sweet.py 也会用到 TokenCounter)
+
+# ================= 断点续跑清单 =================
+# 每个切片处理结束后追加一行 {"id": ..., "status": ..., "pairs": n}
+# status 取值：
+#   done    成功并写入了 >=1 条问答对
+#   empty   成功但模型没有给出有效问答对 (0 条)
+#   timeout 超时被斩杀
+#   failed  API 错误 / JSON 解析失败
+#   batch_error  批量接口里这条请求出错 / 分片过期没有返回
+MANIFEST_STATUSES = ("done", "empty", "timeout", "failed", "batch_error")
+# 续跑时默认只跳过真正完成的切片；timeout / failed / batch_error 没有产出，重启后再给一次机会
+FINISHED_STATUSES = ("done", "empty")
+
+
+class ChunkManifest:
+    """按 source_chunk_id 记录切片完成情况的追加式清单"""
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._fh = None
+
+    def load(self):
+        """读取清单，返回 {chunk_id: status}，同一个 id 以最后一次记录为准"""
+        status = {}
+        if not os.path.exists(self.path):
+            return status
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                    status[rec["id"]] = rec["status"]
+                except Exception:
+                    # 崩溃时可能只写了半行，直接忽略
+                    pass
+        return status
+
+    def load_finished(self, skip_statuses=FINISHED_STATUSES, seed_output=None):
+        """返回本次启动需要跳过的 chunk_id 集合
+
+        seed_output: 旧版本没有清单时，用已有结果文件里的 source_chunk_id 兜底
+        """
+        status = self.load()
+        finished = {c_id for c_id, s in status.items() if s in skip_statuses}
+        if not status and seed_output and os.path.exists(seed_output):
+            with open(seed_output, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        finished.add(json.loads(line)["source_chunk_id"])
+                    except Exception:
+                        pass
+        return finished
+
+    def open(self):
+        # 上次崩溃留下的半行需要先补一个换行，否则会和新记录粘在一起
+        needs_newline = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self._fh = open(self.path, 'a', encoding='utf-8')
+        if needs_newline:
+            self._fh.write("\n")
+        return self
+
+    def record(self, chunk_id, status, pairs=0):
+        rec = {"id": chunk_id, "status": status, "pairs": pairs}
+        self._fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._fh.flush()
+        if self.fsync:
+            os.fsync(self._fh.fileno())
+
+    def close(self):
+        if self._fh:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ================= 切片 ID 与切片存储 =================
+def chunk_content_id(text):
+    """切片 ID = 正文内容的哈希。重新切块、调整顺序后，内容没变的切片 ID 不变，已完成的结果仍能对上"""
+    return "c_" + hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class ChunkStore:
+    """domain_chunks.jsonl 的偏移索引 (SQLite)：按切片 ID 直接 seek 读取，不用重新扫描整个 JSONL
+
+    索引表只存 (id, 字节偏移, 长度)，正文仍然只在 JSONL 里一份。内容相同的切片 ID 相同，只保留第一条
+    """
+
+    def __init__(self, jsonl_path, index_path=""):
+        self.jsonl_path = jsonl_path
+        self.index_path = index_path or jsonl_path + ".index.db"
+        self._db = None
+        self._fh = None
+
+    def _conn(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.index_path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, offset INTEGER, length INTEGER) WITHOUT ROWID")
+        return self._db
+
+    def reset(self):
+        """清空索引 (重新切块时调用)"""
+        self._conn().execute("DELETE FROM chunks")
+
+    def add_many(self, rows):
+        """rows: [(id, 字节偏移, 长度), ...]"""
+        self._conn().executemany("INSERT OR IGNORE INTO chunks VALUES (?, ?, ?)", rows)
+
+    def commit(self):
+        self._conn().commit()
+
+    def rebuild(self):
+        """扫描已有的 JSONL 重建索引 (文件不是 chunk.py 写的、或者索引丢了的时候用)"""
+        self.reset()
+        rows = []
+        offset = 0
+        with open(self.jsonl_path, 'rb') as f:
+            for line in f:
+                try:
+                    c_id = json.loads(line).get("id")
+                except Exception:
+                    c_id = None
+                if c_id:
+                    rows.append((c_id, offset, len(line)))
+                offset += len(line)
+                if len(rows) >= 10000:
+                    self.add_many(rows)
+                    rows = []
+        self.add_many(rows)
+        self.commit()
+
+    def get(self, chunk_id):
+        """按 ID 读取整条切片记录，不存在返回 None"""
+        row = self._conn().execute("SELECT offset, length FROM chunks WHERE id = ?", (chunk_id,)).fetchone()
+        if row is None:
+            return None
+        if self._fh is None:
+            self._fh = open(self.jsonl_path, 'rb')
+        self._fh.seek(row[0])
+        return json.loads(self._fh.read(row[1]))
+
+    def get_text(self, chunk_id):
+        record = self.get(chunk_id)
+        return record.get("text") if record else None
+
+    def __contains__(self, chunk_id):
+        return self._conn().execute("SELECT 1 FROM chunks WHERE id = ?", (chunk_id,)).fetchone() is not None
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ================= 结果记录 =================
+def complete_qa_pairs(result):
+    """模型返回的 JSON 里完整的问答对 (问题和回答都有的 dict)"""
+    if not result:
+        return []
+    final_qas = result.get('qa_pairs', result) if isinstance(result, dict) else result
+    if not isinstance(final_qas, list):
+        return []
+    return [qa for qa in final_qas if isinstance(qa, dict)
+            and qa.get("instruction", qa.get("question")) and qa.get("output", qa.get("answer"))]
+
+def extract_qa_records(chunk_id, origin_text, result):
+    """把模型返回的 JSON 转成 sensor_physics_sft.jsonl 里的记录，所有 runner 统一格式"""
+    return [{
+        "source_chunk_id": chunk_id,
+        "instruction": qa.get("instruction", qa.get("question")),
+        "output": qa.get("output", qa.get("answer")),
+        "context_preview": origin_text[:50]
+    } for qa in complete_qa_pairs(result)]
+
+# ================= 模型输出 JSON 解码 =================
+# 反斜杠后面跟 b f n r t u 时既可能是 JSON 转义，也可能是没转义的 LaTeX (\frac 会被读成换页符 + "rac")。
+# 反斜杠后的整串字母是下面这些命令时按 LaTeX 保留；两个字母以内的短命令 (\nu \ne \to) 只在 $...$ 里才算
+LATEX_COMMANDS = frozenset("""
+    backslash bar beta begin big Big bigg Bigg bigl bigr Bigl Bigr binom bm bmod boldsymbol bot boxed breve bullet
+    flat forall frac frown
+    nabla natural ne nearrow neg neq newline nexists ngeq ni nleq nmid nolimits nonumber not nparallel nsim nu nwarrow
+    rangle rbrace rbrack rceil rfloor rho right rightarrow rightleftharpoons rm rvert rVert
+    tan tanh tau text textbf textit textrm textsf textstyle texttt tfrac therefore theta tilde times to top triangle tt
+    underline unit uparrow updownarrow upsilon
+""".split())
+_STRING_RUN = re.compile(r'[^"\\$\x00-\x1f]+')
+_ALPHA_RUN = re.compile(r'[A-Za-z]+')
+_HEX4 = re.compile(r'[0-9a-fA-F]{4}')
+_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+
+
+def repair_model_json(text):
+    """把模型输出修成合法的 JSON 文本，返回 (修好的文本, 是否从截断处补全)；找不到 JSON 时返回 (None, False)
+
+    - 去掉 ``` 代码块标记和 JSON 前后的说明文字
+    - 字符串里没转义的 LaTeX 反斜杠按字面保留，原始换行等控制字符转义
+    - 字符串里没转义的引号 (后面跟的不是 , : } ]) 按字面保留
+    - 去掉 } ] 前多余的逗号，数组里相邻元素漏掉的逗号补上
+    - 输出被截断时退回到最后一个完整的元素，再把没闭合的括号补齐
+    """
+    text = text.replace("```json", "").replace("```", "")
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        return None, False
+    out = []
+    stack = []
+    safe = None           # 截断时可以退回的位置：(len(out), len(stack))
+    in_string = math = False
+    i, n = min(starts), len(text)
+    while i < n:
+        ch = text[i]
+        if in_string:
+            m = _STRING_RUN.match(text, i)
+            if m:
+                out.append(m.group())
+                i = m.end()
+                continue
+            if ch == '"':
+                j = i + 1
+                while j < n and text[j] in " \t\r\n":
+                    j += 1
+                if j >= n or text[j] in ",:}]":
+                    in_string = False
+                    out.append('"')
+                else:
+                    out.append('\\"')
+            elif ch == "$":
+                math = not math
+                out.append("$")
+            elif ch == "\\":
+                nxt = text[i + 1] if i + 1 < n else ""
+                if nxt and nxt in '"\\/':
+                    out.append("\\" + nxt)
+                    i += 2
+                    continue
+                if nxt == "u" and _HEX4.match(text, i + 2):
+                    out.append(text[i:i + 6])
+                    i += 6
+                    continue
+                if nxt and nxt in "bfnrtu":
+                    run = _ALPHA_RUN.match(text, i + 1).group()
+                    latex = run in LATEX_COMMANDS and (len(run) > 2 or math)
+                    if not latex and nxt != "u":
+                        out.append("\\" + nxt)
+                        i += 2
+                        continue
+                # LaTeX 命令或者非法转义：反斜杠按字面保留
+                out.append("\\\\")
+            else:
+                out.append(_CONTROL_ESCAPES.get(ch) or "\\u%04x" % ord(ch))
+            i += 1
+            continue
+
+        if ch == '"' or ch in "{[":
+            if stack and stack[-1] == "[" and out and out[-1][-1] in '}]"':
+                out.append(",")
+            if ch == '"':
+                in_string, math = True, False
+                out.append('"')
+            else:
+                # 数组里刚开头的对象不算完整元素，截断时不要补出一个空的 {}
+                if not (ch == "{" and stack and stack[-1] == "["):
+                    safe = (len(out) + 1, len(stack) + 1)
+                stack.append(ch)
+                out.append(ch)
+        elif ch in "}]":
+            if not stack:
+                break
+            if out[-1] == ",":
+                out.pop()
+            out.append("}" if stack.pop() == "{" else "]")
+            if not stack:
+                return "".join(out), False
+            safe = (len(out), len(stack))
+        elif not ch.isspace():
+            out.append(ch)
+        i += 1
+
+    if safe is None:
+        return None, False
+    # 没有闭合：退回到最后一个完整元素之后，补上缺的括号
+    out = out[:safe[0]]
+    if out[-1] == ",":
+        out.pop()
+    out.extend("}" if b == "{" else "]" for b in reversed(stack[:safe[1]]))
+    return "".join(out), True
+
+
+def loads_model_json(text):
+    """宽容地解析模型输出的 JSON (LaTeX 友好、截断可恢复)，实在修不好抛 json.JSONDecodeError
+
+    截断的输出只保留已经闭合的问答对；一个完整的问答对都没剩下时同样抛 json.JSONDecodeError，
+    不能当成 "模型没出题" 的空结果 (那样切片会被记成 empty，不再重试)
+    """
+    stripped = text.replace("```json", "").replace("```", "").strip()
+    if "\\" not in stripped:
+        # 没有反斜杠就没有歧义，合法 JSON 直接走 C 实现
+        try:
+            return json.loads(stripped)
+        except json.JSONDecodeError:
+            pass
+    repaired, recovered = repair_model_json(stripped)
+    if repaired is None:
+        raise json.JSONDecodeError("输出里没有 JSON", text, 0)
+    result = json.loads(repaired)
+    if recovered and not complete_qa_pairs(result):
+        raise json.JSONDecodeError("输出被截断，没有完整的问答对", text, len(text))
+    return result
+
+
+# ================= 流式输出解析 =================
+class QAStreamParser:
+    """边接收边扫描模型输出的 JSON：数组里的对象一闭合就解析出来 (问答对可以提前拿到)，
+    同时检查输出是否已经退化 (大段重复、一直不出现 JSON)，退化时调用方可以提前断开连接不再付费。
+    扫描是增量的，每个字符只看一次
+    """
+
+    def __init__(self, loads=loads_model_json, repeat_chars=400, prose_chars=300, max_period=200):
+        self.loads = loads                # 解析单个对象用的函数 (可以先修复 LaTeX 转义)
+        self.repeat_chars = repeat_chars  # 末尾这么多字符按某个周期完全重复，判为复读
+        self.prose_chars = prose_chars    # 这么多个非空白字符之后还没出现 { 或 [，判为不是 JSON
+        self.max_period = max_period
+        self.pairs = []
+        self._parts = []
+        self._text = ""
+        self._pos = 0
+        self._stack = []                  # [(括号, 起始位置)]
+        self._in_string = False
+        self._escape = False
+        self._seen_json = False
+        self._prose = 0
+        self._next_repeat_check = repeat_chars
+
+    @property
+    def text(self):
+        if self._parts:
+            self._text += "".join(self._parts)
+            self._parts = []
+        return self._text
+
+    def feed(self, delta):
+        """送入一段增量文本，返回这段里新闭合的对象列表"""
+        if not delta:
+            return []
+        self._parts.append(delta)
+        text = self.text
+        found = []
+        stack = self._stack
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                self._seen_json = True
+                stack.append((ch, i))
+            elif ch in '}]':
+                if not stack:
+                    continue
+                opener, start = stack.pop()
+                # 只取最外层数组里的对象：{"qa_pairs": [ {...} ]} 或 [ {...} ]
+                if opener == '{' and ch == '}' and stack and stack[-1][0] == '[' and len(stack) <= 2:
+                    try:
+                        obj = self.loads(text[start:i + 1])
+                    except ValueError:
+                        continue
+                    if isinstance(obj, dict):
+                        self.pairs.append(obj)
+                        found.append(obj)
+            elif not self._seen_json and not ch.isspace() and ch != '`':
+                self._prose += 1
+        self._pos = len(text)
+        return found
+
+    def degenerate(self):
+        """输出已经没救了就返回原因，否则返回 None"""
+        if not self._seen_json and self._prose > self.prose_chars:
+            return "prose"
+        text = self.text
+        if len(text) >= self._next_repeat_check:
+            # 每多 1/4 窗口检查一次：末尾 repeat_chars 个字符是否以某个周期 p 完全重复
+            self._next_repeat_check = len(text) + self.repeat_chars // 4
+            n = self.repeat_chars
+            if len(text) >= n + 1:
+                tail = text[-n:]
+                for p in range(1, min(self.max_period, len(text) - n) + 1):
+                    if tail == text[-n - p:-p]:
+                        return f"repeat(period={p})"
+        return None
+
+
+async def stream_chat_completion(client, request, parser=None, abort_degenerate=True):
+    """以流式方式调用 chat.completions.create，返回和非流式相同的关键信息
+
+    返回 SimpleNamespace(content, finish_reason, usage, ttfb, pairs, aborted)：
+    ttfb 为首个内容片段到达的时间，pairs 为流式过程中已经闭合的问答对，
+    aborted 为提前断开的原因 (None 表示正常结束)。平台不返回流式 usage 时 usage 为 None
+    """
+    parser = parser or QAStreamParser()
+    started = time.monotonic()
+    ttfb = None
+    finish_reason = None
+    usage = None
+    aborted = None
+    stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **request)
+    try:
+        async for event in stream:
+            if getattr(event, "usage", None):
+                usage = event.usage
+            if not event.choices:
+                continue
+            choice = event.choices[0]
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+            delta = choice.delta.content if choice.delta else None
+            if not delta:
+                continue
+            if ttfb is None:
+                ttfb = time.monotonic() - started
+            parser.feed(delta)
+            if abort_degenerate:
+                aborted = parser.degenerate()
+                if aborted:
+                    break
+    finally:
+        # 提前退出时关掉连接，平台就不再继续生成
+        await stream.close()
+    return SimpleNamespace(content=parser.text, finish_reason=finish_reason, usage=usage,
+                           ttfb=ttfb, pairs=parser.pairs, aborted=aborted)
+
+# ================= 流式调度 =================
+_DONE = object()
+
+
+async def run_pipeline(items, handle, write, concurrency, queue_size=None, retry=None):
+    """读取协程 -> concurrency 个 worker -> 单个写入协程
+
+    items:  普通迭代器/生成器，按需惰性读取，不会一次性装进内存
+    handle: async 函数，处理单个 item 并返回结果
+    write:  普通函数，只在写入协程里串行调用，写文件不需要加锁
+    retry:  RetryQueue (可选)。handle 里把失败的切片 offer 进去，items 读完之后再把它们送回 worker，
+            直到没有在途的 item、重试队列也空了才结束
+    队列有界，内存占用只跟并发数有关，跟语料大小无关
+    """
+    queue_size = queue_size or concurrency * 2
+    in_q = asyncio.Queue(maxsize=queue_size)
+    out_q = asyncio.Queue(maxsize=queue_size)
+    pending = 0                # 已送进 in_q、还没处理完的 item
+    finished = asyncio.Event()  # 每处理完一个 item 置位，唤醒等待重试的读取协程
+
+    async def reader():
+        nonlocal pending
+        for item in items:
+            pending += 1
+            await in_q.put(item)
+            # 队列没满时 put 不会让出控制权，手动让一下，第一个请求才能立刻发出去
+            await asyncio.sleep(0)
+        while retry is not None:
+            task = retry.pop_ready()
+            if task is not None:
+                pending += 1
+                await in_q.put(task)
+                continue
+            if pending == 0 and not retry:
+                break
+            # 在途的 item 可能还会产生新的重试；没有到时间的重试等到点再送
+            finished.clear()
+            try:
+                await asyncio.wait_for(finished.wait(), timeout=retry.wait_time())
+            except asyncio.TimeoutError:
+                pass
+        for _ in range(concurrency):
+            await in_q.put(_DONE)
+
+    async def worker():
+        nonlocal pending
+        while True:
+            item = await in_q.get()
+            if item is _DONE:
+                return
+            await out_q.put(await handle(item))
+            pending -= 1
+            finished.set()
+
+    async def writer():
+        while True:
+            res = await out_q.get()
+            if res is _DONE:
+                return
+            write(res)
+
+    tasks = [asyncio.create_task(reader())]
+    tasks += [asyncio.create_task(worker()) for _ in range(concurrency)]
+    writer_task = asyncio.create_task(writer())
+
+    async def producers():
+        await asyncio.gather(*tasks)
+        await out_q.put(_DONE)
+
+    try:
+        await asyncio.gather(producers(), writer_task)
+    finally:
+        for t in tasks + [writer_task]:
+            t.cancel()
+
+
+# ================= 延后重试队列 =================
+# 失败原因 (与遥测的 outcome 同名) -> 重试策略，不在表里的原因不重试：
+#   delay              重新发出前至少等多久 (秒)，第 n 次重试等 delay * n
+#   timeout_factor     每次重试把超时时间乘以多少
+#   max_tokens_factor  每次重试把 max_tokens 乘以多少
+#   repair             把上次的坏输出连同修复提示词发回去，让模型只改格式
+RETRY_POLICIES = {
+    "rate_limited": {"delay": 5.0},
+    "timeout": {"timeout_factor": 1.5},
+    "truncated": {"max_tokens_factor": 1.5},
+    "json_error": {"repair": True},
+    "aborted": {},
+    "api_error": {"delay": 2.0},
+}
+
+
+class RetryTask:
+    """排到末尾重试的切片：原始 item + 第几次重试 + 这次请求要用的参数"""
+
+    def __init__(self, item, attempt, reason, timeout_factor=1.0, max_tokens_factor=1.0, repair_text=None,
+                 not_before=0.0):
+        self.item = item
+        self.attempt = attempt
+        self.reason = reason
+        self.timeout_factor = timeout_factor
+        self.max_tokens_factor = max_tokens_factor
+        self.repair_text = repair_text
+        self.not_before = not_before
+
+
+class RetryQueue:
+    """失败的切片不当场重试 (不占 worker、不拖慢主流程)，而是排到输入流的末尾，按失败原因换参数再试
+
+    每个切片最多重试 max_attempts 次；重试总数不超过 max(min_budget, budget_ratio * 首轮切片数)，
+    接口整体出问题时不会把请求量翻倍
+    """
+
+    def __init__(self, max_attempts=2, budget_ratio=0.2, min_budget=10, policies=None):
+        self.max_attempts = max_attempts
+        self.budget_ratio = budget_ratio
+        self.min_budget = min_budget
+        self.policies = dict(RETRY_POLICIES, **(policies or {}))
+        self._tasks = deque()
+        self.first_pass = 0
+        self.retries = {}     # 原因 -> 重试次数
+        self.recovered = 0    # 重试后成功的切片
+        self.gave_up = 0      # 次数或预算用完，放弃的切片
+
+    def __len__(self):
+        return len(self._tasks)
+
+    @property
+    def budget(self):
+        return max(self.min_budget, int(self.budget_ratio * self.first_pass))
+
+    def offer(self, item, reason=None, repair_text=None):
+        """handle 处理完一个切片后调用：reason 为 None 表示成功。返回 True 表示已排进重试队列，这次结果不要写出"""
+        prev = item if isinstance(item, RetryTask) else None
+        if prev is None:
+            self.first_pass += 1
+        if reason is None:
+            if prev is not None:
+                self.recovered += 1
+            return False
+        policy = self.policies.get(reason)
+        attempt = prev.attempt + 1 if prev else 1
+        if policy is None:
+            return False
+        if attempt > self.max_attempts or sum(self.retries.values()) >= self.budget:
+            self.gave_up += 1
+            return False
+        self.retries[reason] = self.retries.get(reason, 0) + 1
+        self._tasks.append(RetryTask(
+            prev.item if prev else item, attempt, reason,
+            timeout_factor=(prev.timeout_factor if prev else 1.0) * policy.get("timeout_factor", 1.0),
+            max_tokens_factor=(prev.max_tokens_factor if prev else 1.0) * policy.get("max_tokens_factor", 1.0),
+            repair_text=repair_text if policy.get("repair") else None,
+            not_before=time.monotonic() + policy.get("delay", 0.0) * attempt,
+        ))
+        return True
+
+    def pop_ready(self):
+        """取出一个已经到时间的重试，没有则返回 None"""
+        now = time.monotonic()
+        for _ in range(len(self._tasks)):
+            task = self._tasks.popleft()
+            if task.not_before <= now:
+                return task
+            self._tasks.append(task)
+        return None
+
+    def wait_time(self):
+        """距离最早一个重试到时间还有多久；队列为空返回 None"""
+        if not self._tasks:
+            return None
+        return max(0.0, min(t.not_before for t in self._tasks) - time.monotonic())
+
+    def summary(self):
+        detail = ", ".join(f"{k} {v}" for k, v in sorted(self.retries.items(), key=lambda kv: -kv[1]))
+        return (f"🔁 延后重试: {sum(self.retries.values())} 次 ({detail or '无'}) | "
+                f"重试后成功 {self.recovered} | 放弃 {self.gave_up} | 预算 {self.budget}")
+
+
+# ================= 自适应并发 (AIMD) =================
+class AdaptiveLimiter:
+    """替代固定的 asyncio.Semaphore，在 [min_limit, max_limit] 之间自动调节并发
+
+    - 遇到 429 或 p95 延迟明显高于基线：并发乘以 decrease (乘性下降)
+    - 一切正常：每完成约 limit 个请求，并发 +1 (加性增长)
+    min_limit == max_limit 时退化为固定并发
+    """
+
+    def __init__(self, initial, min_limit=1, max_limit=None, decrease=0.5,
+                 latency_window=100, latency_tolerance=2.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit or initial
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self._limit = float(min(max(initial, min_limit), self.max_limit))
+        self._latencies = deque(maxlen=latency_window)
+        self._new_samples = 0
+        self._baseline_p95 = None
+        self._last_cut = 0.0
+        self._in_flight = 0
+        self._waiters = deque()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    async def acquire(self):
+        if not self._waiters and self._in_flight < self.limit:
+            self._in_flight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # 名额已经分配下来但协程被取消了，要还回去
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self._in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self._in_flight < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self._in_flight += 1
+                fut.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+    def _cut(self):
+        # 同一波 429 / 慢请求只降一次：冷却时间取最近的中位延迟，至少 1 秒
+        now = time.monotonic()
+        cooldown = max(1.0, self.percentile(0.5) or 0.0)
+        if now - self._last_cut < cooldown:
+            return
+        self._last_cut = now
+        self._limit = max(self.min_limit, self._limit * self.decrease)
+        # 降档后重新采样，旧窗口里的延迟是在高并发下测的
+        self._latencies.clear()
+        self._new_samples = 0
+
+    def percentile(self, q):
+        if not self._latencies:
+            return None
+        data = sorted(self._latencies)
+        return data[min(len(data) - 1, int(len(data) * q))]
+
+    def record_throttle(self):
+        """收到 429"""
+        self._cut()
+
+    def record_latency(self, seconds):
+        """一次请求结束 (超时的请求按超时时间记)"""
+        self._latencies.append(seconds)
+        self._new_samples += 1
+        window = self._latencies.maxlen
+        if len(self._latencies) == window and self._new_samples >= window // 4:
+            self._new_samples = 0
+            p95 = self.percentile(0.95)
+            if self._baseline_p95 is None or p95 < self._baseline_p95:
+                self._baseline_p95 = p95
+            elif p95 > self._baseline_p95 * self.latency_tolerance:
+                self._cut()
+                return
+        self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+        self._wake()
+
+
+# ================= 精确 token 计数 =================
+class TokenCounter:
+    """用目标模型的 tokenizer.json (HuggingFace tokenizers 格式，事先下载到本地) 精确计数
+
+    没有 tokenizer 文件或没装 tokenizers 时退回按字符估算。估算用的 "每 token 字数"
+    可以用 calibrate() 拿真实 tokenizer 拟合后存进 calibration_file，之后在没有 tokenizer 的机器上也能用
+    """
+
+    DEFAULT_RATIOS = {"non_ascii": 1.5, "ascii": 4.0}
+
+    def __init__(self, tokenizer_file="", calibration_file=""):
+        self.tokenizer = None
+        self.calibration_file = calibration_file
+        if tokenizer_file and os.path.exists(tokenizer_file):
+            try:
+                from tokenizers import Tokenizer
+                self.tokenizer = Tokenizer.from_file(tokenizer_file)
+            except ImportError:
+                print("⚠️ 没有安装 tokenizers (pip install tokenizers)，token 数改为估算")
+        self.ratios = dict(self.DEFAULT_RATIOS)
+        if calibration_file and os.path.exists(calibration_file):
+            with open(calibration_file, 'r', encoding='utf-8') as f:
+                self.ratios.update(json.load(f))
+
+    @property
+    def exact(self):
+        return self.tokenizer is not None
+
+    def estimate(self, text):
+        non_ascii = len(text) - len(text.encode('ascii', 'ignore'))
+        return int(non_ascii / self.ratios["non_ascii"] + (len(text) - non_ascii) / self.ratios["ascii"]) + 1
+
+    def count_batch(self, texts):
+        """批量计数：tokenizers 的 encode_batch 在 Rust 里多线程执行，比逐条调用快得多"""
+        if self.tokenizer is None:
+            return [self.estimate(t) for t in texts]
+        return [len(enc.ids) for enc in self.tokenizer.encode_batch(list(texts), add_special_tokens=False)]
+
+    def count(self, text):
+        return self.count_batch([text])[0]
+
+    def calibrate(self, texts):
+        """用真实 tokenizer 拟合 token ≈ 非ASCII字数 / a + ASCII字数 / b，结果写入 calibration_file"""
+        if self.tokenizer is None or not texts:
+            return False
+        # 最小二乘 (无截距)：解 2x2 正规方程
+        xs = [(len(t) - len(t.encode('ascii', 'ignore')), len(t.encode('ascii', 'ignore'))) for t in texts]
+        ys = self.count_batch(texts)
+        s11 = sum(u * u for u, _ in xs)
+        s12 = sum(u * v for u, v in xs)
+        s22 = sum(v * v for _, v in xs)
+        b1 = sum(u * y for (u, _), y in zip(xs, ys))
+        b2 = sum(v * y for (_, v), y in zip(xs, ys))
+        det = s11 * s22 - s12 * s12
+        if det <= 0:
+            return False
+        k1 = (b1 * s22 - b2 * s12) / det
+        k2 = (s11 * b2 - s12 * b1) / det
+        # 某一类字符样本太少时拟合不稳定，保留默认值
+        if k1 > 0:
+            self.ratios["non_ascii"] = round(1 / k1, 4)
+        if k2 > 0:
+            self.ratios["ascii"] = round(1 / k2, 4)
+        if self.calibration_file:
+            with open(self.calibration_file, 'w', encoding='utf-8') as f:
+                json.dump(self.ratios, f)
+        return True
+
+
+# ================= RPM / TPM 限速 =================
+class _Bucket:
+    # 容量 capacity + 每秒补充 rate，且 capacity + 60*rate == per_minute，
+    # 所以任意 60 秒窗口内放行的总量都不会超过 per_minute
+    def __init__(self, per_minute, burst):
+        self.capacity = per_minute * burst
+        self.rate = (per_minute - self.capacity) / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # 单个请求比桶还大时，只要求桶满即可放行，否则会永远等下去
+        deficit = min(amount, self.capacity) - self.level
+        return max(0.0, deficit / self.rate)
+
+
+class RateLimiter:
+    """所有 worker 共享的 RPM + TPM 双令牌桶
+
+    acquire(tokens) 按预估 token (prompt + max_tokens) 预扣，
+    拿到 response.usage 之后调用 reconcile 多退少补。
+    rpm / tpm 为 0 表示不限制。
+    """
+
+    def __init__(self, rpm=0, tpm=0, burst=0.1):
+        burst = min(max(burst, 0.0), 0.9)
+        self._req = _Bucket(rpm, burst) if rpm else None
+        self._tok = _Bucket(tpm, burst) if tpm else None
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self._req or self._tok)
+
+    async def acquire(self, tokens):
+        if not self.enabled:
+            return tokens
+        # 加锁排队，先来先放行，避免大请求一直被小请求插队
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                wait = 0.0
+                if self._req:
+                    self._req.refill(now)
+                    wait = max(wait, self._req.wait_time(1))
+                if self._tok:
+                    self._tok.refill(now)
+                    wait = max(wait, self._tok.wait_time(tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self._req:
+                self._req.level -= 1
+            if self._tok:
+                self._tok.level -= tokens
+        return tokens
+
+    def reconcile(self, reserved, actual):
+        """用真实用量修正预扣的 token 数，actual 大于预扣时桶可以暂时为负"""
+        if self._tok and actual is not None:
+            self._tok.refill(time.monotonic())
+            self._tok.level = min(self._tok.capacity, self._tok.level + reserved - actual)
+
+
+# ================= Prompt 前缀缓存统计 =================
+def _field(obj, key):
+    # response.usage 可能是 SDK 对象，也可能是 dict (离线/模拟接口)
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(key)
+    return getattr(obj, key, None)
+
+
+def cached_prompt_tokens(usage):
+    """命中缓存的 prompt token 数
+
+    DeepSeek: usage.prompt_cache_hit_tokens
+    OpenAI 兼容接口: usage.prompt_tokens_details.cached_tokens
+    """
+    hit = _field(usage, "prompt_cache_hit_tokens")
+    if hit is None:
+        hit = _field(_field(usage, "prompt_tokens_details"), "cached_tokens")
+    return hit or 0
+
+
+class UsageStats:
+    """累计 token 用量与前缀缓存命中情况，结束时打印节省了多少钱和时间"""
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self._latency = {True: [0, 0.0], False: [0, 0.0]}  # 是否命中 -> [次数, 总延迟]
+
+    def record(self, usage, latency):
+        if usage is None:
+            return
+        cached = cached_prompt_tokens(usage)
+        self.requests += 1
+        self.prompt_tokens += _field(usage, "prompt_tokens") or 0
+        self.completion_tokens += _field(usage, "completion_tokens") or 0
+        self.cached_tokens += cached
+        bucket = self._latency[cached > 0]
+        bucket[0] += 1
+        bucket[1] += latency
+
+    @property
+    def hit_rate(self):
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def mean_latency(self, hit):
+        n, total = self._latency[hit]
+        return total / n if n else None
+
+    def summary(self, price_input_per_m, price_cache_hit_per_m):
+        saved_money = self.cached_tokens * (price_input_per_m - price_cache_hit_per_m) / 1e6
+        lines = [
+            f"Prompt 缓存命中率: {self.hit_rate * 100:.1f}% "
+            f"({self.cached_tokens}/{self.prompt_tokens} tokens, {self.requests} 次请求)",
+            f"缓存节省费用: 约 {saved_money:.2f} 元",
+        ]
+        hit_lat, miss_lat = self.mean_latency(True), self.mean_latency(False)
+        if hit_lat is not None and miss_lat is not None:
+            saved_time = (miss_lat - hit_lat) * self._latency[True][0]
+            lines.append(f"平均延迟: 命中 {hit_lat:.2f}s / 未命中 {miss_lat:.2f}s，累计节省约 {saved_time:.0f}s")
+        return "\n".join(lines)
+
+
+# ================= 请求级遥测 =================
+# 每个请求结束后追加一行事件，outcome 取值：
+#   ok            返回并解析成功
+#   truncated     finish_reason == "length"，输出被 max_tokens 截断，JSON 不完整
+#   json_error    返回了但 JSON 解析失败
+#   timeout       超时被斩杀
+#   aborted       流式输出已经退化 (复读、不是 JSON)，提前断开
+#   rate_limited  429
+#   api_error     其他 API / 网络错误
+TELEMETRY_OUTCOMES = ("ok", "truncated", "json_error", "aborted", "timeout", "rate_limited", "api_error")
+
+
+def _pct(data, q):
+    if not data:
+        return None
+    return data[min(len(data) - 1, int(len(data) * q))]
+
+
+class Telemetry:
+    """请求级事件日志 (JSONL) + 定期打印最近一段时间的吞吐和延迟分位数
+
+    path 为空时不写文件，只做汇总。printer 用 tqdm.write 可以不打乱进度条。
+    raw_path 不为空时另外记录每次请求的原始输出，作为 bench_json_repair.py 的语料
+    """
+
+    def __init__(self, path="", summary_interval=30.0, window=60.0, printer=print, raw_path=""):
+        self.path = path
+        self.raw_path = raw_path
+        self.summary_interval = summary_interval
+        self.window = window
+        self.printer = printer
+        self.totals = dict.fromkeys(TELEMETRY_OUTCOMES, 0)
+        self._recent = deque()  # (结束时间, outcome, 延迟, 排队, 输出 token 数)
+        self._fh = None
+        self._raw_fh = None
+        self._started = time.monotonic()
+        self._last_print = self._started
+
+    def open(self):
+        if self.path:
+            self._fh = open(self.path, 'a', encoding='utf-8')
+        if self.raw_path:
+            self._raw_fh = open(self.raw_path, 'a', encoding='utf-8')
+        return self
+
+    def close(self):
+        for fh in (self._fh, self._raw_fh):
+            if fh:
+                fh.close()
+        self._fh = self._raw_fh = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, chunk_id, outcome, latency, queue_wait=None, ttfb=None, usage=None,
+               finish_reason=None, retry=0, error=None, salvaged=0, endpoint=None):
+        completion = _field(usage, "completion_tokens")
+        event = {
+            "ts": round(time.time(), 3),
+            "chunk_id": chunk_id,
+            "outcome": outcome,
+            "queue_wait": None if queue_wait is None else round(queue_wait, 3),
+            "ttfb": None if ttfb is None else round(ttfb, 3),
+            "latency": round(latency, 3),
+            "prompt_tokens": _field(usage, "prompt_tokens"),
+            "completion_tokens": completion,
+            "cached_tokens": cached_prompt_tokens(usage) if usage is not None else None,
+            "finish_reason": finish_reason,
+            "retry": retry,
+        }
+        if endpoint:
+            event["endpoint"] = endpoint
+        if salvaged:
+            # 整体解析失败，但流式解析已经拿到了这么多个完整的问答对
+            event["salvaged"] = salvaged
+        if error:
+            event["error"] = str(error)[:200]
+        if self._fh:
+            self._fh.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self._fh.flush()
+        self.totals[outcome] = self.totals.get(outcome, 0) + 1
+        now = time.monotonic()
+        self._recent.append((now, outcome, latency, queue_wait or 0.0, completion or 0))
+        while self._recent and self._recent[0][0] < now - self.window:
+            self._recent.popleft()
+        if self.summary_interval and now - self._last_print >= self.summary_interval:
+            self._last_print = now
+            self.printer(self.summary())
+
+    def record_raw(self, chunk_id, content, finish_reason=None):
+        """记录一次请求的原始输出 (解析之前)"""
+        if self._raw_fh:
+            self._raw_fh.write(json.dumps({"chunk_id": chunk_id, "finish_reason": finish_reason, "content": content},
+                                          ensure_ascii=False) + "\n")
+
+    def summary(self):
+        """最近 window 秒的滚动统计"""
+        events = list(self._recent)
+        if not events:
+            return f"📊 最近 {self.window:.0f}s 没有请求结束"
+        span = min(self.window, max(time.monotonic() - self._started, 1e-9))
+        counts = {}
+        for _, outcome, _, _, _ in events:
+            counts[outcome] = counts.get(outcome, 0) + 1
+        shares = " · ".join(f"{k} {v / len(events):.0%}" for k, v in sorted(counts.items(), key=lambda kv: -kv[1]))
+        # 429 是立刻返回的，不算进延迟分布
+        lat = sorted(e[2] for e in events if e[1] != "rate_limited")
+        wait = sorted(e[3] for e in events)
+        tokens = sum(e[4] for e in events)
+        line = f"📊 最近 {span:.0f}s: {len(events) / span * 60:.1f} 请求/分 | {shares}"
+        if lat:
+            line += f" | 延迟 p50 {_pct(lat, 0.5):.1f}s p95 {_pct(lat, 0.95):.1f}s p99 {_pct(lat, 0.99):.1f}s"
+        line += f" | 排队 p50 {_pct(wait, 0.5):.2f}s | 输出 {tokens / span:.0f} tok/s"
+        return line
+
+    def totals_summary(self):
+        total = sum(self.totals.values())
+        parts = " | ".join(f"{k} {v} ({v / max(total, 1):.1%})" for k, v in self.totals.items() if v)
+        return f"请求结果: 共 {total} 次 | {parts}" if total else "请求结果: 没有发出请求"
+
+
+# ================= 对冲请求 (hedging) =================
+class Hedger:
+    """请求超过近期 p90 延迟还没返回，就再发一份，谁先回来用谁，另一个取消
+
+    对冲请求总数不超过 max_ratio * 总请求数，避免拥堵时雪上加霜
+    """
+
+    def __init__(self, quantile=0.9, max_ratio=0.05, window=200, min_samples=20, min_delay=1.0):
+        self.quantile = quantile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def delay(self):
+        """发出对冲前要等多久；样本不够时返回 None (不对冲)"""
+        if len(self._latencies) < self.min_samples:
+            return None
+        data = sorted(self._latencies)
+        return max(self.min_delay, data[min(len(data) - 1, int(len(data) * self.quantile))])
+
+    async def run(self, make_call):
+        """make_call(attempt) 返回一个协程，attempt=0 为原请求，1 为对冲请求"""
+        self.requests += 1
+        started = time.monotonic()
+        primary = asyncio.ensure_future(make_call(0))
+        tasks = {primary}
+        try:
+            delay = self.delay()
+            if delay is not None:
+                await asyncio.wait(tasks, timeout=delay)
+                if not primary.done() and self.hedges < self.max_ratio * self.requests:
+                    self.hedges += 1
+                    tasks.add(asyncio.ensure_future(make_call(1)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        if t is not primary:
+                            self.hedge_wins += 1
+                        self._latencies.append(time.monotonic() - started)
+                        return t.result()
+                    error = t.exception()
+            # 两份都失败了，抛出最后一个错误
+            raise error
+        finally:
+            for t in tasks:
+                t.cancel()
+
+
+# ================= 多端点路由 =================
+# ENDPOINTS 配置里每一项的字段，没写的用这里的默认值：
+#   name               显示用的名字 (留空为 模型@序号)
+#   base_url / api_key / model
+#   weight             分流权重，实际按 权重 × 空闲并发名额 随机分配
+#   concurrency        这个端点的并发上限 (自适应并发在它以内调节)
+#   rpm / tpm          这个 key 的限速，0 表示不限制
+#   probe              是否用 models.list() 探活 (平台不支持 /models 时设为 False)
+ENDPOINT_DEFAULTS = {"name": "", "base_url": "", "api_key": "", "model": "", "weight": 1.0, "concurrency": 10,
+                     "rpm": 0, "tpm": 0, "probe": True}
+
+
+def _pooled_http_client(size, keepalive):
+    """连接池按端点并发开够，空闲连接保留 keepalive 秒 (SDK 默认 5 秒就断，下一波请求又要重新握手)；没装 httpx 时用 SDK 默认"""
+    try:
+        import httpx
+        from openai import DefaultAsyncHttpxClient
+    except ImportError:
+        return None
+    return DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=size * 2, max_keepalive_connections=size,
+                                                       keepalive_expiry=keepalive))
+
+
+class Endpoint:
+    """一个 (平台, key, 模型)：自己的客户端连接池、自适应并发、RPM / TPM 额度和健康状态"""
+
+    def __init__(self, name, base_url, api_key, model, weight=1.0, concurrency=10, rpm=0, tpm=0,
+                 initial_concurrency=None, min_concurrency=1, probe=True, keepalive=120.0):
+        from openai import AsyncOpenAI
+        self.name = name
+        self.model = model
+        self.weight = weight
+        self.probe = probe
+        self.limiter = AdaptiveLimiter(initial_concurrency or concurrency, min_concurrency, concurrency)
+        self.rate_limiter = RateLimiter(rpm, tpm)
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url,
+                                  http_client=_pooled_http_client(concurrency, keepalive))
+        self.healthy = True
+        self.failures = 0          # 连续失败次数 (429 不算)
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+
+def make_endpoints(configs, adaptive=True, initial_concurrency=None, min_concurrency=1):
+    """把 ENDPOINTS 配置转成 Endpoint 列表。adaptive=False 时每个端点固定用自己的 concurrency"""
+    endpoints = []
+    for i, cfg in enumerate(configs, 1):
+        unknown = set(cfg) - set(ENDPOINT_DEFAULTS)
+        if unknown:
+            raise ValueError(f"ENDPOINTS 第 {i} 项有未知字段: {sorted(unknown)}")
+        c = dict(ENDPOINT_DEFAULTS, **cfg)
+        limit = c["concurrency"]
+        initial = min(initial_concurrency or limit, limit) if adaptive else limit
+        floor = min(min_concurrency, limit) if adaptive else limit
+        endpoints.append(Endpoint(c["name"] or f"{c['model']}@{i}", c["base_url"], c["api_key"], c["model"],
+                                  c["weight"], limit, c["rpm"], c["tpm"], initial, floor, c["probe"]))
+    return endpoints
+
+
+class Router:
+    """在多个端点之间分配请求：吞吐随 key / 平台数量叠加，单个平台出问题不会拖住整个流程
+
+    - 按 权重 × 空闲并发名额 随机挑端点，名额都满时按权重排队
+    - 连续失败 failure_threshold 次 (超时、5xx、连接错误；429 交给各端点自己的自适应并发) 的端点冷却 cooldown 秒
+    - 启动时和之后每 probe_interval 秒用 models.list() 探活 (同 check_models.py)，顺便让连接池保持热连接
+    - 所有端点都不可用时照样按权重分配，不让流程停下
+    用法: async with router: ...
+    """
+
+    def __init__(self, endpoints, failure_threshold=3, cooldown=30.0, probe_interval=60.0, probe_timeout=10.0,
+                 warm_connections=4, printer=print):
+        self.endpoints = list(endpoints)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.warm_connections = warm_connections
+        self.printer = printer
+        self._rng = random.Random()
+        self._task = None
+
+    @property
+    def limit(self):
+        """当前总并发 (各端点自适应并发之和)"""
+        return sum(ep.limiter.limit for ep in self.endpoints)
+
+    @property
+    def max_limit(self):
+        return sum(ep.limiter.max_limit for ep in self.endpoints)
+
+    def available(self):
+        now = time.monotonic()
+        return [ep for ep in self.endpoints if ep.healthy and ep.cooldown_until <= now]
+
+    def pick(self):
+        candidates = self.available() or self.endpoints
+        weights = [ep.weight * max(ep.limiter.limit - ep.limiter.in_flight, 0) for ep in candidates]
+        if not any(weights):
+            weights = [ep.weight for ep in candidates]
+        return self._rng.choices(candidates, weights)[0]
+
+    def report(self, ep, ok, throttled=False):
+        """请求结束后调用：ok 表示端点正常返回了内容 (内容能不能解析不归端点管)"""
+        ep.requests += 1
+        if ok:
+            ep.failures = 0
+            return
+        ep.errors += 1
+        if throttled:
+            return
+        ep.failures += 1
+        now = time.monotonic()
+        if ep.failures >= self.failure_threshold and ep.cooldown_until <= now:
+            ep.cooldown_until = now + self.cooldown
+            self.printer(f"⚠️ 端点 {ep.name} 连续失败 {ep.failures} 次，{self.cooldown:.0f}s 内不再分配请求")
+
+    async def check(self, ep, connections=1):
+        """探活：并发发 connections 个 models.list()，同时把这么多条连接建好。返回错误信息，正常返回 None"""
+        if not ep.probe:
+            return None
+        # 探活不走 SDK 的自动重试，宕机的端点在 probe_timeout 内就判定下线 (连接池仍和 ep.client 共用)
+        client = ep.client.with_options(max_retries=0, timeout=self.probe_timeout)
+        try:
+            # return_exceptions=True：超时取消、或者其中一个先失败时，其余请求的异常也都被取走，不会报
+            # "exception was never retrieved"
+            pages = await asyncio.wait_for(
+                asyncio.gather(*(client.models.list() for _ in range(connections)), return_exceptions=True),
+                self.probe_timeout)
+            failed = [p for p in pages if isinstance(p, BaseException)]
+            if failed:
+                raise failed[0]
+            ids = [m.id for m in pages[0].data]
+            if ids and ep.model not in ids:
+                raise ValueError(f"平台上没有模型 {ep.model}")
+        except Exception as e:
+            ep.healthy = False
+            return str(e)[:120] or type(e).__name__
+        if not ep.healthy:
+            self.printer(f"✅ 端点 {ep.name} 恢复")
+        ep.healthy = True
+        ep.failures = 0
+        ep.cooldown_until = 0.0
+        return None
+
+    async def warm_up(self):
+        """启动时检查所有端点，并预先建好 warm_connections 条连接"""
+        errors = await asyncio.gather(*(self.check(ep, min(self.warm_connections, ep.limiter.max_limit))
+                                        for ep in self.endpoints))
+        for ep, err in zip(self.endpoints, errors):
+            status = f"❌ {err}" if err else ("✅" if ep.probe else "⚪️ 不探活")
+            self.printer(f"   端点 {ep.name}: {ep.model} | 权重 {ep.weight} | 并发 {ep.limiter.max_limit} | {status}")
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            await asyncio.gather(*(self.check(ep) for ep in self.endpoints))
+
+    async def __aenter__(self):
+        await self.warm_up()
+        if self.probe_interval:
+            self._task = asyncio.create_task(self._health_loop())
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._task:
+            self._task.cancel()
+        for ep in self.endpoints:
+            await ep.client.close()
+
+    def summary(self):
+        lines = ["🌐 端点统计:"]
+        for ep in self.endpoints:
+            share = ep.requests / max(sum(e.requests for e in self.endpoints), 1)
+            lines.append(f"   {ep.name}: 请求 {ep.requests} ({share:.0%}) | 失败 {ep.errors} | "
+                         f"结束时并发 {ep.limiter.limit} | {'健康' if ep.healthy else '不可用'}")
+        return "\n".join(lines)
@@ -0,0 +1,293 @@
+import json
+import os
+import time
+from openai import OpenAI
+from gen_utils import ChunkManifest, complete_qa_pairs, extract_qa_records, loads_model_json
+# Prompt 与 RHS 保持一致，改 Prompt 只需要改 run_hyper_speed.py (JSON 解析同样用 gen_utils.loads_model_json)
+from run_hyper_speed import SYSTEM_PROMPT, USER_PROMPT_PREFIX, text_in_range
+
+# ================= 1. 📦 批量接口 (Batch API) 配置 =================
+# 不需要实时返回的大批量构建：价格约为实时接口的一半，吞吐额度也高得多
+API_KEY = ""  # <--- 【必填】
+BASE_URL = ""    # 需要平台支持 OpenAI 兼容的 /files + /batches 接口
+MODEL_NAME = ""
+# 本地离线测试：先运行 fake_batch_server.py，再把 BASE_URL 设为 "http://127.0.0.1:8765/v1"
+
+# 输出长度，与 RHS 保持一致即可；输入长度过滤直接沿用 RHS 的 MIN/MAX_TEXT_LENGTH 和 MIN/MAX_TEXT_TOKENS
+MAX_OUTPUT_TOKENS = 1280
+
+# 分片限制：按平台对单个批量文件的限制填写 (OpenAI: 50000 条 / 200MB)
+SHARD_MAX_REQUESTS = 50000
+SHARD_MAX_BYTES = 100 * 1024 * 1024
+# 同时在平台排队的分片数，避免超出平台的排队 token 额度
+MAX_ACTIVE_SHARDS = 5
+COMPLETION_WINDOW = "24h"
+POLL_INTERVAL = 60  # 秒
+# 出错 / 过期没返回的切片会排进新的分片重试；同一个切片最多进几个分片 (首次 + 重试)
+# 超过之后清单里仍是 batch_error，换 RHS / DSP 续跑时会接着重试
+BATCH_MAX_ATTEMPTS = 3
+
+WORK_DIR = r""
+INPUT_FILE = os.path.join(WORK_DIR, "domain_chunks.jsonl")
+OUTPUT_FILE = os.path.join(WORK_DIR, "sensor_physics_sft.jsonl")
+# 与 DSP / RHS 共用同一个清单，三种模式可以交替续跑
+MANIFEST_FILE = os.path.join(WORK_DIR, "chunk_manifest.jsonl")
+BATCH_DIR = os.path.join(WORK_DIR, "batch_jobs")
+STATE_FILE = os.path.join(BATCH_DIR, "batch_state.json")
+
+# 分片状态: prepared -> submitted -> merged
+# 平台返回 failed / expired / cancelled 时也会合并已有结果；出错和缺失的切片记为 batch_error
+# (单独一个状态：续跑时不会被跳过，批量模式还要按它把切片重新排进新分片)
+FINAL_BATCH_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# ================= 2. 状态文件 =================
+def load_state():
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {"shards": {}}
+
+def save_state(state):
+    # 先写临时文件再替换，中途崩溃不会留下半个状态文件
+    tmp = STATE_FILE + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, STATE_FILE)
+
+# ================= 3. 生成分片 =================
+def build_request(chunk_id, text):
+    return {
+        "custom_id": str(chunk_id),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": MODEL_NAME,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": USER_PROMPT_PREFIX + text}
+            ],
+            "temperature": 0.3,
+            "max_tokens": MAX_OUTPUT_TOKENS,
+            "response_format": {"type": "json_object"}
+        }
+    }
+
+def iter_shard_requests(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except Exception:
+                pass
+
+def scan_shards(state):
+    """读一遍已有的分片文件：每个切片进过几个分片，以及还在平台排队 (没合并) 的切片。只在启动时调用一次"""
+    queued, in_flight = {}, set()
+    for shard in state["shards"].values():
+        for req in iter_shard_requests(shard["file"]):
+            queued[req["custom_id"]] = queued.get(req["custom_id"], 0) + 1
+            if shard["status"] != "merged":
+                in_flight.add(req["custom_id"])
+    return queued, in_flight
+
+def write_shards(state, rows, queued):
+    """把 (chunk_id, 正文) 按分片上限写成新的分片文件，同时更新 queued 计数，返回新分片数"""
+    new_shards = 0
+    f_shard, n, size = None, 0, 0
+
+    def close_shard():
+        nonlocal f_shard, new_shards
+        if f_shard:
+            f_shard.close()
+            state["shards"][name] = {"file": path, "requests": n, "status": "prepared"}
+            save_state(state)
+            new_shards += 1
+            f_shard = None
+
+    for c_id, text in rows:
+        row = json.dumps(build_request(c_id, text), ensure_ascii=False) + "\n"
+        row_bytes = len(row.encode('utf-8'))
+        if f_shard and (n >= SHARD_MAX_REQUESTS or size + row_bytes > SHARD_MAX_BYTES):
+            close_shard()
+        if not f_shard:
+            name = f"shard_{len(state['shards']) + 1:05d}"
+            path = os.path.join(BATCH_DIR, f"{name}.requests.jsonl")
+            f_shard = open(path, 'w', encoding='utf-8')
+            n, size = 0, 0
+        f_shard.write(row)
+        queued[str(c_id)] = queued.get(str(c_id), 0) + 1
+        n += 1
+        size += row_bytes
+    close_shard()
+    return new_shards
+
+def prepare_shards(state, finished_ids, retry_ids, queued, in_flight):
+    """把还没完成、也没进过任何分片的切片写成新的分片文件
+
+    retry_ids 是批量接口出错的切片 (清单里的 batch_error)，进过的分片数没到 BATCH_MAX_ATTEMPTS 的重新排进新分片
+    """
+    def pending_rows():
+        with open(INPUT_FILE, 'r', encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                try:
+                    data = json.loads(line)
+                except Exception:
+                    continue
+                text = data.get('text', data.get('content', ''))
+                if not text_in_range(text, data.get('tokens')):
+                    continue
+                c_id = str(data.get('id', f"line_{i+1}"))
+                if c_id in finished_ids or c_id in in_flight:
+                    continue
+                if c_id in queued and (c_id not in retry_ids or queued[c_id] >= BATCH_MAX_ATTEMPTS):
+                    continue
+                yield c_id, text
+
+    return write_shards(state, pending_rows(), queued)
+
+# ================= 4. 提交 / 轮询 =================
+def submit_shard(client, shard):
+    with open(shard["file"], 'rb') as f:
+        uploaded = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=uploaded.id,
+        endpoint="/v1/chat/completions",
+        completion_window=COMPLETION_WINDOW
+    )
+    shard.update({"status": "submitted", "input_file_id": uploaded.id, "batch_id": batch.id})
+
+def download_file(client, file_id, path):
+    content = client.files.content(file_id)
+    with open(path, 'wb') as f:
+        f.write(content.content)
+
+def merge_shard(client, shard, batch, manifest, finished_ids, f_out):
+    """下载结果并合并进 OUTPUT_FILE，返回 (成功切片数, 新增问答对数, {出错切片 id: 正文})"""
+    base = shard["file"].replace(".requests.jsonl", "")
+    result_files = []
+    for file_id, suffix in ((batch.output_file_id, ".output.jsonl"), (batch.error_file_id, ".errors.jsonl")):
+        if file_id:
+            path = base + suffix
+            download_file(client, file_id, path)
+            result_files.append(path)
+
+    # 原文只在本分片的请求文件里，按分片建索引，内存占用有上限
+    origin = {}
+    for req in iter_shard_requests(shard["file"]):
+        origin[req["custom_id"]] = req["body"]["messages"][-1]["content"][len(USER_PROMPT_PREFIX):]
+
+    done_chunks, pairs, errors = 0, 0, {}
+    for path in result_files:
+        for row in iter_shard_requests(path):
+            c_id = row.get("custom_id")
+            if c_id not in origin:
+                continue
+            text = origin.pop(c_id)
+            if c_id in finished_ids:
+                continue  # 上次合并到一半崩溃，已经写过了
+            response = row.get("response") or {}
+            result = None
+            if response.get("status_code") == 200 and not row.get("error"):
+                try:
+                    choice = response["body"]["choices"][0]
+                    result = loads_model_json(choice["message"]["content"])
+                    # 被 max_tokens 截断又没剩下完整问答对的不算 empty，排进重试分片
+                    if choice.get("finish_reason") == "length" and not complete_qa_pairs(result):
+                        result = None
+                except Exception:
+                    result = None
+            if result is None:
+                manifest.record(c_id, "batch_error")
+                errors[c_id] = text
+                continue
+            records = extract_qa_records(c_id, text, result)
+            for record in records:
+                f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f_out.flush()
+            manifest.record(c_id, "done" if records else "empty", len(records))
+            # 重试分片里成功的切片不能再被排进新分片
+            finished_ids.add(c_id)
+            done_chunks += 1
+            pairs += len(records)
+
+    # 平台没有返回结果的 (过期 / 取消)
+    for c_id, text in origin.items():
+        if c_id not in finished_ids:
+            manifest.record(c_id, "batch_error")
+            errors[c_id] = text
+    return done_chunks, pairs, errors
+
+def main():
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    print(f"=== 📦 批量接口版启动 (分片上限: {SHARD_MAX_REQUESTS} 条 / {SHARD_MAX_BYTES // 1024 // 1024} MB) ===")
+
+    client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
+    manifest = ChunkManifest(MANIFEST_FILE)
+    finished_ids = {str(c_id) for c_id in manifest.load_finished(seed_output=OUTPUT_FILE)}
+    retry_ids = {str(c_id) for c_id, status in manifest.load().items() if status == "batch_error"}
+
+    state = load_state()
+    # 分片文件只在启动时读一遍，之后新分片的计数由 write_shards 增量更新
+    queued, in_flight = scan_shards(state)
+    new_shards = prepare_shards(state, finished_ids, retry_ids, queued, in_flight)
+    print(f"新生成分片: {new_shards} 个 | 分片总数: {len(state['shards'])}")
+
+    total_pairs = 0
+    with open(OUTPUT_FILE, 'a', encoding='utf-8') as f_out, manifest:
+        while True:
+            pending = [(k, v) for k, v in sorted(state["shards"].items()) if v["status"] != "merged"]
+            if not pending:
+                break
+
+            # 1. 控制同时在平台排队的分片数
+            active = sum(1 for _, v in pending if v["status"] == "submitted")
+            for name, shard in pending:
+                if shard["status"] == "prepared" and active < MAX_ACTIVE_SHARDS:
+                    try:
+                        submit_shard(client, shard)
+                        save_state(state)
+                        active += 1
+                        print(f"  📤 {name}: 已提交 ({shard['requests']} 条) batch_id={shard['batch_id']}")
+                    except Exception as e:
+                        print(f"  ❌ {name}: 提交失败 {e}，下一轮重试")
+
+            # 2. 轮询已提交的分片，完成一个合并一个；出错的切片攒到这一轮结束一起排进新分片
+            retry_rows = {}
+            for name, shard in pending:
+                if shard["status"] != "submitted":
+                    continue
+                try:
+                    batch = client.batches.retrieve(shard["batch_id"])
+                except Exception as e:
+                    print(f"  ⚠️ {name}: 查询失败 {e}")
+                    continue
+                if batch.status not in FINAL_BATCH_STATUSES:
+                    continue
+                done_chunks, pairs, errors = merge_shard(client, shard, batch, manifest, finished_ids, f_out)
+                shard.update({"status": "merged", "batch_status": batch.status})
+                save_state(state)
+                total_pairs += pairs
+                print(f"  ✅ {name}: {batch.status} | 成功切片 {done_chunks}/{shard['requests']} | 新增问答对 {pairs}")
+                if errors:
+                    retry_rows.update(errors)
+
+            if retry_rows:
+                # 原文直接取自刚合并的分片，不用再扫一遍输入文件和所有分片
+                rows = [(c_id, text) for c_id, text in retry_rows.items()
+                        if c_id not in finished_ids and queued.get(c_id, 0) < BATCH_MAX_ATTEMPTS]
+                retried = write_shards(state, rows, queued)
+                print(f"  🔁 {len(retry_rows)} 个切片出错，{len(rows)} 个重新排进 {retried} 个新分片")
+                if len(rows) < len(retry_rows):
+                    print(f"  ⚠️ {len(retry_rows) - len(rows)} 个已达 BATCH_MAX_ATTEMPTS，留给 RHS / DSP 续跑时重试")
+
+            if any(v["status"] != "merged" for v in state["shards"].values()):
+                time.sleep(POLL_INTERVAL)
+
+    print(f"\n=== 完成 ===")
+    print(f"新增数据: {total_pairs} 条，结果已合并至: {OUTPUT_FILE}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n🛑 已停止。分片状态已保存，重新运行会继续轮询未完成的分片")
@@ -2,35 +2,108 @@ import json
 import os
 import time
 import logging
-import re
 import asyncio
-from openai import AsyncOpenAI
+from types import SimpleNamespace
 from tqdm.asyncio import tqdm
+from gen_utils import (ChunkManifest, Hedger, QAStreamParser, RetryQueue, RetryTask, Router, Telemetry, TokenCounter,
+                       UsageStats, complete_qa_pairs, extract_qa_records, loads_model_json, make_endpoints, run_pipeline,
+                       stream_chat_completion)
 
 # ================= 1. ⚡️ 极速配置区域 =================
 API_KEY = ""  # <--- 【必填】
 BASE_URL = ""    #api调用平台链接
 MODEL_NAME = ""  #选择你的模型
 
+# 多平台 / 多账号 / 多模型一起跑：吞吐随 key 数量叠加，某个平台出故障时请求自动分到其余端点
+# 每项 {"name", "base_url", "api_key", "model", "weight", "concurrency", "rpm", "tpm", "probe"}，字段说明见 gen_utils.ENDPOINT_DEFAULTS
+# 留空则只用上面这一个 (并发、限速沿用下面的 CONCURRENCY / RPM_LIMIT / TPM_LIMIT)；CONCURRENCY 等自适应参数对每个端点分别生效
+ENDPOINTS = []
+HEALTH_CHECK_INTERVAL = 60        # 后台探活间隔 (秒)，同时让连接池保持热连接；0 表示只在启动时检查
+ENDPOINT_FAILURE_THRESHOLD = 3    # 连续失败几次 (超时、5xx、连接错误) 暂停分配
+ENDPOINT_COOLDOWN = 30.0          # 暂停多久 (秒)
+
 #以下建议根据sweet结果设置
-# 【配置 1】并发数： 50
+# 【配置 1】并发上限： 50 (worker 数量)
 CONCURRENCY = 50
+# 自适应并发：遇到 429 / 延迟飙升自动减半，顺畅时逐步加回，最多到 CONCURRENCY
+# 设为 False 则固定使用 CONCURRENCY
+ADAPTIVE_CONCURRENCY = True
+INITIAL_CONCURRENCY = 10
+MIN_CONCURRENCY = 2
 
-# 【配置 2】输入限制：放宽下限，提升上限。
+# 【配置 2】输入限制：默认按 token 过滤，和 chunk.py 按 token 切块对齐 (chunk.py 输出里带 tokens 字段)
+# 与 chunk.py 的 CHUNK_TOKENS 保持一致；整块的公式 / 表格加上重叠句会超出目标，上限留 3 倍余量 (约等于以前的 3500 字)
+CHUNK_TOKENS = 800
+MIN_TEXT_TOKENS = 60
+MAX_TEXT_TOKENS = CHUNK_TOKENS * 3
+# 与 chunk.py 相同的 tokenizer.json 和换算比例缓存。过滤、合并请求、TPM 预扣都用它计数；
+# 没有 tokenizer 时按 chunk.py 拟合出的比例估算。切片没有 tokens 字段又数不了时，长度过滤才退回按字数
+TOKENIZER_FILE = ""
+TOKEN_CALIBRATION_FILE = ""
 MIN_TEXT_LENGTH = 100
 MAX_TEXT_LENGTH = 3500 
 
-# 【配置 3】超时斩杀：微调至 60秒
+# 【配置 3】超时斩杀：微调至 60秒 (开启对冲后只作为兜底，很少触发)
 TIMEOUT_SECONDS = 60.0 
 
+# 【配置 3.1】对冲请求：请求超过近期 p90 延迟还没返回，就再发一份，谁先回来用谁
+# 拖尾的慢请求不用再等满 60 秒被斩杀，切片也不会丢
+HEDGE_ENABLED = True
+HEDGE_QUANTILE = 0.9
+HEDGE_MAX_RATIO = 0.05   # 对冲请求最多占总请求数的 5%
+
+# 【配置 3.2】延后重试：超时 / 429 / JSON 失败的切片不当场重试，排到输入的最后按失败原因换参数再试
+# (429 等一会儿、超时放宽 TIMEOUT、截断加大 max_tokens、JSON 错发修复提示词)，主流程照样全速
+# 策略见 gen_utils.RETRY_POLICIES，可以在 RETRY_POLICIES 里覆盖个别原因，例如 {"timeout": {"timeout_factor": 2.0}}
+RETRY_ENABLED = True
+RETRY_MAX_ATTEMPTS = 2          # 每个切片最多重试几次
+RETRY_BUDGET_RATIO = 0.2        # 重试总数不超过首轮切片数的 20%
+RETRY_POLICIES = {}
+RETRY_MAX_OUTPUT_TOKENS = 4096  # 截断重试加大 max_tokens 的上限
+
 # 【配置 4】最大生成长度
 MAX_OUTPUT_TOKENS = 1280
 
+# 【配置 4.0】流式输出：边收边解析，finish_reason=length 精确记录截断，截断前已完整的问答对照样保留
+# 输出退化 (末尾 DEGENERATE_REPEAT_CHARS 字一直在复读，或前 DEGENERATE_PROSE_CHARS 字都不是 JSON) 时提前断开
+STREAM = True
+ABORT_DEGENERATE = True
+DEGENERATE_REPEAT_CHARS = 400
+DEGENERATE_PROSE_CHARS = 300
+
+# 【配置 4.1】多切片合并：一次请求打包多个切片，省掉重复的 system prompt 和往返开销
+# BATCH_CHUNKS = 1 表示关闭；合并后的输出按 chunk_index 拆回各个切片，拆不开就回退单条请求
+BATCH_CHUNKS = 1
+BATCH_TOKEN_BUDGET = 3000          # 单次合并请求里切片正文的预估 token 上限
+BATCH_MAX_OUTPUT_TOKENS = 4096     # 合并请求的 max_tokens 上限 (否则为 MAX_OUTPUT_TOKENS * 片段数)
+BATCH_TIMEOUT_SECONDS = 120.0
+
+# 【配置 5】平台限速 (按你账号的实际额度填写，0 表示不限制)
+# 发请求前按 预估prompt + MAX_OUTPUT_TOKENS 预扣额度，拿到 usage 后多退少补
+RPM_LIMIT = 0
+TPM_LIMIT = 0
+
+# 【配置 6】计费 (元 / 百万 token)，只用于统计前缀缓存省了多少钱，按平台价格填写
+PRICE_INPUT_PER_M = 2.0
+PRICE_CACHE_HIT_PER_M = 0.2
+
 # 路径以及命名请合理修改
 WORK_DIR = r""
 INPUT_FILE = os.path.join(WORK_DIR, "domain_chunks.jsonl")
 OUTPUT_FILE = os.path.join(WORK_DIR, "sensor_physics_sft.jsonl")
 LOG_FILE = os.path.join(WORK_DIR, "generation.log")
+# 断点续跑清单：按 source_chunk_id 记录每个切片的结果 (done/empty/timeout/failed)
+MANIFEST_FILE = os.path.join(WORK_DIR, "chunk_manifest.jsonl")
+# 重启时跳过哪些状态的切片。默认只跳过已完成的，超时 / 失败的切片重启后会再试；
+# 确定不想再为它们花钱时加上 "timeout", "failed"
+RESUME_SKIP_STATUSES = ("done", "empty")
+# 请求级遥测：每个请求一行 (排队时间、延迟、token、finish_reason、结果分类)，留空则不写文件
+TELEMETRY_FILE = os.path.join(WORK_DIR, "request_events.jsonl")
+# 每次请求的原始输出 (解析之前)，给 bench_json_repair.py 当语料，留空则不记录
+RAW_RESPONSE_FILE = ""
+# 每隔多少秒打印一次最近 SUMMARY_WINDOW 秒的吞吐和延迟分位数，0 表示不打印
+SUMMARY_INTERVAL = 30
+SUMMARY_WINDOW = 60
 
 # ================= 2. Prompt  =================
 #请合理修改
@@ -69,6 +142,17 @@ SYSTEM_PROMPT = r"""你是一位传感器材料与器件物理领域的专家。
   ]
 }
 """
+# 前缀缓存 (DeepSeek 等平台支持)：system + 用户指令前缀每次必须逐字节一致才能命中。
+# 不要往 SYSTEM_PROMPT 或 USER_PROMPT_PREFIX 里拼时间戳、chunk_id 之类会变的内容，变化的文本只放在最后
+USER_PROMPT_PREFIX = "请阅读以下科学文献片段，并生成0-2个包含物理约束的问答对：\n\n"
+# 合并请求用的前缀：要求每个问答对带上来源片段编号
+BATCH_USER_PROMPT_PREFIX = """以下是若干个互相独立的科学文献片段，每个片段以 [片段 N] 开头。
+请对每个片段分别生成0-2个包含物理约束的问答对，并在每个问答对中用整数字段 "chunk_index" 标明它来自第几个片段。
+输出示例：{"qa_pairs": [{"chunk_index": 1, "instruction": "...", "output": "..."}]}
+
+"""
+# JSON 解析失败的切片重试时，把上次的输出连同这段提示词发回去，只让模型修格式
+REPAIR_PROMPT = "下面是你上一次的输出，它不是合法的 JSON (可能有未转义的反斜杠、多余的说明文字)。请只输出修复后的 JSON，结构和问答内容保持不变：\n\n"
 
 # ================= 3. 工具函数 =================
 def setup_logger(log_file_path):
@@ -80,162 +164,376 @@ def setup_logger(log_file_path):
         logger.addHandler(fh)
     return logger
 
-def fix_json_string(json_str):
-    json_str = json_str.replace("```json", "").replace("```", "").strip()
-    try:
-        json_str = re.sub(r'(?<!\\)\\(?!["\\/bfnrtu])', r'\\\\', json_str)
-    except Exception:
-        pass
-    return json_str
+_token_counter = None
+
+def token_counter():
+    """全程共用一个 TokenCounter (run_batch_api 也通过 text_in_range 用它)"""
+    global _token_counter
+    if _token_counter is None:
+        _token_counter = TokenCounter(TOKENIZER_FILE, TOKEN_CALIBRATION_FILE)
+    return _token_counter
+
+def count_tokens(text):
+    return token_counter().count(text)
 
-def count_lines(filename):
-    if not os.path.exists(filename): return 0
-    with open(filename, 'r', encoding='utf-8') as f:
-        return sum(1 for _ in f)
+# 系统提示词每次都一样，main 里按本次的计数器数一次
+SYSTEM_PROMPT_TOKENS = 0
 
 # ================= 4. 核心逻辑 (斩杀版) =================
-async def process_single_chunk(sem, client, text_chunk, chunk_id, logger):
-    
-    # 过滤器：只处理长度适中的文本
-    if len(text_chunk) > MAX_TEXT_LENGTH:
-        return chunk_id, text_chunk, None # 太长不读
+class BadOutputError(ValueError):
+    """模型有返回但内容用不了。outcome 为 truncated / json_error / aborted，content 为原始输出 (修复重试时用)"""
+
+    def __init__(self, outcome, content, cause):
+        super().__init__(f"{outcome}: {cause}")
+        self.outcome = outcome
+        self.content = content
+
+async def request_qa(rt, user_content, max_tokens, timeout, chunk_id, retry=0):
+    """发一次请求并解析 JSON。超时抛 asyncio.TimeoutError，其余错误原样抛出；每次请求都记一条遥测事件"""
+    estimated = SYSTEM_PROMPT_TOKENS + count_tokens(user_content) + max_tokens
+    queued = time.monotonic()
+    # 按权重和空闲名额挑一个端点，并发名额和 RPM / TPM 额度都按端点各自计算
+    ep = rt.router.pick()
     
-    async with sem:
-        # 极速版不重试：失败了就直接丢弃，不浪费时间重试
-        retries = 1 
+    # 只有真正发请求的时候占用并发名额，429 之后的避让不占
+    async with ep.limiter:
+        reserved = await ep.rate_limiter.acquire(estimated)
         
-        for attempt in range(retries):
-            try:
-                # 🔪 斩杀逻辑：asyncio.wait_for 强制超时
-                response = await asyncio.wait_for(
-                    client.chat.completions.create(
-                        model=MODEL_NAME,
-                        messages=[
-                            {"role": "system", "content": SYSTEM_PROMPT},
-                            {"role": "user", "content": f"请阅读以下科学文献片段，并生成0-2个包含物理约束的问答对：\n\n{text_chunk}"}
-                        ],
-                        temperature=0.3,
-                        max_tokens=MAX_OUTPUT_TOKENS, # 限制废话
-                        response_format={"type": "json_object"}
-                    ),
-                    timeout=TIMEOUT_SECONDS # 超过直接杀
-                )
-                
-                raw_content = response.choices[0].message.content
-                cleaned_content = fix_json_string(raw_content)
-                qa_data = json.loads(cleaned_content)
-                return chunk_id, text_chunk, qa_data
-
-            except asyncio.TimeoutError:
-                # 记录一下被杀掉的任务（可选）
-                # logger.warning(f"Chunk {chunk_id}: 🔪 超时斩杀 ")
-                return chunk_id, text_chunk, None
-                
-            except Exception as e:
-                err_str = str(e)
-                if "429" in err_str:
-                    logger.warning(f"Chunk {chunk_id}: 限流 429，避让 5秒...")
-                    await asyncio.sleep(5)
-                else:
-                    # 其他错误直接忽略，不记录Error以免刷屏
-                    pass
-                
-        return chunk_id, text_chunk, None
+        async def call(attempt):
+            if attempt == 0:
+                return await send()
+            # 对冲请求是第二个并发请求：同样占一个并发名额和 RPM / TPM 额度。
+            # 两份请求的真实用量最后只按胜出的那份对账一次，所以这份预扣不管输赢都只留 prompt 部分，输出额度退回
+            hedge_reserved = 0
+            async with ep.limiter:
+                try:
+                    hedge_reserved = await ep.rate_limiter.acquire(estimated)
+                    return await send()
+                finally:
+                    if hedge_reserved:
+                        ep.rate_limiter.reconcile(hedge_reserved, hedge_reserved - max_tokens)
+        
+        async def send():
+            request = dict(
+                model=ep.model,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": user_content}
+                ],
+                temperature=0.3,
+                max_tokens=max_tokens, # 限制废话
+                response_format={"type": "json_object"}
+            )
+            if STREAM:
+                # 流式：问答对边收边解析，输出退化就提前断开，不再为废话付费
+                parser = QAStreamParser(repeat_chars=DEGENERATE_REPEAT_CHARS, prose_chars=DEGENERATE_PROSE_CHARS)
+                return await stream_chat_completion(ep.client, request, parser, abort_degenerate=ABORT_DEGENERATE)
+            response = await ep.client.chat.completions.create(**request)
+            choice = response.choices[0]
+            return SimpleNamespace(content=choice.message.content or "", finish_reason=choice.finish_reason,
+                                   usage=response.usage, ttfb=None, pairs=[], aborted=None)
+        
+        started = time.monotonic()
+        queue_wait = started - queued
+        try:
+            # 🔪 斩杀逻辑：asyncio.wait_for 强制超时，对冲请求也一起取消
+            result = await asyncio.wait_for(
+                rt.hedger.run(call) if rt.hedger else call(0),
+                timeout=timeout # 超过直接杀
+            )
+        except asyncio.TimeoutError:
+            # 超时的请求平台照样在生成，预扣额度不退
+            rt.router.report(ep, ok=False)
+            rt.telemetry.record(chunk_id, "timeout", time.monotonic() - started, queue_wait, retry=retry,
+                                endpoint=ep.name)
+            raise
+        except Exception as e:
+            # 请求没成功，预扣的输出额度退回去
+            ep.rate_limiter.reconcile(reserved, reserved - max_tokens)
+            throttled = "429" in str(e)
+            if throttled:
+                ep.limiter.record_throttle()
+            rt.router.report(ep, ok=False, throttled=throttled)
+            rt.telemetry.record(chunk_id, "rate_limited" if throttled else "api_error", time.monotonic() - started,
+                                queue_wait, retry=retry, error=e, endpoint=ep.name)
+            raise
+        finally:
+            # 超时的请求也算一个延迟样本，让控制器感知到拥堵
+            latency = time.monotonic() - started
+            ep.limiter.record_latency(latency)
+    
+    rt.router.report(ep, ok=True)
+    rt.telemetry.record_raw(chunk_id, result.content, result.finish_reason)
+    usage = result.usage
+    if usage is None and result.aborted:
+        # 提前断开的流拿不到 usage，按已收到的内容估算
+        completion = count_tokens(result.content)
+        usage = SimpleNamespace(prompt_tokens=estimated - max_tokens, completion_tokens=completion,
+                                total_tokens=estimated - max_tokens + completion)
+    rt.usage_stats.record(usage, latency)
+    if usage:
+        ep.rate_limiter.reconcile(reserved, usage.total_tokens)
+    finish_reason = result.finish_reason
+    salvaged = result.pairs
+    try:
+        if result.aborted:
+            raise json.JSONDecodeError(f"输出退化，已提前断开: {result.aborted}", result.content, len(result.content))
+        qa_data = loads_model_json(result.content)
+        if finish_reason == "length":
+            # 截断的输出修好后只剩已闭合的问答对，照样按截断统计 (一个都没剩时 loads_model_json 已经抛错)
+            salvaged = complete_qa_pairs(qa_data)
+            raise json.JSONDecodeError("输出被 max_tokens 截断", result.content, len(result.content))
+    except json.JSONDecodeError as e:
+        # 被 max_tokens 截断的单独统计，调大 MAX_OUTPUT_TOKENS 才能解决
+        outcome = "aborted" if result.aborted else "truncated" if finish_reason == "length" else "json_error"
+        rt.telemetry.record(chunk_id, outcome, latency, queue_wait, ttfb=result.ttfb, usage=usage,
+                            finish_reason=finish_reason, retry=retry, error=e, salvaged=len(salvaged),
+                            endpoint=ep.name)
+        if salvaged:
+            # 截断 / 断开之前已经闭合的问答对是完整的，照样收下
+            return {"qa_pairs": salvaged}
+        raise BadOutputError(outcome, result.content, e) from e
+    rt.telemetry.record(chunk_id, "ok", latency, queue_wait, ttfb=result.ttfb, usage=usage,
+                        finish_reason=finish_reason, retry=retry, endpoint=ep.name)
+    return qa_data
 
-# ================= 5. 主程序 =================
-async def main():
-    logger = setup_logger(LOG_FILE)
-    print(f"=== ⚡️ 极速斩杀版启动 (并发: {CONCURRENCY}) ===")
-    print(f"策略: 只读 {MIN_TEXT_LENGTH}-{MAX_TEXT_LENGTH}字 | 超时 {TIMEOUT_SECONDS}s 即杀 | 输出限 {MAX_OUTPUT_TOKENS} tokens")
+async def process_single_chunk(rt, text_chunk, chunk_id, task=None):
+    """单个切片只请求一次 (极速版不当场重试)。返回 (chunk_id, 正文, 结果, 状态, 失败信息)
+
+    失败信息为 (失败原因, 上次的输出) 或 None，交给延后重试队列；task 是重试时带的 RetryTask
+    """
+    max_tokens, timeout, user_content, attempt = MAX_OUTPUT_TOKENS, TIMEOUT_SECONDS, USER_PROMPT_PREFIX + text_chunk, 0
+    if task is not None:
+        attempt = task.attempt
+        max_tokens = min(int(MAX_OUTPUT_TOKENS * task.max_tokens_factor), max(RETRY_MAX_OUTPUT_TOKENS, MAX_OUTPUT_TOKENS))
+        timeout = TIMEOUT_SECONDS * task.timeout_factor
+        if task.repair_text:
+            user_content = REPAIR_PROMPT + task.repair_text
     
-    client = AsyncOpenAI(api_key=API_KEY, base_url=BASE_URL)
+    try:
+        qa_data = await request_qa(rt, user_content, max_tokens, timeout, chunk_id, retry=attempt)
+        return chunk_id, text_chunk, qa_data, "done", None
+
+    except asyncio.TimeoutError:
+        # 超时、JSON 失败等都已经记在遥测事件里 (TELEMETRY_FILE)
+        return chunk_id, text_chunk, None, "timeout", ("timeout", None)
     
-    # 进度检查
-    total_lines = count_lines(INPUT_FILE)
-    processed_count = 0
-    if os.path.exists(OUTPUT_FILE):
-        processed_count = count_lines(OUTPUT_FILE)
+    except BadOutputError as e:
+        return chunk_id, text_chunk, None, "failed", (e.outcome, e.content)
         
-    print(f"总行数: {total_lines} | 已存盘: {processed_count}")
+    except Exception as e:
+        if "429" in str(e):
+            if not RETRY_ENABLED:
+                rt.logger.warning(f"Chunk {chunk_id}: 限流 429，避让 5秒...")
+                await asyncio.sleep(5)
+            return chunk_id, text_chunk, None, "failed", ("rate_limited", None)
+        return chunk_id, text_chunk, None, "failed", ("api_error", None)
+
+# ================= 4.1 多切片合并请求 =================
+def iter_batches(chunks, size, token_budget):
+    """把 (chunk_id, 正文, token 数) 按 数量 <= size 且 token <= token_budget 打包成 [(chunk_id, 正文), ...]"""
+    batch, tokens = [], 0
+    for c_id, text, t in chunks:
+        if batch and (len(batch) >= size or tokens + t > token_budget):
+            yield batch
+            batch, tokens = [], 0
+        batch.append((c_id, text))
+        tokens += t
+    if batch:
+        yield batch
+
+def split_batch_result(qa_data, batch):
+    """按 chunk_index 把合并请求的结果拆回每个切片；格式不对返回 None"""
+    final_qas = qa_data.get('qa_pairs', qa_data) if isinstance(qa_data, dict) else qa_data
+    if not isinstance(final_qas, list):
+        return None
+    per_chunk = [[] for _ in batch]
+    for qa in final_qas:
+        if not isinstance(qa, dict):
+            continue
+        try:
+            idx = int(qa.get("chunk_index")) - 1
+        except (TypeError, ValueError):
+            # 模型没按要求标注来源，没法归属到具体切片
+            return None
+        if 0 <= idx < len(batch):
+            per_chunk[idx].append(qa)
+    return [(c_id, text, {"qa_pairs": qas}, "done", None) for (c_id, text), qas in zip(batch, per_chunk)]
+
+async def process_chunk_batch(rt, batch):
+    """一次请求处理多个切片，返回每个切片各自的结果列表"""
+    if len(batch) == 1:
+        c_id, text = batch[0]
+        return [await process_single_chunk(rt, text, c_id)]
     
-    # 快速加载数据
-    print("正在加载数据队列...")
-    lines_to_process = []
-    skipped = 0
+    user_content = BATCH_USER_PROMPT_PREFIX + "\n\n".join(
+        f"[片段 {i}]\n{text}" for i, (_, text) in enumerate(batch, 1)
+    )
+    max_tokens = min(MAX_OUTPUT_TOKENS * len(batch), BATCH_MAX_OUTPUT_TOKENS)
+    try:
+        qa_data = await request_qa(rt, user_content, max_tokens, BATCH_TIMEOUT_SECONDS,
+                                  [c_id for c_id, _ in batch])
+        results = split_batch_result(qa_data, batch)
+        if results is not None:
+            return results
+        rt.logger.warning(f"Batch {batch[0][0]}..: 结果无法按 chunk_index 拆分，回退单条请求")
+    except asyncio.TimeoutError:
+        # 超时的切片之后按单条请求重试
+        return [(c_id, text, None, "timeout", ("timeout", None)) for c_id, text in batch]
+    except BadOutputError:
+        rt.logger.warning(f"Batch {batch[0][0]}..: JSON 解析失败，回退单条请求")
+    except Exception as e:
+        throttled = "429" in str(e)
+        if throttled and not RETRY_ENABLED:
+            await asyncio.sleep(5)
+        reason = "rate_limited" if throttled else "api_error"
+        return [(c_id, text, None, "failed", (reason, None)) for c_id, text in batch]
     
+    # 回退：逐个切片单独请求
+    return await asyncio.gather(*(process_single_chunk(rt, text, c_id) for c_id, text in batch))
+
+# ================= 5. 主程序 =================
+def text_in_range(text, tokens=None):
+    """有 token 数就按 MIN/MAX_TEXT_TOKENS 过滤，没有 token 数又数不了时才按 MIN/MAX_TEXT_LENGTH"""
+    if tokens is None and (MIN_TEXT_TOKENS or MAX_TEXT_TOKENS) and token_counter().exact:
+        tokens = count_tokens(text)
+    if tokens is not None and (MIN_TEXT_TOKENS or MAX_TEXT_TOKENS):
+        return tokens >= MIN_TEXT_TOKENS and (not MAX_TEXT_TOKENS or tokens <= MAX_TEXT_TOKENS)
+    return MIN_TEXT_LENGTH <= len(text) <= MAX_TEXT_LENGTH
+
+def iter_pending_chunks(finished_ids, stats):
+    """流式读取输入文件：边读边过滤，不再把全部切片装进内存。产出 (chunk_id, 正文, token 数)"""
     with open(INPUT_FILE, 'r', encoding='utf-8') as f:
         for i, line in enumerate(f):
-            if i < processed_count: continue
-            
             # 简单过滤，加速加载
             if len(line) < MIN_TEXT_LENGTH: 
-                skipped += 1
+                stats["skipped"] += 1
                 continue
                 
             try:
                 data = json.loads(line)
-                text = data.get('text', data.get('content', ''))
+            except Exception:
+                continue
+            text = data.get('text', data.get('content', ''))
+            
+            # 严格的长度过滤 (太长不读)：有 token 数就按 token，否则按字数
+            if not text_in_range(text, data.get('tokens')):
+                stats["skipped"] += 1
+                continue
                 
-                # 严格的长度过滤
-                if len(text) < MIN_TEXT_LENGTH or len(text) > MAX_TEXT_LENGTH:
-                    skipped += 1
-                    continue
-                    
-                c_id = data.get('id', f"line_{i+1}")
-                lines_to_process.append((c_id, text))
-            except:
-                pass
+            c_id = data.get('id', f"line_{i+1}")
+            if c_id in finished_ids:
+                stats["resumed"] += 1
+                continue
+            # chunk.py 已经数过的直接用，合并请求按它打包
+            yield c_id, text, data.get('tokens') or count_tokens(text)
 
-    print(f"有效任务: {len(lines_to_process)} 条 (已过滤不合格: {skipped} 条)")
+async def main():
+    global _token_counter, SYSTEM_PROMPT_TOKENS
+    # 按本次运行的 TOKENIZER_FILE 重新建 (基准脚本会在两次运行之间改配置)
+    _token_counter = None
+    SYSTEM_PROMPT_TOKENS = count_tokens(SYSTEM_PROMPT)
+    logger = setup_logger(LOG_FILE)
+    endpoint_configs = ENDPOINTS or [{"name": "default", "base_url": BASE_URL, "api_key": API_KEY, "model": MODEL_NAME,
+                                      "concurrency": CONCURRENCY, "rpm": RPM_LIMIT, "tpm": TPM_LIMIT}]
+    router = Router(make_endpoints(endpoint_configs, ADAPTIVE_CONCURRENCY, INITIAL_CONCURRENCY, MIN_CONCURRENCY),
+                    ENDPOINT_FAILURE_THRESHOLD, ENDPOINT_COOLDOWN, HEALTH_CHECK_INTERVAL, printer=tqdm.write)
+    print(f"=== ⚡️ 极速斩杀版启动 (并发上限: {router.max_limit} | 端点: {len(router.endpoints)} | 自适应: {ADAPTIVE_CONCURRENCY}) ===")
+    if MIN_TEXT_TOKENS or MAX_TEXT_TOKENS:
+        text_range = f"{MIN_TEXT_TOKENS}-{MAX_TEXT_TOKENS or '∞'} tokens (切片没有 tokens 字段时按 {MIN_TEXT_LENGTH}-{MAX_TEXT_LENGTH}字)"
+    else:
+        text_range = f"{MIN_TEXT_LENGTH}-{MAX_TEXT_LENGTH}字"
+    print(f"策略: 只读 {text_range} | 超时 {TIMEOUT_SECONDS}s 即杀 | 输出限 {MAX_OUTPUT_TOKENS} tokens")
+    if BATCH_CHUNKS > 1:
+        print(f"合并请求: 每次最多 {BATCH_CHUNKS} 个切片 / {BATCH_TOKEN_BUDGET} tokens")
+    if not ENDPOINTS:
+        print(f"限速: RPM {RPM_LIMIT or '不限'} | TPM {TPM_LIMIT or '不限'}")
+    if RETRY_ENABLED:
+        print(f"延后重试: 每个切片最多 {RETRY_MAX_ATTEMPTS} 次，总数不超过首轮的 {RETRY_BUDGET_RATIO:.0%}")
     
-    if not lines_to_process:
-        print("无任务。")
-        return
-
-    sem = asyncio.Semaphore(CONCURRENCY)
-    tasks = []
-
-    for c_id, text in lines_to_process:
-        tasks.append(process_single_chunk(sem, client, text, c_id, logger))
+    # 进度检查：按 chunk_id 跳过已完成的切片，而不是按输出行数
+    manifest = ChunkManifest(MANIFEST_FILE)
+    finished_ids = manifest.load_finished(RESUME_SKIP_STATUSES, seed_output=OUTPUT_FILE)
+    print(f"已完成切片: {len(finished_ids)} (边读边发，不再预加载)")
     
-    # 执行
-    with open(OUTPUT_FILE, 'a', encoding='utf-8') as f_out:
-        pbar = tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="⚡️ Speed Run", unit="chk")
-        
-        valid_total = 0
-        for future in pbar:
-            try:
-                chunk_id, origin_text, result = await future
-                
-                if result:
-                    final_qas = result.get('qa_pairs', result) if isinstance(result, dict) else result
+    usage_stats = UsageStats()
+    hedger = Hedger(HEDGE_QUANTILE, HEDGE_MAX_RATIO) if HEDGE_ENABLED else None
+    
+    telemetry = Telemetry(TELEMETRY_FILE, SUMMARY_INTERVAL, SUMMARY_WINDOW, printer=tqdm.write,
+                          raw_path=RAW_RESPONSE_FILE)
+    retry = RetryQueue(RETRY_MAX_ATTEMPTS, RETRY_BUDGET_RATIO, policies=RETRY_POLICIES) if RETRY_ENABLED else None
+    
+    rt = SimpleNamespace(router=router, usage_stats=usage_stats, hedger=hedger, logger=logger, telemetry=telemetry)
+    
+    stats = {"skipped": 0, "resumed": 0}
+    valid_total = 0
+    
+    async def handle(item):
+        if isinstance(item, RetryTask):
+            c_id, text = item.item
+            results = [await process_single_chunk(rt, text, c_id, item)]
+        else:
+            results = await process_chunk_batch(rt, item)
+        if retry is None:
+            return results
+        # 失败的切片排进重试队列，这次的结果不写；次数或预算用完的照常写 (清单里记 timeout / failed)
+        kept = []
+        for res in results:
+            reason, last_output = res[4] or (None, None)
+            source = item if isinstance(item, RetryTask) else (res[0], res[1])
+            if not retry.offer(source, reason, last_output):
+                kept.append(res)
+        return kept
+    
+    # 执行：reader -> 各端点并发上限之和个 worker -> 单个 writer
+    async with router:
+        with open(OUTPUT_FILE, 'a', encoding='utf-8') as f_out, manifest, telemetry:
+            pbar = tqdm(desc="⚡️ Speed Run", unit="chk")
+            
+            def write_results(results):
+                for res in results:
+                    write_result(res)
+            
+            def write_result(res):
+                nonlocal valid_total
+                try:
+                    chunk_id, origin_text, result, status, _ = res
+                    records = extract_qa_records(chunk_id, origin_text, result)
+                    valid_count = len(records)
                     
-                    if isinstance(final_qas, list) and len(final_qas) > 0:
-                        valid_count = 0
-                        for qa in final_qas:
-                            q = qa.get("instruction", qa.get("question"))
-                            a = qa.get("output", qa.get("answer"))
-                            
-                            if q and a:
-                                record = {
-                                    "source_chunk_id": chunk_id,
-                                    "instruction": q,
-                                    "output": a,
-                                    "context_preview": origin_text[:50]
-                                }
-                                f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
-                                valid_count += 1
-                        
-                        if valid_count > 0:
-                            f_out.flush()
-                            valid_total += valid_count
-                            logger.info(f"Chunk {chunk_id}: +{valid_count}")
-                            pbar.set_postfix({"✅ Saved": valid_total})
-            except Exception:
-                pass # 极速模式下忽略写入错误，保持奔跑
+                    for record in records:
+                        f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    
+                    if valid_count > 0:
+                        f_out.flush()
+                        valid_total += valid_count
+                        logger.info(f"Chunk {chunk_id}: +{valid_count}")
+                        pbar.set_postfix({"✅ Saved": valid_total, "并发": router.limit, "缓存": f"{usage_stats.hit_rate:.0%}"})
+                    
+                    # 结果落盘之后再记清单：崩溃时最多重跑这一个切片，不会漏
+                    if status == "done" and valid_count == 0:
+                        status = "empty"
+                    manifest.record(chunk_id, status, valid_count)
+                except Exception as e:
+                    # 极速模式下不中断，但要留下记录
+                    logger.error(f"Chunk {res[0] if res else '?'}: 写入结果出错: {e}")
+                pbar.update(1)
+            
+            batches = iter_batches(iter_pending_chunks(finished_ids, stats), BATCH_CHUNKS, BATCH_TOKEN_BUDGET)
+            await run_pipeline(batches, handle, write_results, router.max_limit, retry=retry)
+            pbar.close()
 
     print(f"\n=== 完成 ===")
-    print(f"新增数据: {valid_total} 条")
+    print(f"处理切片: {pbar.n} 条 (已过滤不合格: {stats['skipped']} 条 | 断点跳过: {stats['resumed']} 条)")
+    print(f"新增数据: {valid_total} 条 | 结束时并发: {router.limit}")
+    print(telemetry.totals_summary())
+    if len(router.endpoints) > 1:
+        print(router.summary())
+    if retry:
+        print(retry.summary())
+    print(usage_stats.summary(PRICE_INPUT_PER_M, PRICE_CACHE_HIT_PER_M))
+    if hedger:
+        print(f"对冲请求: {hedger.hedges} 次 (占 {hedger.hedges / max(hedger.requests, 1):.1%})，其中 {hedger.hedge_wins} 次先于原请求返回")
 
 if __name__ == "__main__":
     try:
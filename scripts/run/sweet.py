@@ -2,6 +2,7 @@ import json
 import os
 import statistics
 import re
+from gen_utils import TokenCounter
 
 # ================= 配置 =================
 # 你的结果文件路径
@@ -9,9 +10,14 @@ FILE_PATH = r""
 
 # 你当前设置的生成限制 (用于计算截断风险)
 CURRENT_MAX_TOKENS = 1024 
-# 粗略换算：1 token ≈ 1.5 中文字符 (根据 DeepSeek tokenizer 估算)
-TOKEN_CHAR_RATIO = 1.5 
-WARNING_LENGTH = CURRENT_MAX_TOKENS * TOKEN_CHAR_RATIO * 0.9 # 达到 90% 长度预警
+# 目标模型的 tokenizer.json (与 chunk.py 相同)，用来精确统计回答的 token 数；
+# 留空则按 chunk.py 拟合出的换算比例 (TOKEN_CALIBRATION_FILE) 估算，都没有时按 1 token ≈ 1.5 中文字符
+TOKENIZER_FILE = ""
+TOKEN_CALIBRATION_FILE = ""
+WARNING_TOKENS = CURRENT_MAX_TOKENS * 0.9 # 达到 90% 长度预警
+# DSP / RHS 写的请求级遥测 (request_events.jsonl)。有它时截断率、输出长度、延迟都按真实记录统计，不用再按字数猜
+# (流式模式下 finish_reason=length 是精确记录的，下面的 "疑似截断" 只是没有遥测时的兜底)
+TELEMETRY_FILE = r""
 
 def check_quality(text):
     """简单判断单条数据的含金量"""
@@ -21,6 +27,69 @@ def check_quality(text):
     has_logic = 1 if any(w in text for w in logic_words) else 0
     return has_formula, has_logic
 
+def percentile(data, q):
+    data = sorted(data)
+    return data[min(len(data) - 1, int(len(data) * q))]
+
+def analyze_telemetry():
+    """按请求级遥测给出 MAX_OUTPUT_TOKENS / TIMEOUT_SECONDS 建议"""
+    events = []
+    with open(TELEMETRY_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                pass
+    if not events:
+        print("⚠️ 遥测文件为空。")
+        return
+    total = len(events)
+    outcomes = {}
+    for e in events:
+        outcomes[e["outcome"]] = outcomes.get(e["outcome"], 0) + 1
+    print(f"\n📡 === 请求级遥测 (基数: {total} 次请求) ===")
+    for name, count in sorted(outcomes.items(), key=lambda kv: -kv[1]):
+        print(f"   {name:<13}: {count:5d} ({count / total:.1%})")
+    # 配置了多个 ENDPOINTS 时按端点分开看，某个 key 错误率 / 延迟明显偏高就降低它的 weight
+    endpoints = sorted({e["endpoint"] for e in events if e.get("endpoint")})
+    if len(endpoints) > 1:
+        for name in endpoints:
+            mine = [e for e in events if e.get("endpoint") == name]
+            ok = [e["latency"] for e in mine if e["outcome"] == "ok"]
+            errors = sum(1 for e in mine if e["outcome"] in ("rate_limited", "timeout", "api_error"))
+            p50 = f"{percentile(ok, 0.5):.1f}s" if ok else "-"
+            print(f"   🔀 {name}: {len(mine)} 次 ({len(mine) / total:.1%}) | 错误 {errors / len(mine):.1%} | 成功延迟 p50 {p50}")
+
+    answered = [e for e in events if e.get("completion_tokens") is not None]
+    finished = [e for e in events if e["outcome"] not in ("rate_limited",)]
+    if answered:
+        completion = [e["completion_tokens"] for e in answered]
+        truncated = sum(1 for e in answered if e.get("finish_reason") == "length")
+        print(f"   输出 token: p50 {percentile(completion, 0.5)} | p95 {percentile(completion, 0.95)} | p99 {percentile(completion, 0.99)}")
+        print(f"   ✂️ 被 max_tokens 截断 (finish_reason=length): {truncated} 次 ({truncated / len(answered):.1%})")
+        ok = [e["completion_tokens"] for e in answered if e.get("finish_reason") != "length"]
+        if truncated > len(answered) * 0.02:
+            print(f"   🔴 截断超过 2%，建议调大 MAX_OUTPUT_TOKENS (当前输出 p99 已顶到上限)")
+        elif ok:
+            print(f"   🟢 建议 MAX_OUTPUT_TOKENS ≈ {int(percentile(ok, 0.99) * 1.1)} (完整输出的 p99 × 1.1)")
+    if finished:
+        latency = [e["latency"] for e in finished if e["outcome"] != "timeout"]
+        timeouts = outcomes.get("timeout", 0)
+        if latency:
+            print(f"   延迟: p50 {percentile(latency, 0.5):.1f}s | p95 {percentile(latency, 0.95):.1f}s | p99 {percentile(latency, 0.99):.1f}s")
+            print(f"   ⏱️ 超时斩杀 {timeouts} 次，建议 TIMEOUT_SECONDS ≈ {percentile(latency, 0.99) * 1.2:.0f}s (成功请求 p99 × 1.2)")
+        waits = [e["queue_wait"] for e in events if e.get("queue_wait") is not None]
+        if waits:
+            print(f"   排队等待: p50 {percentile(waits, 0.5):.2f}s | p95 {percentile(waits, 0.95):.2f}s (持续偏高说明并发名额或 RPM/TPM 是瓶颈)")
+    aborted = outcomes.get("aborted", 0)
+    salvaged = sum(e.get("salvaged", 0) for e in events)
+    if aborted or salvaged:
+        wasted = sum(e.get("completion_tokens") or 0 for e in events if e["outcome"] == "aborted")
+        print(f"   🛑 输出退化提前断开 {aborted} 次 (这些请求共 {wasted} 输出 token)，截断 / 断开前抢救出 {salvaged} 个问答对")
+    throttled = outcomes.get("rate_limited", 0)
+    if throttled > total * 0.05:
+        print(f"   🔴 429 占 {throttled / total:.1%}，吞吐受平台限流约束，调大 CONCURRENCY 没有用")
+
 def analyze_output_sweet_spot():
     print(f"正在分析结果文件: {FILE_PATH} ...")
     
@@ -30,6 +99,7 @@ def analyze_output_sweet_spot():
 
     instruction_lens = [] # 问题长度
     output_lens = []      # 答案长度
+    outputs = []
     high_quality_indices = [] # 高质量答案的索引
     truncated_suspects = 0    # 疑似被截断的数量
 
@@ -46,21 +116,25 @@ def analyze_output_sweet_spot():
                 
                 instruction_lens.append(i_len)
                 output_lens.append(o_len)
+                outputs.append(out)
                 
                 # 质量检测
                 f_score, l_score = check_quality(out)
                 if f_score and l_score:
                     high_quality_indices.append(i)
-                
-                # 截断检测：如果答案长度非常接近最大 Token 限制，且不以标点结束
-                if o_len > WARNING_LENGTH:
-                    # 简单检查末尾标点
-                    if out.strip()[-1] not in ['。', '.', '!', '}', ']']:
-                        truncated_suspects += 1
                         
             except:
                 pass
 
+    # 截断检测：如果答案 token 数非常接近最大 Token 限制，且不以标点结束
+    counter = TokenCounter(TOKENIZER_FILE, TOKEN_CALIBRATION_FILE)
+    output_tokens = counter.count_batch(outputs)
+    for out, o_tokens in zip(outputs, output_tokens):
+        if o_tokens > WARNING_TOKENS and out.strip():
+            # 简单检查末尾标点
+            if out.strip()[-1] not in ['。', '.', '!', '}', ']']:
+                truncated_suspects += 1
+
     total = len(output_lens)
     if total == 0:
         print("⚠️ 结果文件为空。")
@@ -84,6 +158,9 @@ def analyze_output_sweet_spot():
     print(f"   - 平均: {int(avg_out)} 字")
     print(f"   - 中位: {int(med_out)} 字")
     print(f"   - 最长: {max_out} 字")
+    if output_tokens:
+        max_tokens_out = max(output_tokens)
+        print(f"   - token: 平均 {int(statistics.mean(output_tokens))} | 最长 {max_tokens_out} ({'tokenizer 精确计数' if counter.exact else '估算'})")
     
     # 长度分布直方图
     print(f"\n📊 **回答长度分布 (寻找 MAX_OUTPUT_TOKENS 甜蜜点)**:")
@@ -102,10 +179,10 @@ def analyze_output_sweet_spot():
     # 1. 关于 MAX_OUTPUT_TOKENS
     if truncated_suspects > total * 0.05:
         print(f"   🔴 **警告**: 有 >5% 的回答可能被截断了！建议调大 `MAX_OUTPUT_TOKENS`。")
-        print(f"      推荐值: {int(max_out / 1.2)} tokens (或更大)")
-    elif max_out < WARNING_LENGTH * 0.5:
+        print(f"      推荐值: {int(CURRENT_MAX_TOKENS * 1.5)} tokens (或更大)")
+    elif max_tokens_out < WARNING_TOKENS * 0.5:
         print(f"   🟢 **空间**: 模型回答都很精简。你可以调小 `MAX_OUTPUT_TOKENS` 以稍微提升并发速度。")
-        print(f"      推荐值: {int(max_out / 1.3)} tokens")
+        print(f"      推荐值: {int(max_tokens_out * 1.2)} tokens")
     else:
         print(f"   🔵 **完美**: `MAX_OUTPUT_TOKENS` 设置得刚刚好，既没截断也没浪费。")
 
@@ -118,4 +195,6 @@ def analyze_output_sweet_spot():
         print(f"      建议 `MIN_TEXT_LENGTH` 不要超过 {int(avg_hq_inst * 0.5)}，否则可能漏掉好问题。")
 
 if __name__ == "__main__":
-    analyze_output_sweet_spot()
\ No newline at end of file
+    analyze_output_sweet_spot()
+    if TELEMETRY_FILE and os.path.exists(TELEMETRY_FILE):
+        analyze_telemetry()
\ No newline at end of file
@@ -1,6 +1,8 @@
 import os
 import json
+import hashlib
 import re
+from concurrent.futures import ProcessPoolExecutor
 #清洗从mineru得到的返回结果
 # ================= 配置区 =================
 BASE_DIR = ""
@@ -8,92 +10,308 @@ OUTPUT_FILE = ""
 #这里根据你的结果分为多少份自主调整
 BATCH_RANGE = range(1, 30)  # 处理 batch_1 到 batch_29
 MIN_LENGTH = 300  # 过滤掉内容过短（少于300字）的文档
+# 清洗进程数，None 表示用满所有 CPU 核；设为 1 则单进程顺序执行
+WORKERS = None
+# 每个进程一次领取的论文数，论文多时调大可以减少进程间通信
+CHUNKSIZE = 16
+# 增量清洗的索引文件，留空则为 OUTPUT_FILE + ".index.json"。重跑时只清洗新增或改动过的论文
+INDEX_FILE = ""
+# 改了清洗规则就把版本号加一，索引整体失效、全部重新清洗
+CLEANER_VERSION = 1
+
+# 参考文献标题：行首 #+ 空格，之后可以有空白，再接关键字 (不区分大小写)。
+# 排在前面的关键字优先：全文只要出现 References 标题就截在它那里，否则再看参考文献、Bibliography
+REF_KEYWORDS = ('References', '参考文献', 'Bibliography')
+REF_HEADING_PATTERN = re.compile(r'#+ \s*(?:(References)|(参考文献)|(Bibliography))', re.IGNORECASE)
+
+def _strip_markup(line):
+    """删除一行里的图片 ![..](..)，超链接 [文字](..) 只保留文字。
+
+    图片和链接都不跨行，而且同一行里从某个 [ 开始找不到 "](" 或者之后的 ")"，
+    后面的 [ 也一定找不到，可以直接结束，所以每一行只扫一遍。
+    """
+    # 先删图片 (和原来先删图片再处理链接的顺序一致，图片删掉后可能拼出新的链接)
+    if '![' in line:
+        out, pos = [], 0
+        while True:
+            i = line.find('![', pos)
+            if i < 0:
+                break
+            j = line.find('](', i + 2)
+            k = line.find(')', j + 2) if j >= 0 else -1
+            if k < 0:
+                break
+            out.append(line[pos:i])
+            pos = k + 1
+        out.append(line[pos:])
+        line = ''.join(out)
+    # 再把超链接换成文字
+    if '[' in line:
+        out, pos = [], 0
+        while True:
+            i = line.find('[', pos)
+            if i < 0:
+                break
+            j = line.find('](', i + 1)
+            k = line.find(')', j + 2) if j >= 0 else -1
+            if k < 0:
+                break
+            out.append(line[pos:i])
+            out.append(line[i + 1:j])
+            pos = k + 1
+        out.append(line[pos:])
+        line = ''.join(out)
+    return line
 
 def clean_paper_content(text):
     """
     针对专业论文 Markdown 的清洗逻辑
+    逐行扫一遍完成：截断参考文献、移除图片、超链接只保留文字、合并多余空行，
+    结果与 clean_paper_content_regex 完全一致 (用 check/check_washing.py 对比)
     """
+    out = []
+    # 遇到优先级较低的参考文献标题时，记下当时已输出的行数，全文扫完没有更优先的再截断
+    cut_at = [None] * len(REF_KEYWORDS)
+    offset = 0
+    for n, line in enumerate(text.split('\n')):
+        # 1. 自动截断参考文献 (References)，标题前面必须有换行，所以第一行不算
+        if n and line.startswith('#'):
+            m = REF_HEADING_PATTERN.match(text, offset)
+            if m:
+                rank = m.lastindex - 1
+                if rank == 0:
+                    cut_at[0] = len(out)
+                    break
+                if cut_at[rank] is None:
+                    cut_at[rank] = len(out)
+        offset += len(line) + 1
+
+        # 2. 移除图片引用 3. 移除超链接，但保留文字
+        if '[' in line:
+            line = _strip_markup(line)
+
+        # 4. 移除多余的换行：连续空行只保留一个
+        if not line and out and not out[-1]:
+            continue
+        out.append(line)
+
+    for n in cut_at:
+        if n is not None:
+            del out[n:]
+            break
+    return '\n'.join(out).strip()
+
+# 原来的多正则版本，作为对照保留
+REF_PATTERNS = [re.compile(r'\n#+ \s*' + kw, re.IGNORECASE) for kw in REF_KEYWORDS]
+IMAGE_PATTERN = re.compile(r'!\[.*?\]\(.*?\)')
+LINK_PATTERN = re.compile(r'\[(.*?)\]\(.*?\)')
+NEWLINES_PATTERN = re.compile(r'\n{3,}')
+
+def clean_paper_content_regex(text):
     # 1. 自动截断参考文献 (References)
-    # 匹配常见的参考文献标题，截断其之后的所有内容
-    ref_keywords = [r'\n#+ \s*References', r'\n#+ \s*参考文献', r'\n#+ \s*Bibliography']
-    for kw in ref_keywords:
-        parts = re.split(kw, text, flags=re.IGNORECASE)
-        if len(parts) > 1:
-            text = parts[0]
+    # 只需要第一个匹配之前的部分，用 search 代替 split，不用切分全文
+    for pattern in REF_PATTERNS:
+        m = pattern.search(text)
+        if m:
+            text = text[:m.start()]
             break
 
     # 2. 移除图片引用 (MinerU 提取的格式通常是 ![](...))
-    text = re.sub(r'!\[.*?\]\(.*?\)', '', text)
+    text = IMAGE_PATTERN.sub('', text)
     
     # 3. 移除超链接，但保留文字
-    text = re.sub(r'\[(.*?)\]\(.*?\)', r'\1', text)
+    text = LINK_PATTERN.sub(r'\1', text)
     
     # 4. 移除多余的换行，保持段落整洁
-    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = NEWLINES_PATTERN.sub('\n\n', text)
     
     return text.strip()
 
-def build_dataset():
-    extracted_count = 0
-    skipped_count = 0
-    
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as outfile:
-        for i in BATCH_RANGE:
-            batch_path = os.path.join(BASE_DIR, f"batch_{i}")
-            if not os.path.exists(batch_path):
-                print(f"跳过不存在的目录: {batch_path}")
+def iter_papers(base_dir=None, batch_range=None):
+    """按 batch 顺序、文件夹名排序列出所有论文，保证每次输出顺序一致；不传参数时用配置区的路径"""
+    base_dir = BASE_DIR if base_dir is None else base_dir
+    for i in (BATCH_RANGE if batch_range is None else batch_range):
+        batch_path = os.path.join(base_dir, f"batch_{i}")
+        if not os.path.exists(batch_path):
+            print(f"跳过不存在的目录: {batch_path}")
+            continue
+        
+        print(f"正在扫描: batch_{i}...")
+        
+        # 遍历每个以论文命名的文件夹
+        for paper_folder in sorted(os.listdir(batch_path)):
+            folder_path = os.path.join(batch_path, paper_folder)
+            if not os.path.isdir(folder_path):
                 continue
-            
-            print(f"正在扫描: batch_{i}...")
-            
-            # 遍历每个以论文命名的文件夹
-            for paper_folder in os.listdir(batch_path):
-                folder_path = os.path.join(batch_path, paper_folder)
-                if not os.path.isdir(folder_path):
+            # 寻找 Markdown 文件
+            md_files = [f for f in os.listdir(folder_path) if f.endswith('.md')]
+            md_path = os.path.join(folder_path, md_files[0]) if md_files else None
+            yield i, paper_folder, folder_path, md_path
+
+def paper_record(i, paper_folder, cleaned_content):
+    # 构造基础 JSONL 条目
+    # 这里先用最通用的格式，方便后续改造成 QA 格式
+    return {
+        "source": f"batch_{i}/{paper_folder}",
+        "title": paper_folder.replace('_', ' '),
+        "content": cleaned_content,
+        "metadata": {
+            "batch": i,
+            "char_count": len(cleaned_content)
+        }
+    }
+
+def wash_paper(task):
+    """在子进程里清洗一篇论文，返回 (状态, JSONL 行或错误信息, 内容哈希)
+
+    内容哈希和索引里的一样时返回 "same"，不用再清洗
+    """
+    i, paper_folder, md_path, old_hash = task
+    try:
+        with open(md_path, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.sha1(raw).hexdigest()
+        if digest == old_hash:
+            return "same", None, digest
+        # 与文本模式读取一致：统一换行符
+        raw_content = raw.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+        
+        # 执行清洗
+        cleaned_content = clean_paper_content(raw_content)
+        
+        # 质量检查
+        if len(cleaned_content) < MIN_LENGTH:
+            return "skip", None, digest
+        
+        data_item = paper_record(i, paper_folder, cleaned_content)
+        # 序列化也放在子进程里做，主进程只负责按顺序写文件
+        return "ok", (json.dumps(data_item, ensure_ascii=False) + '\n').encode('utf-8'), digest
+        
+    except Exception as e:
+        return "error", f"处理 {md_path} 失败: {e}", None
+
+# ================= 增量索引 =================
+# 索引记录每篇论文 (按 md 路径) 的 mtime、大小、内容哈希，以及输出行在 OUTPUT_FILE 中的字节偏移或跳过原因。
+# 重跑时 mtime 和大小都没变的直接复用；变了的读一遍算哈希，内容没变也复用
+def index_path():
+    return INDEX_FILE or OUTPUT_FILE + ".index.json"
+
+def load_index():
+    settings = {"cleaner_version": CLEANER_VERSION, "min_length": MIN_LENGTH}
+    path = index_path()
+    if os.path.exists(path) and os.path.exists(OUTPUT_FILE):
+        with open(path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        # 输出文件大小对不上说明上次中途崩溃或被手动改过，不能再按偏移复用
+        if index.get("settings") == settings and index.get("output_size") == os.path.getsize(OUTPUT_FILE):
+            return index
+        print("清洗规则或输出文件有变化，全部重新清洗")
+    return {"settings": settings, "output_size": 0, "papers": {}}
+
+def save_index(index):
+    # 先写临时文件再替换，中途崩溃不会留下半个索引
+    path = index_path()
+    tmp = path + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def build_dataset():
+    index = load_index()
+    old = index["papers"]
+    papers = {}   # 本次的索引
+    plan = []     # 按输出顺序排列的 (key, 是否需要清洗)
+    tasks = []
+    for i, paper_folder, folder_path, md_path in iter_papers():
+        source = f"batch_{i}/{paper_folder}"
+        if md_path is None:
+            papers[folder_path] = {"source": source, "status": "skip", "reason": "no_md"}
+            continue
+        st = os.stat(md_path)
+        prev = old.get(md_path)
+        if prev and prev["mtime"] == st.st_mtime_ns and prev["size"] == st.st_size:
+            papers[md_path] = prev
+            plan.append((md_path, False))
+            continue
+        papers[md_path] = {"source": source, "mtime": st.st_mtime_ns, "size": st.st_size}
+        tasks.append((i, paper_folder, md_path, prev["hash"] if prev else None))
+        plan.append((md_path, True))
+
+    # 旧的输出行全部原样保留时 (例如只是新来了一个 batch) 直接追加；
+    # 否则按顺序重写：没变的行按偏移从旧文件拷贝，只有变了的论文重新清洗
+    # 没有有效索引时 OUTPUT_FILE 里可能是旧内容，也要重写
+    append = (os.path.exists(OUTPUT_FILE) and os.path.getsize(OUTPUT_FILE) == index["output_size"]
+              and all(papers.get(key) is entry for key, entry in old.items() if entry["status"] == "ok"))
+    print(f"共 {len(papers)} 篇，需要清洗 {len(tasks)} 篇，输出方式: {'追加' if append else '重写'}")
+
+    if WORKERS == 1 or len(tasks) <= 1:
+        results = map(wash_paper, tasks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=WORKERS)
+        # map 按提交顺序返回结果，多进程下输出顺序和单进程完全一致
+        results = pool.map(wash_paper, tasks, chunksize=CHUNKSIZE)
+
+    old_file = None
+    if append:
+        outfile = open(OUTPUT_FILE, 'ab')
+        pos = index["output_size"]
+    else:
+        if any(entry["status"] == "ok" for entry in old.values()):
+            old_file = open(OUTPUT_FILE, 'rb')
+        outfile = open(OUTPUT_FILE + ".tmp", 'wb')
+        pos = 0
+    try:
+        for key, needs_wash in plan:
+            entry = papers[key]
+            if needs_wash:
+                status, payload, digest = next(results)
+                if status == "error":
+                    # 不写进索引，下次重跑再试
+                    print(payload)
+                    del papers[key]
                     continue
-                
-                # 寻找 Markdown 文件
-                md_files = [f for f in os.listdir(folder_path) if f.endswith('.md')]
-                if not md_files:
-                    skipped_count += 1
+                entry["hash"] = digest
+                if status == "same":
+                    # 只是 mtime 变了，内容没变
+                    prev = old[key]
+                    entry.update({k: prev[k] for k in ("status", "reason", "offset", "length") if k in prev})
+                elif status == "skip":
+                    entry.update({"status": "skip", "reason": "too_short"})
                     continue
-                
-                md_path = os.path.join(folder_path, md_files[0])
-                
-                try:
-                    with open(md_path, 'r', encoding='utf-8') as f:
-                        raw_content = f.read()
-                    
-                    # 执行清洗
-                    cleaned_content = clean_paper_content(raw_content)
-                    
-                    # 质量检查
-                    if len(cleaned_content) < MIN_LENGTH:
-                        skipped_count += 1
-                        continue
-                    
-                    # 构造基础 JSONL 条目
-                    # 这里先用最通用的格式，方便后续改造成 QA 格式
-                    data_item = {
-                        "source": f"batch_{i}/{paper_folder}",
-                        "title": paper_folder.replace('_', ' '),
-                        "content": cleaned_content,
-                        "metadata": {
-                            "batch": i,
-                            "char_count": len(cleaned_content)
-                        }
-                    }
-                    
-                    outfile.write(json.dumps(data_item, ensure_ascii=False) + '\n')
-                    extracted_count += 1
-                    
-                except Exception as e:
-                    print(f"处理 {md_path} 失败: {e}")
+                else:
+                    entry.update({"status": "ok", "offset": pos, "length": len(payload)})
+                    outfile.write(payload)
+                    pos += len(payload)
+                    continue
+            # 复用旧的输出行
+            if entry["status"] != "ok" or append:
+                continue
+            old_file.seek(entry["offset"])
+            line = old_file.read(entry["length"])
+            entry["offset"] = pos
+            outfile.write(line)
+            pos += len(line)
+    finally:
+        outfile.close()
+        if old_file:
+            old_file.close()
+        if pool:
+            pool.shutdown()
+    if not append:
+        os.replace(OUTPUT_FILE + ".tmp", OUTPUT_FILE)
+
+    index["papers"] = papers
+    index["output_size"] = pos
+    save_index(index)
 
+    extracted_count = sum(1 for entry in papers.values() if entry["status"] == "ok")
+    skipped_count = sum(1 for entry in papers.values() if entry["status"] == "skip")
     print(f"\n处理完成！")
     print(f"成功提取: {extracted_count} 篇论文")
     print(f"跳过/无效: {skipped_count} 篇")
+    print(f"本次重新清洗: {len(tasks)} 篇")
     print(f"结果已保存至: {OUTPUT_FILE}")
 
 if __name__ == "__main__":
-    build_dataset()
\ No newline at end of file
+    build_dataset()